@@ -1,58 +1,51 @@
-import os
-import json
-import yaml
+import sys
+import argparse
 
 from os         import path
-from datetime   import datetime
 
-# Pipeline steps
-from utils.init                                             import get_llm
-from pipeline.general.s1_read_and_extract_text              import process_pdf_files
-from pipeline.general.s2_semantically_group_paragraphs      import process_semantic_grouping
-from pipeline.general.s3_summarize_grouped_files            import summarize_grouped_files
-from pipeline.graph_rag.s1_entity_type_identification       import extract_entity_types_
-from pipeline.graph_rag.s2_extract_entities                 import extract_entities_
-from pipeline.graph_rag.s3_relate_entities                  import relate_entities_
+# Pipeline runner
+from utils.init         import load_configs
+from pipeline.runner    import RunLock, build_stages, resolve_targets, run_pipeline
 
 # Define the data directory relative to this file.
 BASE_DIR = path.dirname(path.realpath(__file__))
 DATA_DIR = path.join(BASE_DIR, "data")
 
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Run the ingestion pipeline on the documents of the data directory.")
+    parser.add_argument("--config",         default=None,       help="Config file, defaults to $RAG_CONFIG_PATH or config-aws.yaml.")
+    parser.add_argument("--data-dir",       default=DATA_DIR,   help="Directory containing the PDF files.")
+    parser.add_argument("--targets",        nargs="+",          help="Stages to run (and the stages they depend on). Defaults to every stage.")
+    parser.add_argument("--only",           action="store_true", help="Run only the targets, not the stages they depend on.")
+    parser.add_argument("--stage-by-stage", action="store_true", help="Finish each stage on every document before starting the next one.")
+    parser.add_argument("--max-workers",    type=int, default=1, help="Number of documents processed at the same time.")
+    parser.add_argument("--force",          action="store_true", help="Reprocess every document, even if it is up to date.")
+    parser.add_argument("--list",           action="store_true", help="List the stages to run and exit.")
+    parser.add_argument("--verbose",        action="store_true", help="Print the progress of every stage.")
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    # Uncomment the steps below as needed for your pipeline.
-
-    # Step 1: Process PDF files.
-    # process_pdf_files(data_dir = DATA_DIR)
-    
-    # Step 2: Apply semantic grouping to processed JSON files.
-    #process_semantic_grouping(
-    #    llm                     = get_llm(usecase="semantic_grouping"),
-    #    data_dir                = DATA_DIR,
-    #    max_merged_chunk_len    = 4000,
-    #)
-
-    # Step 3: Summarize grouped JSON files.
-    #summarize_grouped_files(
-    #    llm                = get_llm(usecase="summary"),
-    #    data_dir           = DATA_DIR,
-    #)
-
-    # Step 4: Extract entity types from the summarized documents.
-    #extract_entity_types_(
-    #    llm                 = get_llm(usecase="extract_entity_types"),
-    #    data_dir            = DATA_DIR,
-    #)
-
-    # Step 5: Extract entities from the grouped paragraphs.
-    #extract_entities_(
-    #    llm                 = get_llm(usecase="extract_entities"),
-    #    data_dir            = DATA_DIR,
-    #)
-
-    # Step 6: Relate entities to each other.
-    #relate_entities_(
-    #    llm                 = get_llm(usecase="relate_entities"),
-    #    data_dir            = DATA_DIR,
-    #)
-
-    pass
\ No newline at end of file
+    args = parse_args()
+    load_configs(args.config)
+
+    if args.list:
+        stages = build_stages(args.data_dir)
+        for name in resolve_targets(stages, args.targets or list(stages), with_dependencies=not args.only):
+            print(f"{name:<25} <- {', '.join(stages[name].dependencies) or 'PDF files'}")
+        sys.exit(0)
+
+    with RunLock(args.data_dir):
+        failures = run_pipeline(
+            data_dir            = args.data_dir,
+            targets             = args.targets,
+            with_dependencies   = not args.only,
+            pipelined           = not args.stage_by_stage,
+            max_workers         = args.max_workers,
+            force               = args.force,
+            verbose             = args.verbose,
+        )
+
+    # A non-zero exit code lets schedulers notice failed documents. They are retried on the next run.
+    sys.exit(1 if failures else 0)
@@ -1,29 +1,35 @@
 import os
-import json
-import hashlib
 
-from tqdm               import tqdm
 from datetime           import datetime
 from os                 import path
-from typing             import List, Union
+from typing             import Dict, List, Optional, Union
 from langchain_ollama   import ChatOllama
 from langchain_aws      import ChatBedrockConverse
 
 # Local imports
 from utils.base_operations.file_search                  import get_files_paths_local
+from utils.base_operations.file_pool                    import process_files_concurrently
 from utils.base_operations.contextually_place_chunk     import contextualize_doc
+from utils.base_operations.document_io                  import DocumentWriter, iter_batches, iter_items, read_fields, with_format
+from utils.base_operations.checkpoint                   import ParagraphCheckpoint
+from utils.base_operations.manifest                     import StageManifest, hash_config, llm_fingerprint, prompt_fingerprint
+from utils.prompts.contextual_retrieval.contextualize_chunks_prompts import contextualize_chunk_prompt
 
 def contextualize_chunks(
                             llm:                  Union[ChatOllama, ChatBedrockConverse],
                             data_dir:             str,
-                            extensions:           List[str] = ["json"],
+                            extensions:           List[str] = ["json", "jsonl"],
                             strategy:             str = "full_document",
                             base_file_prefix:     str = "summarized-",
                             output_file_prefix:   str = "contextualized-chunks-",
                             output_dir:           str = "contextual/first-data-extraction",
                             max_chunk_len:        int = 6000,
+                            document_format:      str = "json",
+                            max_workers:          int = 1,
+                            files:                Optional[List[str]] = None,
+                            force:                bool = False,
                             verbose:              bool = False,
-                        ) -> None:
+                        ) -> Dict[str, Exception]:
     """
     Load JSON files that start with "summarized-" because in the case we want to contextualize,
     the chunks based on the summary instead of the original text, we will need the summary.
@@ -41,17 +47,67 @@ def contextualize_chunks(
         output_file_prefix:   str - The prefix of the output JSON files.
         output_dir:           str - The directory to save the summarized JSON files.
         max_chunk_len:        int - The maximum length of the document chunks for summarization.
+        document_format:      str - Format of the output files, "json" or "jsonl" (streamed paragraph by paragraph).
+        max_workers:          int - Number of files contextualized at the same time. A failing file doesn't stop the others.
+        files:                Optional[List[str]] - Contextualize only these files instead of every matching file in data_dir.
+        force:                bool - Contextualize the files even if they and the stage configuration are unchanged since the last run.
         verbose:              bool - Whether to print the progress.
+
+    Returns:
+        Dict[str, Exception] - The files that failed, with their exception.
     """
 
-    json_files = get_files_paths_local(data_dir, extensions=extensions, file_prefix=base_file_prefix)
+    json_files = files if files is not None else get_files_paths_local(data_dir, extensions=extensions, file_prefix=base_file_prefix)
     output_dir = path.join(data_dir, output_dir)
     os.makedirs(output_dir, exist_ok=True)
 
-    for file_path in tqdm(json_files, desc="Contextualizing chunks", disable=not verbose):
-        # Load the JSON file
-        with open(file_path, "r") as f:
-            data = json.load(f, encoding="utf-8")
+    # Skip the files already contextualized, unchanged, with the same configuration.
+    manifest = StageManifest.for_stage(data_dir, "contextualize_chunks", hash_config(
+        stage       = "contextualize_chunks",
+        llm         = llm_fingerprint(llm),
+        prompt      = prompt_fingerprint(contextualize_chunk_prompt),
+        strategy    = strategy,
+        output      = (output_dir, output_file_prefix, document_format),
+    ))
+    pending = dict(manifest.pending(json_files, force=force, verbose=verbose))
+
+    # Contextualize the chunks of each file, a failing file doesn't stop the others.
+    def process_file(file_path: str) -> str:
+        # The chunks are placed in the full text or in the summary of the document.
+        fields = read_fields(file_path)
+        if strategy == "full_document":
+            document_context = " ".join(para["text"] for para in iter_items(file_path, "grouped_paragraphs"))
+        else:
+            document_context = fields["summary"]
+
+        filename = path.basename(file_path).replace(base_file_prefix, "")
+        output_file = with_format(path.join(output_dir, f"{output_file_prefix}{filename}"), document_format)
+
+        # Contextualize the chunks, one batch of paragraphs in memory at a time
+        checkpoint = ParagraphCheckpoint.for_file(output_dir, "contextualize_chunks", file_path, manifest.config_hash + pending[file_path])
+        with DocumentWriter(output_file, fields) as writer:
+            writer.counts["grouped_paragraphs"] = 0
+            for paragraphs in iter_batches(iter_items(file_path, "grouped_paragraphs")):
+                preambles = contextualize_doc(llm, {"grouped_paragraphs": paragraphs},
+                                              strategy          = strategy,
+                                              document_context  = document_context,
+                                              checkpoint        = checkpoint,
+                                              verbose           = verbose)
+                for paragraph, preamble in zip(paragraphs, preambles):
+                    paragraph["context"] = preamble
+                writer.write_many("grouped_paragraphs", paragraphs)
+
+            # Add metadata to the contextualized document
+            writer.close(metadata={
+                "contextualization_strategy":   strategy,
+                "contextualization_timestamp":  datetime.isoformat(datetime.now()),
+            })
+        manifest.record(file_path, pending[file_path], output_file)
+        checkpoint.remove()
+        return output_file
 
-        # Contextualize the chunks
-        data = contextualize_doc(llm, data, strategy=strategy, verbose=verbose)
\ No newline at end of file
+    return process_files_concurrently(list(pending),
+                                      process_file,
+                                      max_workers   = max_workers,
+                                      desc          = "Contextualizing chunks",
+                                      verbose       = verbose)
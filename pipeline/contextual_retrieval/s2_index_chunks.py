@@ -0,0 +1,113 @@
+from os                 import path
+from typing             import Dict, List, Optional
+from langchain_core.embeddings import Embeddings
+
+# Local imports
+from utils.vector_index                         import VectorIndex
+from utils.base_operations.file_search          import get_files_paths_local
+from utils.base_operations.file_pool            import process_files_concurrently
+from utils.base_operations.chunk_index          import embed_chunks
+from utils.base_operations.document_io          import iter_items
+from utils.base_operations.manifest             import StageManifest, hash_config, hash_file, llm_fingerprint
+
+
+def index_chunks_(
+                    embeddings:         Embeddings,
+                    index:              VectorIndex,
+                    data_dir:           str,
+                    extensions:         List[str] = ["json", "jsonl"],
+                    base_file_prefix:   str = "contextualized-chunks-",
+                    input_dir:          str = "contextual/first-data-extraction",
+                    batch_size:         int = 64,
+                    max_workers:        int = 1,
+                    files:              Optional[List[str]] = None,
+                    force:              bool = False,
+                    verbose:            bool = False,
+                ) -> Dict[str, Exception]:
+    """
+    Load JSON files that start with "contextualized-chunks-", embed every chunk with its contextual preamble,
+    and add them to the vector index, where 'retrieve_chunks' searches them. A document indexed again replaces
+    its previous chunks. The documents whose file was deleted are removed, and the search structures updated,
+    once for the corpus by 'prune_chunk_index_'.
+
+    Args:
+        - embeddings: Embeddings - The embeddings model of the chunks.
+        - index: VectorIndex - The vector index, see 'get_vector_index'.
+        - data_dir: str - The data directory.
+        - extensions: List[str] - The file extensions to consider.
+        - base_file_prefix: str - The prefix of the contextualized JSON files.
+        - input_dir: str - The directory of the contextualized JSON files, relative to data_dir.
+        - batch_size: int - Number of chunks embedded per request.
+        - max_workers: int - Number of files indexed at the same time. A failing file doesn't stop the others.
+        - files: Optional[List[str]] - Index only these files instead of every matching file.
+        - force: bool - Index the files even if they and the embeddings model are unchanged since the last run.
+        - verbose: bool - Whether to print the progress.
+
+    Returns:
+        - Dict[str, Exception] - The files that failed, with their exception.
+    """
+    json_files = files if files is not None else get_files_paths_local(path.join(data_dir, input_dir),
+                                                                      extensions=extensions, file_prefix=base_file_prefix)
+
+    manifest = StageManifest.for_stage(data_dir, "index_chunks", hash_config(
+        stage       = "index_chunks",
+        embeddings  = llm_fingerprint(embeddings),
+        index       = type(index).__name__,
+    ))
+    pending = dict(manifest.pending(json_files, force=force, verbose=verbose))
+
+    # The files up to date but missing from the index (e.g. deleted) are indexed again.
+    pending.update({f: hash_file(f) for f in json_files if f not in pending and path.normpath(f) not in index.documents})
+
+    # Index the chunks of each file, a failing file doesn't stop the others.
+    def process_file(file_path: str) -> str:
+        index.add_document(file_path, embed_chunks(embeddings, iter_items(file_path, "grouped_paragraphs"), batch_size=batch_size))
+        # The chunks live in the index, the input itself is recorded as the output.
+        manifest.record(file_path, pending[file_path], file_path)
+        return file_path
+
+    failures = process_files_concurrently(list(pending),
+                                          process_file,
+                                          max_workers   = max_workers,
+                                          desc          = "Indexing chunks",
+                                          verbose       = verbose)
+    if verbose:
+        print(f"Indexed {len(pending) - len(failures)} of {len(json_files)} files in the vector index")
+    return failures
+
+
+def prune_chunk_index_(
+                        index:              VectorIndex,
+                        data_dir:           str,
+                        extensions:         List[str] = ["json", "jsonl"],
+                        base_file_prefix:   str = "contextualized-chunks-",
+                        input_dir:          str = "contextual/first-data-extraction",
+                        max_dead_ratio:     float = 0.3,
+                        verbose:            bool = False,
+                    ) -> None:
+    """
+    Remove the documents whose contextualized file was deleted from the vector index, compact the index
+    once the chunks of the deleted and replaced documents are more than 'max_dead_ratio' of its rows,
+    and update its search structures (e.g. train the IVF index) with the chunks indexed since the last run.
+    Runs on the whole corpus, after 'index_chunks_', since only the list of every current file tells
+    which documents are gone, and the search structures are best built once every document is indexed.
+
+    Args:
+        - index: VectorIndex - The vector index, see 'get_vector_index'.
+        - data_dir: str - The data directory.
+        - extensions: List[str] - The file extensions to consider.
+        - base_file_prefix: str - The prefix of the contextualized JSON files.
+        - input_dir: str - The directory of the contextualized JSON files, relative to data_dir.
+        - max_dead_ratio: float - Share of dead rows from which the index is compacted.
+        - verbose: bool - Whether to print the progress.
+    """
+    current = {path.normpath(f) for f in get_files_paths_local(path.join(data_dir, input_dir),
+                                                               extensions=extensions, file_prefix=base_file_prefix)}
+    deleted = [document for document in index.documents if document not in current]
+    for document in deleted:
+        index.delete_document(document)
+
+    compacted = index.compact(max_dead_ratio=max_dead_ratio)
+    index.build()
+    if verbose:
+        print(f"Removed {len(deleted)} deleted files from the vector index" + (", compacted it" if compacted else ""))
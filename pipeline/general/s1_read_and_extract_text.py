@@ -1,19 +1,31 @@
 import os
-import json
 from os         import path
 from datetime   import datetime
-from typing     import Dict, List
+from typing     import Dict, Iterable, List, Optional, Tuple, Union
 
-from utils.pdf_document_parser                import extract_paragraphs_and_tables
+from utils.ocr_cache                    import SQLiteOCRCache
+from utils.pdf_document_parser          import extract_pdfs_concurrently, iter_paragraphs_and_tables
 from utils.base_operations.file_search  import get_files_paths_local
+from utils.base_operations.manifest     import StageManifest, hash_config
+from utils.base_operations.document_io  import DocumentWriter, with_format
 
 def process_pdf_files(
                         data_dir:             str,
                         file_extensions:      List[str] = ["pdf"],
                         output_dir_name:      str = "first-data-extraction",
                         output_files_prefix:  str = "processed-",
+                        document_format:      str = "json",
+                        max_workers:          int = 1,
+                        pages_per_shard:      int = 25,
+                        page_timeout:         Optional[float] = 120,
+                        text_layer_fast_path: bool = True,
+                        ocr_cache:            Optional[SQLiteOCRCache] = None,
+                        extract_table_images: bool = False,
+                        chunk_elements:       bool = True,
+                        files:                Optional[List[str]] = None,
+                        force:                bool = False,
                         verbose:              bool = True,
-                      ) -> None:
+                      ) -> Dict[str, Exception]:
     """
     Process PDF files by extracting paragraphs and tables,
     then save the results as JSON files in a "first-data-extraction" directory.
@@ -23,40 +35,119 @@ def process_pdf_files(
         - file_extensions (List[str]): The extensions of the files to process.
         - output_dir_name (str): The name of the output directory.
         - output_files_prefix (str): The prefix for the output JSON files.
+        - document_format (str): Format of the output files, "json" or "jsonl" (streamed record by record).
+        - max_workers (int): Number of worker processes. Above 1, files are parsed concurrently and split in
+                             page ranges parsed in parallel; 1 parses them one by one in this process,
+                             streaming their paragraphs to the output as the page batches are parsed.
+        - pages_per_shard (int): Maximum number of pages parsed at once: the page ranges of the worker processes,
+                                 or the page batches streamed in this process. Bounds the memory of a parse.
+        - page_timeout (Optional[float]): Seconds allowed per page, with 'max_workers' above 1. None disables it.
+        - text_layer_fast_path (bool): Read born-digital pages from their text layer, only OCR the scanned pages
+                                       and the pages with tables.
+        - ocr_cache (Optional[SQLiteOCRCache]): Reuse the elements of the pages already OCRed, in any document.
+        - extract_table_images (bool): Save an image of every table in the output directory.
+        - chunk_elements (bool): Combine the elements under each title in chunks of up to 500 characters. Off keeps
+                                 one paragraph per element with its type (Title, ListElement, Footer...), for
+                                 the type rules of the semantic grouping.
+        - files (Optional[List[str]]): Process only these files instead of every matching file in data_dir.
+        - force (bool): Reprocess the files even if they are unchanged since the last run.
         - verbose (bool): Whether to print progress information
+
+    Returns:
+        - Dict[str, Exception]: The files that failed, with their exception.
     """
 
-    files = get_files_paths_local(data_dir, extensions=file_extensions)
+    if files is None:
+        files = get_files_paths_local(data_dir, extensions=file_extensions)
     if verbose:
         print(f"Found {len(files)} {file_extensions} files in {data_dir}")
 
-    for file in files:
-        original_dir = path.dirname(file)
-        file_name = path.splitext(path.basename(file))[0]
-        output_dir = path.join(original_dir, output_dir_name)
-        os.makedirs(output_dir, exist_ok=True)
+    # Skip the files already processed, unchanged, with the same settings.
+    manifest = StageManifest.for_stage(data_dir, "process_pdf_files", hash_config(
+        stage                = "process_pdf_files",
+        output_dir_name      = output_dir_name,
+        output_files_prefix  = output_files_prefix,
+        document_format      = document_format,
+        text_layer_fast_path = text_layer_fast_path,
+        extract_table_images = extract_table_images,
+        chunk_elements       = chunk_elements,
+    ))
 
-        # Extract paragraphs and tables from the PDF.
-        paragraphs, tables = extract_paragraphs_and_tables(
-            file,
-            image_output_dir_path=output_dir
-        )
+    pending = dict(manifest.pending(files, force=force, verbose=verbose))
+    failures: Dict[str, Exception] = {}
 
-        output_data = {
-            "paragraphs": paragraphs,
-            "tables": tables,
-            "metadata": {
-                "original_file": file,
-                "processing_date": datetime.now().isoformat()
-            }
-        }
+    def output_dir_of(file: str) -> str:
+        output_dir = path.join(path.dirname(file), output_dir_name)
+        os.makedirs(output_dir, exist_ok=True)
+        return output_dir
 
-        output_file = path.join(output_dir, f"{output_files_prefix}{file_name}.json")
-        with open(output_file, "w", encoding="utf-8") as f:
-            json.dump(output_data, f, ensure_ascii=False, indent=4)
+    def save(file: str, records: Iterable[Tuple[str, Union[dict, str]]]) -> None:
+        file_name = path.splitext(path.basename(file))[0]
+        output_file = with_format(path.join(output_dir_of(file), f"{output_files_prefix}{file_name}"), document_format)
+        try:
+            with DocumentWriter(output_file, {"metadata": {
+                                                "original_file": file,
+                                                "processing_date": datetime.now().isoformat(),
+                                                "original_file_hash": pending[file],
+                                              }}) as writer:
+                for list_name, item in records:
+                    writer.write(list_name, item)
+                writer.close()
+        except Exception:
+            # A streamed document is left without its trailer, removed so the next stages never read it.
+            if document_format == "jsonl" and path.exists(output_file):
+                os.remove(output_file)
+            raise
+        manifest.record(file, pending[file], output_file)
 
         if verbose:
             print(f"Processed: {file}")
-            print(f"Paragraphs: {len(paragraphs)}")
-            print(f"Tables: {len(tables)}")
-            print("-" * 60)
\ No newline at end of file
+            print(f"Paragraphs: {writer.counts.get('paragraphs', 0)}")
+            print(f"Tables: {writer.counts.get('tables', 0)}")
+            print("-" * 60)
+
+    if max_workers <= 1:
+        for file in pending:
+            # Extract paragraphs and tables from the PDF, written as each batch of pages is parsed.
+            try:
+                save(file, iter_paragraphs_and_tables(
+                    file,
+                    image_output_dir_path=output_dir_of(file),
+                    pages_per_batch=pages_per_shard,
+                    text_layer_fast_path=text_layer_fast_path,
+                    ocr_cache=ocr_cache,
+                    extract_table_images=extract_table_images,
+                    chunk_elements=chunk_elements,
+                ))
+            except Exception as e:
+                failures[file] = e
+                print(f"Failed to process {file}: {type(e).__name__}: {e}")
+        parsed = []
+    else:
+        # Parse the PDFs in a pool of processes, saving each one as soon as all of its pages are parsed.
+        parsed = extract_pdfs_concurrently(
+            {file: output_dir_of(file) for file in pending},
+            max_workers          = max_workers,
+            pages_per_shard      = pages_per_shard,
+            page_timeout         = page_timeout,
+            text_layer_fast_path = text_layer_fast_path,
+            ocr_cache            = ocr_cache,
+            extract_table_images = extract_table_images,
+            chunk_elements       = chunk_elements,
+        )
+    for file, result in parsed:
+        if isinstance(result, Exception):
+            failures[file] = result
+            print(f"Failed to process {file}: {type(result).__name__}: {result}")
+            continue
+        paragraphs, tables = result
+        try:
+            save(file, [("paragraphs", paragraph) for paragraph in paragraphs] + [("tables", table) for table in tables])
+        except Exception as e:
+            failures[file] = e
+            print(f"Failed to save {file}: {type(e).__name__}: {e}")
+
+    if failures:
+        print(f"Processing PDF files: {len(failures)} of {len(pending)} files failed.")
+
+    return failures
@@ -0,0 +1,81 @@
+import json
+import hashlib
+
+from os                 import path
+from datetime           import datetime
+from typing             import List
+
+# Local imports
+from utils.base_operations.file_search          import get_files_paths_local
+from utils.base_operations.deduplication        import find_boilerplate
+from utils.base_operations.document_io          import iter_items
+from utils.base_operations.manifest             import StageManifest, hash_config, hash_file
+from utils.base_operations.serialization        import atomic_write, dumps
+
+
+def mark_boilerplate(
+                        data_dir:             str,
+                        extensions:           List[str] = ["json", "jsonl"],
+                        base_file_prefix:     str = "processed-",
+                        output_dir:           str = "first-data-extraction",
+                        output_file_name:     str = "boilerplate.json",
+                        min_pages:            int = 3,
+                        min_documents:        int = 2,
+                        max_distance:         int = 3,
+                        force:                bool = False,
+                        verbose:              bool = False,
+                    ) -> None:
+    """
+    Find the boilerplate paragraphs of the processed files (headers, footers, disclaimers repeated across
+    pages, and across documents when they also repeat within one, exact or near duplicates) and save them in a "boilerplate.json" index. Semantic
+    grouping skips the excluded paragraphs, so no LLM stage pays for them; the index keeps their provenance.
+
+    Args:
+        - data_dir: str - The directory containing the processed JSON files.
+        - extensions: List[str] - The file extensions to consider.
+        - base_file_prefix: str - The prefix of the processed JSON files.
+        - output_dir: str - The directory to save the boilerplate index.
+        - output_file_name: str - The name of the boilerplate index.
+        - min_pages: int - Number of pages of a document from which a repeated paragraph is boilerplate.
+        - min_documents: int - Number of documents from which a paragraph repeated on several pages is boilerplate.
+        - max_distance: int - Maximum SimHash Hamming distance between near-duplicate paragraphs.
+        - force: bool - Rebuild the index even if the processed files and the settings are unchanged since the last run.
+        - verbose: bool - Whether to print the progress.
+    """
+    json_files = get_files_paths_local(data_dir, extensions=extensions, file_prefix=base_file_prefix)
+    json_files = sorted(path.normpath(f) for f in json_files)
+    output_file = path.join(data_dir, output_dir, output_file_name)
+
+    # The index depends on the whole corpus, so it is up to date only if no processed file changed.
+    manifest = StageManifest.for_stage(data_dir, "mark_boilerplate", hash_config(
+        stage           = "mark_boilerplate",
+        min_pages       = min_pages,
+        min_documents   = min_documents,
+        max_distance    = max_distance,
+        # Shared paragraphs must also repeat within a document, older indexes are rebuilt.
+        across_documents = "repeated_pages",
+    ))
+    corpus_hash = hashlib.md5(json.dumps([(f, hash_file(f)) for f in json_files]).encode()).hexdigest()
+
+    if not force and manifest.is_up_to_date(data_dir, corpus_hash):
+        if verbose:
+            print(f"Boilerplate index is up to date: {output_file}")
+        return
+
+    # The paragraphs are streamed, only their fingerprints are kept in memory.
+    boilerplate = find_boilerplate({json_file: iter_items(json_file, "paragraphs") for json_file in json_files},
+                                   min_pages     = min_pages,
+                                   min_documents = min_documents,
+                                   max_distance  = max_distance)
+    boilerplate["metadata"] = {
+        "documents":            len(json_files),
+        "excluded_paragraphs":  sum(len(positions) for positions in boilerplate["excluded_paragraphs"].values()),
+        "timestamp":            datetime.now().isoformat(),
+    }
+
+    atomic_write(output_file, dumps(boilerplate))
+    manifest.record(data_dir, corpus_hash, output_file)
+
+    if verbose:
+        print(f"Saved boilerplate index: {output_file} ({len(boilerplate['clusters'])} clusters, "
+              f"{boilerplate['metadata']['excluded_paragraphs']} paragraphs excluded)")
@@ -1,27 +1,44 @@
 import os   
 import json
-import tqdm
-import hashlib 
+import hashlib
 
 from datetime               import datetime
-from typing                 import List, Union
+from typing                 import Dict, List, Optional, Set, Union
 from langchain_ollama       import ChatOllama
 from langchain_aws          import ChatBedrockConverse
+from langchain_core.embeddings import Embeddings
 
 # Local imports
 from utils.base_operations.file_search          import get_files_paths_local
-from utils.base_operations.semantic_grouping    import semantic_grouping
+from utils.base_operations.file_pool            import process_files_concurrently
+from utils.base_operations.semantic_grouping    import iter_semantic_groups, iter_embedding_semantic_groups, grouping_record, grouping_stats
+from utils.base_operations.document_io          import DocumentWriter, iter_items, with_format
+from utils.base_operations.manifest             import StageManifest, hash_config, llm_fingerprint, prompt_fingerprint
+from utils.base_operations.checkpoint           import ParagraphCheckpoint
+from utils.prompts.general.semantic_grouping_prompts import similarity_prompt
 
 def process_semantic_grouping(
-                              llm:                  Union[ChatOllama, ChatBedrockConverse],
-                              data_dir:             str,
-                              extensions:           List[str] = ["json"], 
-                              base_file_prefix:     str = "processed-",
-                              max_merged_chunk_len: int = 4000,
-                              output_file_prefix:   str = "grouped-",
-                              output_dir:           str = "second-data-extraction",
-                              verbose:              bool = False,
-                              ) -> None:
+                              llm:                    Union[ChatOllama, ChatBedrockConverse],
+                              data_dir:               str,
+                              extensions:             List[str] = ["json", "jsonl"], 
+                              base_file_prefix:       str = "processed-",
+                              max_merged_chunk_len:   int = 4000,
+                              output_file_prefix:     str = "grouped-",
+                              output_dir:             str = "second-data-extraction",
+                              strategy:               str = "llm",
+                              embeddings:             Optional[Embeddings] = None,
+                              merge_threshold:        float = 0.80,
+                              split_threshold:        float = 0.60,
+                              context_token_budget:   Optional[int] = None,
+                              type_rules:             bool = True,
+                              min_fragment_chars:     int = 40,
+                              max_workers:            int = 1,
+                              document_format:        str = "json",
+                              boilerplate_file_path:  Optional[str] = "first-data-extraction/boilerplate.json",
+                              files:                  Optional[List[str]] = None,
+                              force:                  bool = False,
+                              verbose:                bool = False,
+                              ) -> Dict[str, Exception]:
     """
     Apply semantic grouping on processed JSON files whose filenames start with "processed-".
 
@@ -33,45 +50,176 @@ def process_semantic_grouping(
         - max_merged_chunk_len: int - The maximum length of the merged chunks. Character wise.
         - output_file_prefix: str - The prefix of the output JSON files.
         - output_dir: str - The directory to save the grouped JSON files.
+        - strategy: str - "llm" asks the LLM about every paragraph, "embeddings" decides by embedding similarity
+                    and only asks the LLM about ambiguous boundaries.
+        - embeddings: Optional[Embeddings] - The embeddings model, required by the "embeddings" strategy.
+        - merge_threshold: float - "embeddings" strategy, similarity from which paragraphs are merged directly.
+        - split_threshold: float - "embeddings" strategy, similarity under which paragraphs are split directly.
+        - context_token_budget: Optional[int] - Token budget of the rolling context sent in each grouping prompt,
+                                None sends the whole current chunk and previous group.
+        - type_rules: bool - Decide the unambiguous boundaries from the element types of the paragraphs (a "Title"
+                      starts a chunk, consecutive "ListElement"s merge, titles and short fragments merge with the
+                      next paragraph) and drop the "Footer"s, so the LLM is only asked about the other boundaries.
+        - min_fragment_chars: int - With 'type_rules', paragraphs shorter than this are merged with the next one.
+        - max_workers: int - Number of files grouped at the same time. A failing file doesn't stop the others.
+        - document_format: str - Format of the output files, "json" or "jsonl" (streamed paragraph by paragraph).
+        - boilerplate_file_path: Optional[str] - Index of the boilerplate paragraphs to skip (see 'mark_boilerplate'),
+                                 relative to data_dir. Nothing is skipped when None or when the index doesn't exist.
+        - files: Optional[List[str]] - Group only these files instead of every matching file in data_dir.
+        - force: bool - Regroup the files even if they and the stage configuration are unchanged since the last run.
+
+    Returns:
+        - Dict[str, Exception] - The files that failed, with their exception.
     """
+    if strategy not in ["llm", "embeddings"]:
+        raise ValueError(f"Invalid semantic grouping strategy: {strategy}. Options: 'llm', 'embeddings'.")
+    if strategy == "embeddings" and embeddings is None:
+        raise ValueError("The 'embeddings' semantic grouping strategy requires an embeddings model.")
+
     # Create the output directory
     output_dir = os.path.join(data_dir, output_dir)
     os.makedirs(output_dir, exist_ok=True)
 
-    json_files = get_files_paths_local(data_dir,
-                                       extensions   =   extensions,
-                                       file_prefix  =   base_file_prefix,
-                                       verbose      =   verbose)
-
-    # Load the JSON files
-    data = []
-    for json_file in json_files:
-        with open(json_file, 'r') as f:
-            data.append(json.load(f))
-    
-
-    # Apply semantic grouping to each JSON file
-    for partially_chunked_file, json_file in tqdm.tqdm(zip(data, json_files), total=len(data), desc="Semantic Grouping"):
-
-        # Apply semantic grouping
-        grouped = semantic_grouping(llm, partially_chunked_file, max_merged_chunk_len, verbose)
-        if verbose:
-            print(f"Semantically grouped: {json_file}")
-        
-        # Add metadata to the grouped paragraphs
-        grouped["metadata"] = {
-            "source": json_file,
-            "grouped_timestamp": datetime.now().isoformat(),
-            "grouped_by": "semantic_grouping",
-        }
-        grouped["metadata"]["file_hash"] = hashlib.md5(json.dumps(grouped).encode()).hexdigest()
+    json_files = files if files is not None else get_files_paths_local(data_dir,
+                                                                       extensions   =   extensions,
+                                                                       file_prefix  =   base_file_prefix,
+                                                                       verbose      =   verbose)
+
+    # Paragraph positions excluded from each file as boilerplate.
+    excluded_paragraphs: Dict[str, Dict[str, int]] = {}
+    if boilerplate_file_path and os.path.exists(os.path.join(data_dir, boilerplate_file_path)):
+        with open(os.path.join(data_dir, boilerplate_file_path), "r", encoding="utf-8") as f:
+            excluded_paragraphs = json.load(f).get("excluded_paragraphs", {})
+
+    def excluded_of(json_file: str) -> Set[int]:
+        return {int(position) for position in excluded_paragraphs.get(os.path.normpath(json_file), {})}
+
+    # Skip the files already grouped, unchanged, with the same configuration and excluded paragraphs.
+    manifest = StageManifest.for_stage(data_dir, "semantic_grouping", hash_config(
+        stage                   = "semantic_grouping",
+        llm                     = llm_fingerprint(llm),
+        embeddings              = llm_fingerprint(embeddings) if strategy == "embeddings" else None,
+        prompt                  = prompt_fingerprint(similarity_prompt),
+        max_merged_chunk_len    = max_merged_chunk_len,
+        strategy                = strategy,
+        merge_threshold         = merge_threshold,
+        split_threshold         = split_threshold,
+        context_token_budget    = context_token_budget,
+        type_rules              = type_rules,
+        min_fragment_chars      = min_fragment_chars,
+        output                  = (output_dir, output_file_prefix, document_format),
+    ))
+    pending = dict(manifest.pending(json_files, force=force, verbose=verbose,
+                                    input_salt=lambda f: hashlib.md5(str(sorted(excluded_of(f))).encode()).hexdigest()))
+
+    # Apply semantic grouping to each JSON file, each worker loads its own file.
+    def process_file(json_file: str) -> str:
+        output_file = group_file(llm                   = llm,
+                                 json_file             = json_file,
+                                 output_dir            = output_dir,
+                                 output_file_prefix    = output_file_prefix,
+                                 max_merged_chunk_len  = max_merged_chunk_len,
+                                 strategy              = strategy,
+                                 embeddings            = embeddings,
+                                 merge_threshold       = merge_threshold,
+                                 split_threshold       = split_threshold,
+                                 context_token_budget  = context_token_budget,
+                                 type_rules            = type_rules,
+                                 min_fragment_chars    = min_fragment_chars,
+                                 document_format       = document_format,
+                                 excluded              = excluded_of(json_file),
+                                 checkpoint            = ParagraphCheckpoint.for_file(output_dir, "semantic_grouping", json_file,
+                                                                                      manifest.config_hash + pending[json_file]),
+                                 verbose               = verbose)
+        manifest.record(json_file, pending[json_file], output_file)
+        return output_file
+
+    return process_files_concurrently(list(pending),
+                                      process_file,
+                                      max_workers   = max_workers,
+                                      desc          = "Semantic Grouping",
+                                      verbose       = verbose)
 
-        # Save the grouped paragraphs to a new JSON file
-        output_file = os.path.join(output_dir, f"{output_file_prefix}{os.path.basename(json_file)}")
-        with open(output_file, "w", encoding="utf-8") as f:
-            json.dump(grouped, f, ensure_ascii=False, indent = 4)
 
-        # Only process the first file for now
-        break
+def group_file(
+                llm:                    Union[ChatOllama, ChatBedrockConverse],
+                json_file:              str,
+                output_dir:             str,
+                output_file_prefix:     str = "grouped-",
+                max_merged_chunk_len:   int = 4000,
+                strategy:               str = "llm",
+                embeddings:             Optional[Embeddings] = None,
+                merge_threshold:        float = 0.80,
+                split_threshold:        float = 0.60,
+                context_token_budget:   Optional[int] = None,
+                type_rules:             bool = True,
+                min_fragment_chars:     int = 40,
+                document_format:        str = "json",
+                excluded:               Optional[Set[int]] = None,
+                checkpoint:             Optional[ParagraphCheckpoint] = None,
+                verbose:                bool = False,
+              ) -> str:
+    """
+    Apply semantic grouping to a single processed file, and save it in 'output_dir'.
+    See 'process_semantic_grouping' for the arguments. Returns the path of the output file.
+    The optional 'checkpoint' logs the grouping decisions, so a crashed file resumes where it stopped.
+    The paragraphs at the 'excluded' positions (boilerplate) are skipped.
+
+    The paragraphs are read lazily and each chunk is written as soon as it is finalized.
+    """
+    excluded = excluded or set()
+    paragraphs = (paragraph for position, paragraph in enumerate(iter_items(json_file, "paragraphs"))
+                  if position not in excluded)
+
+    # Apply semantic grouping
+    stats = grouping_stats()
+    if strategy == "embeddings":
+        groups = iter_embedding_semantic_groups(llm, embeddings, paragraphs,
+                                                max_chunk             = max_merged_chunk_len,
+                                                merge_threshold       = merge_threshold,
+                                                split_threshold       = split_threshold,
+                                                context_token_budget  = context_token_budget,
+                                                checkpoint            = checkpoint,
+                                                type_rules            = type_rules,
+                                                min_fragment_chars    = min_fragment_chars,
+                                                stats                 = stats,
+                                                verbose               = verbose)
+    else:
+        groups = iter_semantic_groups(llm, paragraphs, max_merged_chunk_len,
+                                      context_token_budget = context_token_budget,
+                                      checkpoint           = checkpoint,
+                                      type_rules           = type_rules,
+                                      min_fragment_chars   = min_fragment_chars,
+                                      stats                = stats,
+                                      verbose              = verbose)
+
+    # Save the grouped paragraphs to a new file, as they are produced
+    output_file = with_format(os.path.join(output_dir, f"{output_file_prefix}{os.path.basename(json_file)}"), document_format)
+    total_length = 0
+    with DocumentWriter(output_file, {"metadata": {
+                                        "source": json_file,
+                                        "grouped_timestamp": datetime.now().isoformat(),
+                                        "grouped_by": "embedding_semantic_grouping" if strategy == "embeddings" else "semantic_grouping",
+                                      }}) as writer:
+        writer.counts["grouped_paragraphs"] = 0
+        for chunk in groups:
+            writer.write("grouped_paragraphs", grouping_record(chunk))
+            total_length += len(chunk)
+
+        # Add metadata to the grouped paragraphs
+        chunk_count = writer.counts["grouped_paragraphs"]
+        processing_metadata = {"average_chunk_length": total_length // chunk_count if chunk_count else 0,
+                               "boilerplate_paragraphs_skipped": len(excluded),
+                               **stats}
+        if strategy == "embeddings":
+            processing_metadata.update(grouping_strategy="embeddings")
+        writer.close(processing_metadata=processing_metadata)
+
+    if verbose:
+        print(f"Semantically grouped: {json_file}")
 
+    # The decisions are saved in the output, the progress log is no longer needed.
+    if checkpoint is not None:
+        checkpoint.remove()
 
+    return output_file
@@ -1,28 +1,36 @@
 import os
-import json
-import tqdm
-import hashlib
 
 from datetime           import datetime
 from os                 import path
-from typing             import List, Union
+from typing             import Dict, List, Optional, Union
 from langchain_ollama   import ChatOllama
 from langchain_aws      import ChatBedrockConverse
 
 # Local imports
 from utils.base_operations.file_search          import get_files_paths_local
+from utils.base_operations.file_pool            import process_files_concurrently
 from utils.base_operations.document_summary     import summarize_document
+from utils.base_operations.document_io          import DocumentWriter, iter_items, read_fields, with_format
+from utils.base_operations.manifest             import StageManifest, hash_config, llm_fingerprint, prompt_fingerprint
+from utils.prompts.general.summary_prompts      import summarize_prompt, summary_of_summaries_prompt
 
 def summarize_grouped_files(
                             llm:                  Union[ChatOllama, ChatBedrockConverse],
                             data_dir:             str,
-                            extensions:           List[str] = ["json"],
+                            extensions:           List[str] = ["json", "jsonl"],
                             base_file_prefix:     str = "grouped-",
                             output_file_prefix:   str = "summarized-",
                             output_dir:           str = "third-data-extraction",
                             max_chunk_len:        int = 6000,
+                            max_workers:          int = 1,
+                            strategy:             str = "sequential",
+                            reduce_fan_in:        int = 8,
+                            max_concurrency:      int = 1,
+                            document_format:      str = "json",
+                            files:                Optional[List[str]] = None,
+                            force:                bool = False,
                             verbose:              bool = False,
-                            ) -> None:
+                            ) -> Dict[str, Exception]:
     """
     Load JSON files that start with "grouped-", summarize their grouped paragraphs,
     and save the output with a new key "summary" in a "second-data-extraction" folder.
@@ -34,49 +42,109 @@ def summarize_grouped_files(
         - output_file_prefix: str - The prefix of the output JSON files.
         - output_dir: str - The directory to save the summarized JSON files.
         - max_chunk_len: int - The maximum length of the document chunks for summarization.
+        - max_workers: int - Number of files summarized at the same time. A failing file doesn't stop the others.
+        - strategy: str - "sequential" or "map_reduce" (concurrent split summaries reduced in a tree of bounded fan-in).
+        - reduce_fan_in: int - "map_reduce" strategy, maximum number of summaries merged by each reduce call.
+        - max_concurrency: int - "map_reduce" strategy, maximum number of requests in flight per file.
+        - document_format: str - Format of the output files, "json" or "jsonl" (streamed paragraph by paragraph).
+        - files: Optional[List[str]] - Summarize only these files instead of every matching file in data_dir.
+        - force: bool - Resummarize the files even if they and the stage configuration are unchanged since the last run.
         - verbose: bool - Whether to print the progress.
+
+    Returns:
+        - Dict[str, Exception] - The files that failed, with their exception.
     """
 
-    json_files = get_files_paths_local(data_dir, extensions=extensions, file_prefix=base_file_prefix)
+    json_files = files if files is not None else get_files_paths_local(data_dir, extensions=extensions, file_prefix=base_file_prefix)
     output_dir = path.join(data_dir, output_dir)
     os.makedirs(output_dir, exist_ok=True)
 
-    # Load the JSON files
-    data = []
-    for json_file in json_files:
-        with open(json_file, "r", encoding="utf-8") as f:
-            loaded_file = json.load(f)
-        data.append(loaded_file) 
-
-    for json_file, grouped_doc in tqdm.tqdm(zip(json_files, data),
-                                            total=len(data),
-                                            desc="Summarizing grouped files"):
-
-        if verbose:
-            print("-" * 60)
-            print(f"Summarizing: {json_file}")
-
-        summary = summarize_document(llm=llm,
-                                     document=grouped_doc,
-                                     verbose=verbose,
-                                     max_document_len=max_chunk_len)
-        grouped_doc["summary"]  = summary
-        
+    # Skip the files already summarized, unchanged, with the same configuration.
+    manifest = StageManifest.for_stage(data_dir, "summarize_grouped_files", hash_config(
+        stage           = "summarize_grouped_files",
+        llm             = llm_fingerprint(llm),
+        prompts         = [prompt_fingerprint(summarize_prompt), prompt_fingerprint(summary_of_summaries_prompt)],
+        max_chunk_len   = max_chunk_len,
+        strategy        = strategy,
+        reduce_fan_in   = reduce_fan_in,
+        # The summaries keep their case since 'clean_summary' stopped lowercasing them.
+        summary_case    = "kept",
+        output          = (output_dir, output_file_prefix, document_format),
+    ))
+    pending = dict(manifest.pending(json_files, force=force, verbose=verbose))
+
+    # Summarize each JSON file, each worker loads its own file.
+    def process_file(json_file: str) -> str:
+        output_file = summarize_file(llm                   = llm,
+                                     json_file             = json_file,
+                                     output_dir            = output_dir,
+                                     output_file_prefix    = output_file_prefix,
+                                     max_chunk_len         = max_chunk_len,
+                                     strategy              = strategy,
+                                     reduce_fan_in         = reduce_fan_in,
+                                     max_concurrency       = max_concurrency,
+                                     document_format       = document_format,
+                                     verbose               = verbose)
+        manifest.record(json_file, pending[json_file], output_file)
+        return output_file
+
+    return process_files_concurrently(list(pending),
+                                      process_file,
+                                      max_workers   = max_workers,
+                                      desc          = "Summarizing grouped files",
+                                      verbose       = verbose)
+
+
+def summarize_file(
+                    llm:                  Union[ChatOllama, ChatBedrockConverse],
+                    json_file:            str,
+                    output_dir:           str,
+                    output_file_prefix:   str = "summarized-",
+                    max_chunk_len:        int = 6000,
+                    strategy:             str = "sequential",
+                    reduce_fan_in:        int = 8,
+                    max_concurrency:      int = 1,
+                    document_format:      str = "json",
+                    verbose:              bool = False,
+                  ) -> str:
+    """
+    Summarize a single grouped file, and save it in 'output_dir'.
+    See 'summarize_grouped_files' for the arguments. Returns the path of the output file.
+
+    Only the paragraph texts are kept in memory for the summary, the paragraphs are then
+    copied lazily from the input to the output.
+    """
+    if verbose:
+        print("-" * 60)
+        print(f"Summarizing: {json_file}")
+
+    texts = [{"text": para["text"]} for para in iter_items(json_file, "grouped_paragraphs")]
+
+    summary = summarize_document(llm=llm,
+                                 document={"grouped_paragraphs": texts},
+                                 verbose=verbose,
+                                 max_document_len=max_chunk_len,
+                                 strategy=strategy,
+                                 reduce_fan_in=reduce_fan_in,
+                                 max_concurrency=max_concurrency)
+    del texts
+
+    # Save the summarized file
+    file_name   = path.splitext(path.basename(json_file))[0]
+    output_file = with_format(path.join(output_dir, f"{output_file_prefix}{file_name}"), document_format)
+
+    with DocumentWriter(output_file, read_fields(json_file)) as writer:
+        writer.counts["grouped_paragraphs"] = 0
+        writer.write_many("grouped_paragraphs", iter_items(json_file, "grouped_paragraphs"))
+
         # Add metadata to the summarized document
-        grouped_doc["metadata"].update({
+        writer.close(summary=summary, metadata={
             "summarized_timestamp": datetime.now().isoformat(),
-            "summarized_by": "summarize_grouped_files"
-        })
-        grouped_doc["metadata"].update({
-            "file_hash": hashlib.md5(json.dumps(data).encode()).hexdigest(),
+            "summarized_by": "summarize_grouped_files",
+            "summary_strategy": strategy,
         })
+        
+    if verbose:
+        print(f"Saved summarized file: {output_file}")
 
-        # Save the summarized JSON file
-        file_name   = path.splitext(path.basename(json_file))[0]
-        output_file = path.join(output_dir, f"{output_file_prefix}{file_name}.json")
-
-        with open(output_file, "w", encoding="utf-8") as f:
-            json.dump(grouped_doc, f, ensure_ascii=False, indent=4)
-            
-        if verbose:
-            print(f"Saved summarized file: {output_file}")
\ No newline at end of file
+    return output_file
@@ -1,5 +1,6 @@
 import os
 import json
+import hashlib
 
 from os                 import path
 from typing             import List, Union
@@ -9,15 +10,22 @@ from langchain_aws      import ChatBedrockConverse
 # Local imports
 from utils.base_operations.file_search          import get_files_paths_local
 from utils.base_operations.types_identification import extract_entity_types
+from utils.base_operations.document_io          import read_fields
+from utils.base_operations.serialization        import atomic_write, dumps
+from utils.base_operations.manifest             import StageManifest, hash_config, hash_file, llm_fingerprint, prompt_fingerprint
+from utils.prompts.general.types_identification_prompts import (general_ent_type_extraction_prompt,
+                                                                specific_ent_type_extraction_prompt,
+                                                                merge_entities_types_prompt)
 
 
 def extract_entity_types_(
                             llm:                  Union[ChatOllama, ChatBedrockConverse],
                             data_dir:             str,
-                            extensions:           List[str] = ["json"],
+                            extensions:           List[str] = ["json", "jsonl"],
                             base_file_prefix:     str = "summarized-",
                             output_dir:           str = "fourth-data-extraction",
                             output_file_name:     str = "all-entity-types.json",
+                            force:                bool = False,
                             verbose:              bool = False,
                         ) -> None:
 
@@ -31,28 +39,41 @@ def extract_entity_types_(
         - base_file_prefix: str - The prefix of the summarized JSON files.
         - output_dir: str - The directory to save the entity types JSON file.
         - output_file_name: str - The name of the output JSON file.
+        - force: bool - Extract the types even if the summaries and the stage configuration are unchanged since the last run.
         - verbose: bool - Whether to print the progress.
     """
     json_files = get_files_paths_local(data_dir, extensions=extensions)
+    json_files = sorted(f for f in json_files if os.path.basename(f).startswith(base_file_prefix))
     output_dir = path.join(data_dir, output_dir)
+    output_file = path.join(data_dir, output_dir, output_file_name)
+
+    # The types are extracted from the whole corpus, so they are up to date only if no summary changed.
+    manifest = StageManifest.for_stage(data_dir, "extract_entity_types", hash_config(
+        stage   = "extract_entity_types",
+        llm     = llm_fingerprint(llm),
+        prompts = [prompt_fingerprint(prompt) for prompt in [general_ent_type_extraction_prompt,
+                                                             specific_ent_type_extraction_prompt,
+                                                             merge_entities_types_prompt]],
+    ))
+    corpus_hash = hashlib.md5(json.dumps([(f, hash_file(f)) for f in json_files]).encode()).hexdigest()
+
+    if not force and manifest.is_up_to_date(data_dir, corpus_hash):
+        if verbose:
+            print(f"Entity types are up to date: {output_file}")
+        return
 
     all_summaries = []
 
+    # Only the summaries are read, the paragraphs of JSONL documents are skipped without loading them.
     for json_file in json_files:
-        if os.path.basename(json_file).startswith(base_file_prefix):
-            with open(json_file, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                summary = data.get("summary", [])
-                all_summaries.append(summary)
+        summary = read_fields(json_file).get("summary", [])
+        all_summaries.append(summary)
                 
     types = extract_entity_types(llm, all_summaries, verbose=True)
 
-    # Save the entity types to a JSON file.
-    output_file = path.join(data_dir, output_dir, output_file_name)
-    os.makedirs(path.dirname(output_file), exist_ok=True)
-    
-    with open(output_file, "w", encoding="utf-8") as f:
-        json.dump(types, f, ensure_ascii=False, indent=4)
+    # Save the entity types to a JSON file, indented as it is small and meant to be reviewed.
+    atomic_write(output_file, dumps(types, indent=True))
+    manifest.record(data_dir, corpus_hash, output_file)
     
     if verbose:
         print(f"Saved entity types file: {output_file}")
\ No newline at end of file
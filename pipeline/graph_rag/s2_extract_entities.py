@@ -1,32 +1,58 @@
 import os
 import json
-import hashlib
 
 from datetime           import datetime
 from os                 import path
-from typing             import List, Union
+from typing             import Dict, List, Optional, Union
 from langchain_ollama   import ChatOllama
 from langchain_aws      import ChatBedrockConverse
 
 # Local imports
 from utils.base_operations.file_search          import get_files_paths_local
+from utils.base_operations.file_pool            import process_files_concurrently
 from utils.base_operations.entity_extraction    import extract_entities_from_paragraphs
+from utils.base_operations.document_io          import DocumentWriter, iter_batches, iter_items, read_fields, with_format
+from utils.base_operations.checkpoint           import ParagraphCheckpoint
+from utils.base_operations.manifest             import StageManifest, hash_config, hash_file, llm_fingerprint, prompt_fingerprint
+from utils.prompts.graphrag.entity_extraction_prompts import (entity_extraction_prompt,
+                                                              missing_entity_check_prompt,
+                                                              additional_entity_extraction_prompt,
+                                                              batched_entity_extraction_prompt)
 
 
 def extract_entities_(
                         llm:                        Union[ChatOllama, ChatBedrockConverse],
                         data_dir:                   str,
-                        extensions:                 List[str] = ["json"],
+                        extensions:                 List[str] = ["json", "jsonl"],
                         base_file_prefix:           str = "summarized-grouped-",
                         base_typology_file_path:    str = "fourth-data-extraction/all-entity-types.json",
                         output_dir:                 str = "fifth-data-extraction",
                         output_file_prefix:         str = "entities-",
+                        max_concurrency:            int = 1,
+                        paragraphs_per_call:        int = 1,
+                        max_tokens_per_call:        int = 3000,
+                        document_format:            str = "json",
+                        max_workers:                int = 1,
+                        files:                      Optional[List[str]] = None,
+                        force:                      bool = False,
                         verbose:                    bool = False,  
-                    ) -> None:
+                    ) -> Dict[str, Exception]:
 
     """
     Load JSON files that start with "summarized-grouped-", extract entities from their grouped paragraphs,
     and save the output with a new key "entities" in a "fifth-data-extraction" folder.
+
+    Args:
+        - max_concurrency: int - Maximum number of requests sent to the LLM at once.
+        - paragraphs_per_call: int - Maximum number of paragraphs packed in a single request.
+        - max_tokens_per_call: int - Estimated token budget of the paragraphs packed in a single request.
+        - document_format: str - Format of the output files, "json" or "jsonl" (streamed paragraph by paragraph).
+        - max_workers: int - Number of files processed at the same time. A failing file doesn't stop the others.
+        - files: Optional[List[str]] - Process only these files instead of every matching file in data_dir.
+        - force: bool - Reextract the entities even if the files and the stage configuration are unchanged since the last run.
+
+    Returns:
+        - Dict[str, Exception] - The files that failed, with their exception.
     """
 
     # Create the output directory path.
@@ -41,34 +67,59 @@ def extract_entities_(
         merged_entity_types = entity_types.get("merged_types", [])
     
     # Load the JSON files that start with "summarized-grouped-".
-    json_files = get_files_paths_local(data_dir, extensions=extensions, file_prefix=base_file_prefix)
+    json_files = files if files is not None else get_files_paths_local(data_dir, extensions=extensions, file_prefix=base_file_prefix)
 
-    for json_file in json_files:
+    # Skip the files already processed, unchanged, with the same entity types and configuration.
+    manifest = StageManifest.for_stage(data_dir, "extract_entities", hash_config(
+        stage                   = "extract_entities",
+        llm                     = llm_fingerprint(llm),
+        prompts                 = [prompt_fingerprint(prompt) for prompt in [entity_extraction_prompt,
+                                                                             missing_entity_check_prompt,
+                                                                             additional_entity_extraction_prompt,
+                                                                             batched_entity_extraction_prompt]],
+        entity_types            = hash_file(entity_types_file),
+        paragraphs_per_call     = paragraphs_per_call,
+        max_tokens_per_call     = max_tokens_per_call,
+        output                  = (output_dir, output_file_prefix, document_format),
+    ))
+
+    pending = dict(manifest.pending(json_files, force=force, verbose=verbose))
+
+    # Extract the entities of each file, a failing file doesn't stop the others.
+    def process_file(json_file: str) -> str:
+        # Per-paragraph progress, so a failure only loses the paragraphs in flight.
+        checkpoint = ParagraphCheckpoint.for_file(output_dir, "extract_entities", json_file, manifest.config_hash)
 
-        # Load the grouped paragraphs from the JSON file.
-        with open(json_file, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            grouped_paragraphs = data.get("grouped_paragraphs", [])
-    
-        # extract entities from the grouped paragraphs 
-        paragraphs_with_entities = extract_entities_from_paragraphs(
-                                                                    llm                     = llm,
-                                                                    paragraphs              = grouped_paragraphs,
-                                                                    relevant_entity_types   = merged_entity_types,
-                                                                    verbose                 = False
-                                                    )
-        data["grouped_paragraphs"] = paragraphs_with_entities
-
-        # Add metadata to the summarized document
-        data["metadata"].update({
-            "entity_extraction_timestamp": datetime.isoformat(datetime.now()),
-        })
-        data["metadata"].update({
-            "file_hash": hashlib.md5(json.dumps(data).encode()).hexdigest(),
-        })
-                               
-        # Save the entities to a JSON file.
         filename = path.basename(json_file).replace(base_file_prefix, "")
-        output_file = path.join(output_dir, f"{output_file_prefix}{filename}")
-        with open(output_file, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)    
\ No newline at end of file
+        output_file = with_format(path.join(output_dir, f"{output_file_prefix}{filename}"), document_format)
+
+        # Extract entities from the grouped paragraphs, one batch of paragraphs in memory at a time,
+        # and save each batch as soon as it is done.
+        with DocumentWriter(output_file, read_fields(json_file)) as writer:
+            writer.counts["grouped_paragraphs"] = 0
+            for grouped_paragraphs in iter_batches(iter_items(json_file, "grouped_paragraphs")):
+                paragraphs_with_entities = extract_entities_from_paragraphs(
+                                                                            llm                     = llm,
+                                                                            paragraphs              = grouped_paragraphs,
+                                                                            relevant_entity_types   = merged_entity_types,
+                                                                            max_concurrency         = max_concurrency,
+                                                                            paragraphs_per_call     = paragraphs_per_call,
+                                                                            max_tokens_per_call     = max_tokens_per_call,
+                                                                            checkpoint              = checkpoint,
+                                                                            verbose                 = False
+                                                            )
+                writer.write_many("grouped_paragraphs", paragraphs_with_entities)
+
+            # Add metadata to the summarized document
+            writer.close(metadata={
+                "entity_extraction_timestamp": datetime.isoformat(datetime.now()),
+            })
+        manifest.record(json_file, pending[json_file], output_file)
+        checkpoint.remove()
+        return output_file
+
+    return process_files_concurrently(list(pending),
+                                      process_file,
+                                      max_workers   = max_workers,
+                                      desc          = "Extracting entities",
+                                      verbose       = verbose)
@@ -2,30 +2,71 @@ import os
 import json
 import hashlib
 
-from tqdm               import tqdm
 from datetime           import datetime
 from os                 import path
-from typing             import List, Union
+from typing             import Dict, List, Optional, Union
 from langchain_ollama   import ChatOllama
 from langchain_aws      import ChatBedrockConverse
 
 # Local imports
 from utils.base_operations.file_search          import get_files_paths_local
-from utils.base_operations.relate_entities      import extract_relations_from_paragraphs
+from utils.base_operations.file_pool            import process_files_concurrently
+from utils.base_operations.relate_entities      import EntityIndex, extract_relations_from_paragraphs
+from utils.base_operations.entity_resolution    import normalize_entity_name
+from utils.base_operations.document_io          import DocumentWriter, iter_batches, iter_items, read_fields, with_format
+from utils.base_operations.checkpoint           import ParagraphCheckpoint
+from utils.base_operations.manifest             import StageManifest, hash_config, llm_fingerprint, prompt_fingerprint
+from utils.models.graphrag_models               import Entity
+from utils.graph_store                          import GraphStore
+from utils.prompts.graphrag.relationship_extraction_prompts import (relationship_extraction_prompt,
+                                                                    missing_relations_check_prompt,
+                                                                    additional_relations_extraction_prompt,
+                                                                    batched_relationship_extraction_prompt)
 
 def relate_entities_(
-                        llm:                        Union[ChatOllama, ChatBedrockConverse],
-                        data_dir:                   str,
-                        extensions:                 List[str] = ["json"],
-                        base_file_prefix:           str = "entities-",
-                        output_dir:                 str = "sixth-data-extraction",
-                        output_file_prefix:         str = "related-",
-                        verbose:                    bool = False,  
-                    ) -> None:
+                        llm:                         Union[ChatOllama, ChatBedrockConverse],
+                        data_dir:                    str,
+                        extensions:                  List[str] = ["json", "jsonl"],
+                        base_file_prefix:            str = "entities-",
+                        output_dir:                  str = "sixth-data-extraction",
+                        output_file_prefix:          str = "related-",
+                        max_concurrency:             int = 1,
+                        paragraphs_per_call:         int = 1,
+                        max_tokens_per_call:         int = 3000,
+                        fuzzy_cutoff:                float = 0.85,
+                        document_entity_lookup:      bool = False,
+                        resolved_entities_file_path: Optional[str] = None,
+                        document_format:             str = "json",
+                        graph_dir:                   Optional[str] = "graph",
+                        max_workers:                 int = 1,
+                        files:                       Optional[List[str]] = None,
+                        force:                       bool = False,
+                        verbose:                     bool = False,  
+                    ) -> Dict[str, Exception]:
 
     """
     Load JSON files that start with "entities-", based on the previous step, and relate the entities to each other.
     and save the output by adding a new field for each entity called "related_entities" in a "sixth-data-extraction" folder.
+
+    Args:
+        - max_concurrency: int - Maximum number of requests sent to the LLM at once.
+        - paragraphs_per_call: int - Maximum number of paragraphs packed in a single request.
+        - max_tokens_per_call: int - Estimated token budget of the paragraphs packed in a single request.
+        - fuzzy_cutoff: float - Minimum similarity of the closest entity name, when a relation names an entity
+                        that is not found by exact or normalized name. 1 to reject these relations.
+        - document_entity_lookup: bool - Also accept the relations naming an entity found in another paragraph
+                                  of the same document.
+        - resolved_entities_file_path: Optional[str] - Resolved entities index (see 'resolve_entities_'), relative
+                                       to data_dir, to also look up the entity names by alias. None to skip it.
+        - document_format: str - Format of the output files, "json" or "jsonl" (streamed paragraph by paragraph).
+        - graph_dir: Optional[str] - Directory of the corpus graph store, relative to data_dir, where the entities and
+                     relations of every related file are appended (see 'GraphStore'). None to skip it.
+        - max_workers: int - Number of files processed at the same time. A failing file doesn't stop the others.
+        - files: Optional[List[str]] - Process only these files instead of every matching file in data_dir.
+        - force: bool - Relate the entities again even if the files and the stage configuration are unchanged since the last run.
+
+    Returns:
+        - Dict[str, Exception] - The files that failed, with their exception.
     """
 
     # Create the output directory path.
@@ -33,36 +74,134 @@ def relate_entities_(
     os.makedirs(output_dir, exist_ok=True)
     
     # Load the JSON files that start with "summarized-grouped-".
-    json_files = get_files_paths_local(data_dir, extensions=extensions, file_prefix=base_file_prefix)
+    json_files = files if files is not None else get_files_paths_local(data_dir, extensions=extensions, file_prefix=base_file_prefix)
 
-    # Overall progress bar
-    json_files = tqdm(json_files, desc="Relating entities", unit="file")
+    # Canonical entity of every normalized name, to look up the aliases.
+    aliases = None
+    if resolved_entities_file_path and path.exists(path.join(data_dir, resolved_entities_file_path)):
+        with open(path.join(data_dir, resolved_entities_file_path), "r", encoding="utf-8") as f:
+            aliases = json.load(f).get("aliases", {})
 
-    for json_file in json_files:
+    # The names of every canonical entity. Entity ids change when the index is rebuilt, the names do not.
+    alias_groups: Dict[int, List[str]] = {}
+    for key, entity_id in (aliases or {}).items():
+        alias_groups.setdefault(entity_id, []).append(key)
 
-        # Load the grouped paragraphs from the JSON file.
-        with open(json_file, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            grouped_paragraphs = data.get("grouped_paragraphs", [])
-    
+    def aliases_salt(json_file: str) -> str:
+        # A document only depends on the aliases of its own entities, so resolving new documents
+        # does not relate every other document again.
+        keys = {normalize_entity_name(e["name"]) for p in iter_items(json_file, "grouped_paragraphs") for e in p.get("entities") or []}
+        groups = sorted({tuple(sorted(alias_groups[aliases[key]])) for key in keys if key in aliases})
+        return hashlib.md5(json.dumps(groups).encode()).hexdigest()
+
+    # Skip the files already processed, unchanged, with the same configuration.
+    manifest = StageManifest.for_stage(data_dir, "relate_entities", hash_config(
+        stage                   = "relate_entities",
+        llm                     = llm_fingerprint(llm),
+        prompts                 = [prompt_fingerprint(prompt) for prompt in [relationship_extraction_prompt,
+                                                                             missing_relations_check_prompt,
+                                                                             additional_relations_extraction_prompt,
+                                                                             batched_relationship_extraction_prompt]],
+        paragraphs_per_call     = paragraphs_per_call,
+        max_tokens_per_call     = max_tokens_per_call,
+        entity_lookup           = (fuzzy_cutoff, document_entity_lookup, aliases is not None),
+        output                  = (output_dir, output_file_prefix, document_format),
+    ))
+    pending = dict(manifest.pending(json_files, force=force, verbose=verbose, input_salt=aliases_salt if aliases else None))
+
+    # The related files up to date but missing from the graph store (e.g. deleted) are appended again.
+    graph = GraphStore.for_directory(path.join(data_dir, graph_dir)) if graph_dir else None
+    if graph is not None:
+        for json_file in json_files:
+            output_file = manifest.output_path(json_file)
+            if json_file not in pending and output_file and path.normpath(output_file) not in graph.documents:
+                graph.add_document(output_file, iter_items(output_file, "grouped_paragraphs"))
+
+    # Relate the entities of each file, a failing file doesn't stop the others.
+    def process_file(json_file: str) -> str:
+        # Per-paragraph progress, so a failure only loses the paragraphs in flight.
+        checkpoint = ParagraphCheckpoint.for_file(output_dir, "relate_entities", json_file, manifest.config_hash + pending[json_file])
 
-        # Add the relationships information to the grouped paragraphs.
-        related_grouped_paragraphs = extract_relations_from_paragraphs(llm = llm,
-                                                                    paragraphs = grouped_paragraphs,
-                                                                    verbose = verbose)
-        data["grouped_paragraphs"] = related_grouped_paragraphs
-
-        # Add metadata to the summarized document
-        data["metadata"].update({
-            "relationships_extraction_timestamp": datetime.isoformat(datetime.now()),
-        })
-        data["metadata"].update({
-            "file_hash": hashlib.md5(json.dumps(data).encode()).hexdigest(),
-        })
-        
-                               
-        # Save the entities to a JSON file.
         filename = path.basename(json_file).replace(base_file_prefix, "")
-        output_file = path.join(output_dir, f"{output_file_prefix}{filename}")
-        with open(output_file, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)    
+        output_file = with_format(path.join(output_dir, f"{output_file_prefix}{filename}"), document_format)
+
+        # Entities of the whole document, a first pass over the paragraphs only keeps their entities.
+        document_entities = None
+        if document_entity_lookup:
+            document_entities = EntityIndex([Entity(**e) for p in iter_items(json_file, "grouped_paragraphs") for e in p["entities"]],
+                                            aliases=aliases, fuzzy_cutoff=fuzzy_cutoff)
+
+        # Add the relationships information to the grouped paragraphs, one batch of paragraphs
+        # in memory at a time, and save each batch as soon as it is done.
+        with DocumentWriter(output_file, read_fields(json_file)) as writer:
+            writer.counts["grouped_paragraphs"] = 0
+            for grouped_paragraphs in iter_batches(iter_items(json_file, "grouped_paragraphs")):
+                related_grouped_paragraphs = extract_relations_from_paragraphs(llm = llm,
+                                                                            paragraphs = grouped_paragraphs,
+                                                                            max_concurrency = max_concurrency,
+                                                                            paragraphs_per_call = paragraphs_per_call,
+                                                                            max_tokens_per_call = max_tokens_per_call,
+                                                                            aliases = aliases,
+                                                                            document_entities = document_entities,
+                                                                            fuzzy_cutoff = fuzzy_cutoff,
+                                                                            checkpoint = checkpoint,
+                                                                            verbose = verbose)
+                writer.write_many("grouped_paragraphs", related_grouped_paragraphs)
+
+            # Add metadata to the related document
+            writer.close(metadata={
+                "relationships_extraction_timestamp": datetime.isoformat(datetime.now()),
+            })
+        if graph is not None:
+            graph.add_document(output_file, iter_items(output_file, "grouped_paragraphs"))
+        manifest.record(json_file, pending[json_file], output_file)
+        checkpoint.remove()
+        return output_file
+
+    return process_files_concurrently(list(pending),
+                                      process_file,
+                                      max_workers   = max_workers,
+                                      desc          = "Relating entities",
+                                      verbose       = verbose)
+
+
+def prune_graph_(
+                    data_dir:           str,
+                    extensions:         List[str] = ["json", "jsonl"],
+                    base_file_prefix:   str = "entities-",
+                    graph_dir:          str = "graph",
+                    verbose:            bool = False,
+                ) -> None:
+    """
+    Remove from the graph store the related documents whose related file, or whose entities file, was deleted,
+    so their relations leave the graph and the communities. Runs on the whole corpus, after 'relate_entities_',
+    since only the list of every current file tells which documents are gone.
+
+    Args:
+        - data_dir: str - The data directory.
+        - extensions: List[str] - The file extensions to consider.
+        - base_file_prefix: str - The prefix of the entities JSON files.
+        - graph_dir: str - Directory of the graph store, relative to data_dir.
+        - verbose: bool - Whether to print the progress.
+    """
+    graph_dir = path.join(data_dir, graph_dir)
+    if not path.exists(path.join(graph_dir, "documents.json")):
+        return
+
+    # The related file of every current entities file, as recorded by 'relate_entities_'.
+    manifest = StageManifest.for_stage(data_dir, "relate_entities", "")
+    current = set()
+    for json_file in get_files_paths_local(data_dir, extensions=extensions, file_prefix=base_file_prefix):
+        output_file = manifest.output_path(json_file)
+        if output_file:
+            current.add(path.normpath(output_file))
+
+    graph = GraphStore.for_directory(graph_dir)
+    deleted = [document for document in graph.documents if document not in current]
+    for document in deleted:
+        graph.remove_document(document)
+
+    if deleted:
+        graph.build()
+    if verbose:
+        print(f"Removed {len(deleted)} deleted files from the graph")
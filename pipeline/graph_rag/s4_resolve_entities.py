@@ -0,0 +1,87 @@
+import json
+import hashlib
+
+from os                 import path
+from datetime           import datetime
+from typing             import List, Optional
+from langchain_core.embeddings import Embeddings
+
+# Local imports
+from utils.base_operations.file_search          import get_files_paths_local
+from utils.base_operations.entity_resolution    import SINGULAR_NOUNS, resolve_entities
+from utils.base_operations.document_io          import iter_items
+from utils.base_operations.manifest             import StageManifest, hash_config, hash_file, llm_fingerprint
+from utils.base_operations.serialization        import atomic_write, dumps
+
+
+def resolve_entities_(
+                        data_dir:               str,
+                        embeddings:             Optional[Embeddings] = None,
+                        extensions:             List[str] = ["json", "jsonl"],
+                        base_file_prefix:       str = "entities-",
+                        output_dir:             str = "seventh-data-extraction",
+                        output_file_name:       str = "resolved-entities.json",
+                        name_threshold:         float = 0.7,
+                        embedding_threshold:    float = 0.9,
+                        force:                  bool = False,
+                        verbose:                bool = False,
+                    ) -> None:
+    """
+    Load JSON files that start with "entities-", and resolve the entities extracted from every document into
+    canonical entities ("tomato", "Tomatoes" and "The tomatoes" share a normalized name, "septoria leaf spot" and
+    "septoria leafspot" are close enough in spelling), saved in a "resolved-entities.json" index with their
+    aliases and provenance (chunk ids and documents). See 'resolve_entities'.
+
+    Args:
+        - data_dir: str - The directory containing the entities JSON files.
+        - embeddings: Optional[Embeddings] - Embeddings model of the names, to also merge the names that are
+                      similar in meaning and not only in spelling. None to only compare the spelling.
+        - extensions: List[str] - The file extensions to consider.
+        - base_file_prefix: str - The prefix of the entities JSON files.
+        - output_dir: str - The directory to save the resolved entities index.
+        - output_file_name: str - The name of the resolved entities index.
+        - name_threshold: float - Character n-gram Jaccard similarity from which two names are merged.
+        - embedding_threshold: float - Embedding cosine similarity from which two names are merged.
+        - force: bool - Resolve the entities again even if the files and the settings are unchanged since the last run.
+        - verbose: bool - Whether to print the progress.
+    """
+    json_files = get_files_paths_local(data_dir, extensions=extensions, file_prefix=base_file_prefix)
+    json_files = sorted(path.normpath(f) for f in json_files)
+    output_file = path.join(data_dir, output_dir, output_file_name)
+
+    # The index depends on the whole corpus, so it is up to date only if no entities file changed.
+    manifest = StageManifest.for_stage(data_dir, "resolve_entities", hash_config(
+        stage                   = "resolve_entities",
+        embeddings              = llm_fingerprint(embeddings) if embeddings is not None else None,
+        name_threshold          = name_threshold,
+        embedding_threshold     = embedding_threshold,
+        # The normalized names, and so the aliases, change with the nouns left singular.
+        singular_nouns          = sorted(SINGULAR_NOUNS),
+    ))
+    corpus_hash = hashlib.md5(json.dumps([(f, hash_file(f)) for f in json_files]).encode()).hexdigest()
+
+    if not force and manifest.is_up_to_date(data_dir, corpus_hash):
+        if verbose:
+            print(f"Resolved entities are up to date: {output_file}")
+        return
+
+    # The paragraphs are streamed, only the distinct names and their provenance are kept in memory.
+    resolved = resolve_entities({json_file: iter_items(json_file, "grouped_paragraphs") for json_file in json_files},
+                                embeddings          = embeddings,
+                                name_threshold      = name_threshold,
+                                embedding_threshold = embedding_threshold)
+    resolved["metadata"] = {
+        "documents":            len(json_files),
+        "entities":             len(resolved["entities"]),
+        "mentions":             sum(entity["mentions"] for entity in resolved["entities"]),
+        "candidate_pairs":      resolved.pop("candidate_pairs"),
+        "merged_pairs":         resolved.pop("merged_pairs"),
+        "timestamp":            datetime.now().isoformat(),
+    }
+
+    atomic_write(output_file, dumps(resolved))
+    manifest.record(data_dir, corpus_hash, output_file)
+
+    if verbose:
+        print(f"Saved resolved entities: {output_file} ({resolved['metadata']['mentions']} mentions, "
+              f"{len(resolved['aliases'])} names, {len(resolved['entities'])} entities)")
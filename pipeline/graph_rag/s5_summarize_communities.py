@@ -0,0 +1,124 @@
+import json
+
+from os                 import path
+from datetime           import datetime
+from typing             import Optional, Union
+from langchain_ollama   import ChatOllama
+from langchain_aws      import ChatBedrockConverse
+
+# Local imports
+from utils.graph_store                          import GraphStore
+from utils.base_operations.checkpoint           import ParagraphCheckpoint
+from utils.base_operations.communities          import attach_relations, community_graph, detect_communities, summarize_communities
+from utils.base_operations.manifest             import StageManifest, hash_config, hash_file, llm_fingerprint, prompt_fingerprint
+from utils.base_operations.serialization        import atomic_write, dumps
+from utils.prompts.graphrag.community_summary_prompts import (community_summary_prompt,
+                                                              community_of_communities_summary_prompt)
+
+
+def summarize_communities_(
+                            llm:                    Union[ChatOllama, ChatBedrockConverse],
+                            data_dir:               str,
+                            graph_dir:              str = "graph",
+                            output_dir:             str = "eighth-data-extraction",
+                            output_file_name:       str = "communities.json",
+                            resolution:             float = 1.0,
+                            min_community_size:     int = 2,
+                            max_levels:             Optional[int] = None,
+                            max_relations:          int = 200,
+                            max_input_tokens:       int = 3000,
+                            max_concurrency:        int = 1,
+                            force:                  bool = False,
+                            verbose:                bool = False,
+                        ) -> None:
+    """
+    Detect the hierarchical communities of the corpus graph (see 'relate_entities_') and summarize each one of
+    them with the LLM, for GraphRAG global search: a global question is answered by a map-reduce over the
+    community summaries of a level instead of every document. The communities are saved in a "communities.json"
+    file, with their level, parent and children links, entities, title and summary.
+
+    Only the communities whose entities or relations changed since the last run are summarized again, and the
+    reports of an interrupted run are reused from its checkpoint.
+
+    Args:
+        - llm: Union[ChatOllama, ChatBedrockConverse] - The LLM used to summarize the communities.
+        - data_dir: str - The data directory, containing the graph store.
+        - graph_dir: str - Directory of the graph store, relative to data_dir.
+        - output_dir: str - The directory to save the communities.
+        - output_file_name: str - The name of the communities file.
+        - resolution: float - Louvain resolution, higher values give smaller communities.
+        - min_community_size: int - Communities with fewer entities are not summarized.
+        - max_levels: Optional[int] - Keep only the finest 'max_levels' levels of communities.
+        - max_relations: int - Maximum number of relations sent to the LLM to summarize a community.
+        - max_input_tokens: int - Estimated token budget of the entities, relations or sub-community summaries of a prompt.
+        - max_concurrency: int - Maximum number of requests sent to the LLM at once.
+        - force: bool - Summarize every community again, even if the graph and the configuration are unchanged.
+        - verbose: bool - Whether to print the progress.
+    """
+    graph_dir = path.join(data_dir, graph_dir)
+    output_file = path.join(data_dir, output_dir, output_file_name)
+    documents_file = path.join(graph_dir, "documents.json")
+    if not path.exists(documents_file):
+        if verbose:
+            print(f"No graph to summarize in {graph_dir}")
+        return
+
+    # The communities depend on the whole graph, which changes whenever a document is appended to it.
+    config_hash = hash_config(
+        stage                   = "summarize_communities",
+        llm                     = llm_fingerprint(llm),
+        prompts                 = [prompt_fingerprint(prompt) for prompt in [community_summary_prompt,
+                                                                             community_of_communities_summary_prompt]],
+        resolution              = resolution,
+        min_community_size      = min_community_size,
+        max_levels              = max_levels,
+        max_relations           = max_relations,
+        max_input_tokens        = max_input_tokens,
+    )
+    manifest = StageManifest.for_stage(data_dir, "summarize_communities", config_hash)
+    graph_hash = hash_file(documents_file)
+
+    if not force and manifest.is_up_to_date(data_dir, graph_hash):
+        if verbose:
+            print(f"Communities are up to date: {output_file}")
+        return
+
+    # Reports of the last run with the same configuration, by community signature.
+    previous = {}
+    if not force and path.exists(output_file):
+        with open(output_file, "r", encoding="utf-8") as f:
+            last_run = json.load(f)
+        if last_run.get("metadata", {}).get("config_hash") == config_hash:
+            previous = {c["signature"]: {"title": c["title"], "summary": c["summary"]} for c in last_run["communities"]}
+
+    store = GraphStore.for_directory(graph_dir)
+    communities = detect_communities(community_graph(store),
+                                     resolution         = resolution,
+                                     min_community_size = min_community_size,
+                                     max_levels         = max_levels)
+    attach_relations(store, communities, max_relations=max_relations)
+    checkpoint = ParagraphCheckpoint.for_file(path.join(data_dir, output_dir), "summarize_communities", output_file, config_hash)
+    stats = summarize_communities(llm, store, communities,
+                                  previous          = previous,
+                                  checkpoint        = checkpoint,
+                                  max_concurrency   = max_concurrency,
+                                  max_input_tokens  = max_input_tokens,
+                                  verbose           = verbose)
+
+    atomic_write(output_file, dumps({
+        "communities": communities,
+        "metadata": {
+            "levels":               len({c["level"] for c in communities}),
+            "communities":          len(communities),
+            "summarized":           stats["summarized"],
+            "reused":               stats["reused"],
+            "config_hash":          config_hash,
+            "timestamp":            datetime.now().isoformat(),
+        },
+    }))
+    manifest.record(data_dir, graph_hash, output_file)
+    checkpoint.remove()
+
+    if verbose:
+        print(f"Saved communities: {output_file} ({len(communities)} communities, "
+              f"{stats['summarized']} summarized, {stats['reused']} reused)")
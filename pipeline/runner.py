@@ -0,0 +1,461 @@
+import os
+import time
+
+from os         import path
+from typing     import Any, Callable, Dict, List, Optional, Tuple
+
+# Local imports
+from utils.init                                             import (get_llm, get_configs, get_embeddings, get_max_concurrency,
+                                                                    get_ocr_cache, get_pipeline_setting, get_usecase_setting,
+                                                                    get_vector_index)
+from utils.base_operations.file_search                      import get_files_paths_local
+from utils.base_operations.file_pool                        import process_files_concurrently
+from utils.base_operations.manifest                         import StageManifest
+from pipeline.general.s1_read_and_extract_text              import process_pdf_files
+from pipeline.general.s1b_mark_boilerplate                  import mark_boilerplate
+from pipeline.general.s2_semantically_group_paragraphs      import process_semantic_grouping
+from pipeline.general.s3_summarize_grouped_files            import summarize_grouped_files
+from pipeline.graph_rag.s1_entity_type_identification       import extract_entity_types_
+from pipeline.graph_rag.s2_extract_entities                 import extract_entities_
+from pipeline.graph_rag.s3_relate_entities                  import prune_graph_, relate_entities_
+from pipeline.graph_rag.s4_resolve_entities                 import resolve_entities_
+from pipeline.graph_rag.s5_summarize_communities          import summarize_communities_
+from pipeline.contextual_retrieval.s1_contextually_place_chunks import contextualize_chunks
+from pipeline.contextual_retrieval.s2_index_chunks           import index_chunks_, prune_chunk_index_
+
+
+class Stage:
+    """
+        A node of the ingestion DAG.
+
+        A stage reads the outputs of the stage named in 'input_from' (or the raw files for the first stage),
+        and can only start once the stages in 'after' are complete. Per-document stages process each input
+        independently, so documents can flow through them one by one; corpus stages need all their inputs.
+
+        The stage name is also the name of its manifest, which records the output of every processed input.
+    """
+
+    def __init__(
+                    self,
+                    name:           str,
+                    run:            Callable[[Optional[List[str]], bool], Any],
+                    list_inputs:    Callable[[], List[str]],
+                    input_from:     Optional[str] = None,
+                    after:          Tuple[str, ...] = (),
+                    per_document:   bool = True,
+                ):
+        """
+        Args:
+            - name: str - Name of the stage and of its manifest.
+            - run: Callable[[Optional[List[str]], bool], Any] - Runs the stage on the given input files
+                   (all the inputs when None), called as run(files, force).
+            - list_inputs: Callable[[], List[str]] - Lists all the current inputs of the stage.
+            - input_from: Optional[str] - Stage producing the inputs of this stage.
+            - after: Tuple[str, ...] - Other stages that must be complete before this one starts.
+            - per_document: bool - Whether the inputs are processed independently of each other.
+        """
+        self.name           = name
+        self.run            = run
+        self.list_inputs    = list_inputs
+        self.input_from     = input_from
+        self.after          = tuple(after)
+        self.per_document   = per_document
+
+    @property
+    def dependencies(self) -> Tuple[str, ...]:
+        return ((self.input_from,) if self.input_from else ()) + self.after
+
+
+def build_stages(data_dir: str) -> Dict[str, Stage]:
+    """
+    The ingestion DAG, with the stage settings read from the configs.
+    The LLMs are only created when a stage runs.
+
+    Args:
+        - data_dir: str - The directory containing the PDF files, and where every stage writes its outputs.
+
+    Returns:
+        - Dict[str, Stage] - The stages by name, in a valid execution order.
+    """
+    def document_format() -> str:
+        return get_pipeline_setting("document_format", "json")
+
+    def list_json(prefix: str) -> Callable[[], List[str]]:
+        return lambda: get_files_paths_local(data_dir, extensions=["json", "jsonl"], file_prefix=prefix)
+
+    def read_pdfs(files: Optional[List[str]], force: bool) -> Dict[str, Exception]:
+        return process_pdf_files(
+            data_dir                = data_dir,
+            document_format         = document_format(),
+            max_workers             = get_pipeline_setting("pdf_workers", 1),
+            pages_per_shard         = get_pipeline_setting("pages_per_shard", 25),
+            page_timeout            = get_pipeline_setting("page_timeout", 120),
+            text_layer_fast_path    = get_pipeline_setting("text_layer_fast_path", True),
+            ocr_cache               = get_ocr_cache(),
+            extract_table_images    = get_pipeline_setting("extract_table_images", False),
+            # The type rules of the semantic grouping need the element types, which chunking replaces by "Text".
+            chunk_elements          = not get_usecase_setting("semantic_grouping", "type_rules", True),
+            files                   = files,
+            force                   = force,
+            verbose                 = False,
+        )
+
+    def identify_boilerplate(files: Optional[List[str]], force: bool) -> None:
+        settings = get_pipeline_setting("boilerplate", {})
+        mark_boilerplate(
+            data_dir                = data_dir,
+            min_pages               = settings.get("min_pages", 3),
+            min_documents           = settings.get("min_documents", 2),
+            max_distance            = settings.get("max_distance", 3),
+            force                   = force,
+        )
+
+    def group(files: Optional[List[str]], force: bool) -> Dict[str, Exception]:
+        strategy = get_usecase_setting("semantic_grouping", "strategy", "llm")
+        return process_semantic_grouping(
+            llm                     = get_llm(usecase="semantic_grouping"),
+            data_dir                = data_dir,
+            max_merged_chunk_len    = 4000,
+            strategy                = strategy,
+            embeddings              = get_embeddings() if strategy == "embeddings" else None,
+            context_token_budget    = get_usecase_setting("semantic_grouping", "context_token_budget"),
+            type_rules              = get_usecase_setting("semantic_grouping", "type_rules", True),
+            min_fragment_chars      = get_usecase_setting("semantic_grouping", "min_fragment_chars", 40),
+            document_format         = document_format(),
+            files                   = files,
+            force                   = force,
+        )
+
+    def summarize(files: Optional[List[str]], force: bool) -> Dict[str, Exception]:
+        return summarize_grouped_files(
+            llm                 = get_llm(usecase="summary"),
+            data_dir            = data_dir,
+            strategy            = get_usecase_setting("summary", "strategy", "sequential"),
+            max_concurrency     = get_max_concurrency(usecase="summary"),
+            document_format     = document_format(),
+            files               = files,
+            force               = force,
+        )
+
+    def identify_entity_types(files: Optional[List[str]], force: bool) -> None:
+        extract_entity_types_(llm=get_llm(usecase="extract_entity_types"), data_dir=data_dir, force=force)
+
+    def extract_entities(files: Optional[List[str]], force: bool) -> Dict[str, Exception]:
+        return extract_entities_(
+            llm                 = get_llm(usecase="extract_entities"),
+            data_dir            = data_dir,
+            max_concurrency     = get_max_concurrency(usecase="extract_entities"),
+            paragraphs_per_call = get_usecase_setting("extract_entities", "paragraphs_per_call", 1),
+            document_format     = document_format(),
+            files               = files,
+            force               = force,
+        )
+
+    def relate_entities(files: Optional[List[str]], force: bool) -> Dict[str, Exception]:
+        return relate_entities_(
+            llm                         = get_llm(usecase="relate_entities"),
+            data_dir                    = data_dir,
+            max_concurrency             = get_max_concurrency(usecase="relate_entities"),
+            paragraphs_per_call         = get_usecase_setting("relate_entities", "paragraphs_per_call", 1),
+            fuzzy_cutoff                = get_usecase_setting("relate_entities", "fuzzy_cutoff", 0.85),
+            document_entity_lookup      = get_usecase_setting("relate_entities", "document_entity_lookup", False),
+            resolved_entities_file_path = ("seventh-data-extraction/resolved-entities.json"
+                                           if get_usecase_setting("relate_entities", "use_resolved_aliases", False) else None),
+            document_format             = document_format(),
+            files                       = files,
+            force                       = force,
+        )
+
+    def prune_graph(files: Optional[List[str]], force: bool) -> None:
+        prune_graph_(data_dir=data_dir)
+
+    def resolve_entities(files: Optional[List[str]], force: bool) -> None:
+        settings = get_pipeline_setting("entity_resolution", {})
+        resolve_entities_(
+            data_dir                = data_dir,
+            embeddings              = get_embeddings() if settings.get("use_embeddings", False) else None,
+            name_threshold          = settings.get("name_threshold", 0.7),
+            embedding_threshold     = settings.get("embedding_threshold", 0.9),
+            force                   = force,
+        )
+
+    def summarize_communities(files: Optional[List[str]], force: bool) -> None:
+        settings = get_pipeline_setting("communities", {})
+        summarize_communities_(
+            llm                     = get_llm(usecase="community_summary"),
+            data_dir                = data_dir,
+            resolution              = settings.get("resolution", 1.0),
+            min_community_size      = settings.get("min_community_size", 2),
+            max_levels              = settings.get("max_levels"),
+            max_relations           = settings.get("max_relations", 200),
+            max_input_tokens        = settings.get("max_input_tokens", 3000),
+            max_concurrency         = get_max_concurrency(usecase="community_summary"),
+            force                   = force,
+        )
+
+    def contextualize(files: Optional[List[str]], force: bool) -> Dict[str, Exception]:
+        return contextualize_chunks(
+            llm                 = get_llm(usecase="default"),
+            data_dir            = data_dir,
+            base_file_prefix    = "summarized-grouped-",
+            document_format     = document_format(),
+            files               = files,
+            force               = force,
+        )
+
+    def index_chunks(files: Optional[List[str]], force: bool) -> Dict[str, Exception]:
+        return index_chunks_(
+            embeddings          = get_embeddings(),
+            index               = get_vector_index(data_dir),
+            data_dir            = data_dir,
+            batch_size          = get_configs()["backend"]["embeddings"].get("batch_size", 64),
+            files               = files,
+            force               = force,
+        )
+
+    def prune_chunk_index(files: Optional[List[str]], force: bool) -> None:
+        prune_chunk_index_(
+            index               = get_vector_index(data_dir),
+            data_dir            = data_dir,
+            max_dead_ratio      = get_configs()["backend"].get("vector_db", {}).get("max_dead_ratio", 0.3),
+        )
+
+    stages = [
+        # Parsed at once, so the files share one pool of 'pdf_workers' processes.
+        Stage("process_pdf_files",       read_pdfs,               lambda: get_files_paths_local(data_dir, extensions=["pdf"]),
+              per_document=False),
+        Stage("mark_boilerplate",        identify_boilerplate,    lambda: [data_dir],               input_from="process_pdf_files",
+              per_document=False),
+        Stage("semantic_grouping",       group,                   list_json("processed-"),          input_from="process_pdf_files",
+              after=("mark_boilerplate",)),
+        Stage("summarize_grouped_files", summarize,               list_json("grouped-"),            input_from="semantic_grouping"),
+        Stage("extract_entity_types",    identify_entity_types,   lambda: [data_dir],               input_from="summarize_grouped_files",
+              per_document=False),
+        Stage("extract_entities",        extract_entities,        list_json("summarized-grouped-"), input_from="summarize_grouped_files",
+              after=("extract_entity_types",)),
+        Stage("relate_entities",         relate_entities,         list_json("entities-"),           input_from="extract_entities",
+              after=("resolve_entities",)),
+        Stage("resolve_entities",        resolve_entities,        lambda: [data_dir],               input_from="extract_entities",
+              per_document=False),
+        Stage("prune_graph",             prune_graph,             lambda: [data_dir],               input_from="relate_entities",
+              per_document=False),
+        Stage("summarize_communities",   summarize_communities,   lambda: [data_dir],               input_from="relate_entities",
+              after=("prune_graph",), per_document=False),
+        Stage("contextualize_chunks",    contextualize,           list_json("summarized-grouped-"), input_from="summarize_grouped_files"),
+        Stage("index_chunks",            index_chunks,            list_json("contextualized-chunks-"), input_from="contextualize_chunks"),
+        Stage("prune_chunk_index",       prune_chunk_index,       lambda: [data_dir],               input_from="index_chunks",
+              per_document=False),
+    ]
+    return {stage.name: stage for stage in stages}
+
+
+def resolve_targets(stages: Dict[str, Stage], targets: List[str], with_dependencies: bool = True) -> List[str]:
+    """
+    The stages to run for the targets, in execution order.
+
+    Args:
+        - stages: Dict[str, Stage] - The DAG, see 'build_stages'.
+        - targets: List[str] - The stages to run.
+        - with_dependencies: bool - Also run every stage the targets depend on.
+    """
+    unknown = [t for t in targets if t not in stages]
+    if unknown:
+        raise ValueError(f"Unknown pipeline targets: {unknown}. Allowed values are: {list(stages)}")
+
+    selected = set(targets)
+    pending  = list(targets)
+    while with_dependencies and pending:
+        for dependency in stages[pending.pop()].dependencies:
+            if dependency not in selected:
+                selected.add(dependency)
+                pending.append(dependency)
+
+    # Topological order: a stage comes after all of its selected dependencies.
+    ordered: List[str] = []
+    while len(ordered) < len(selected):
+        ready = [name for name in stages
+                 if name in selected and name not in ordered
+                 and all(d in ordered or d not in selected for d in stages[name].dependencies)]
+        if not ready:
+            raise ValueError(f"The pipeline stages have a dependency cycle: {sorted(selected - set(ordered))}")
+        ordered.extend(ready)
+    return ordered
+
+
+def _raise_failures(result: Any) -> None:
+    # The stages that process files in a pool report their failed files instead of raising.
+    if isinstance(result, dict) and result:
+        raise next(iter(result.values()))
+
+
+def _run_document(
+                    data_dir:   str,
+                    stages:     Dict[str, Stage],
+                    chain:      List[str],
+                    input_path: str,
+                    force:      bool,
+                    ) -> None:
+    """
+    Run a document through a chain of per-document stages, each one fed by the output of its input stage.
+    """
+    outputs = {}
+    for name in chain:
+        stage = stages[name]
+        stage_input = outputs.get(stage.input_from, input_path)
+
+        _raise_failures(stage.run([stage_input], force))
+
+        output = StageManifest.for_stage(data_dir, name, "").output_path(stage_input)
+        if output is None:
+            raise Exception(f"Stage '{name}' produced no output for {stage_input}")
+        outputs[name] = output
+
+
+def run_pipeline(
+                    data_dir:           str,
+                    targets:            Optional[List[str]] = None,
+                    with_dependencies:  bool = True,
+                    pipelined:          bool = True,
+                    max_workers:        int = 1,
+                    force:              bool = False,
+                    stages:             Optional[Dict[str, Stage]] = None,
+                    verbose:            bool = False,
+                ) -> Dict[str, Exception]:
+    """
+    Run the target stages of the ingestion DAG.
+
+    Every stage skips the inputs its manifest already records as processed, unchanged, with the same
+    configuration, so rerunning after a crash resumes from the last completed document of each stage.
+
+    When 'pipelined', consecutive per-document stages run as a wave: each document goes through all
+    of them as soon as it is ready, instead of waiting for the whole corpus at every stage.
+    Corpus stages (entity types identification) are barriers between waves.
+
+    A stage that fails as a whole is not a valid input for the stages depending on it: they are skipped,
+    and reported as failed, instead of running on missing or stale outputs.
+
+    Args:
+        - data_dir: str - The directory containing the PDF files.
+        - targets: Optional[List[str]] - The stages to run, all of them when None.
+        - with_dependencies: bool - Also run the stages the targets depend on.
+        - pipelined: bool - Pipeline documents through per-document stages, instead of running stage by stage.
+        - max_workers: int - Number of documents processed at the same time.
+        - force: bool - Reprocess every input, even if it is up to date.
+        - stages: Optional[Dict[str, Stage]] - The DAG, defaults to 'build_stages(data_dir)'.
+        - verbose: bool - Whether to print the progress.
+
+    Returns:
+        - Dict[str, Exception] - The failures, keyed by stage name for stages run at once or skipped, by "<stage>:<file>"
+                                 for the failed files of a stage run at once, or by "<first stage of the wave>:<document>"
+                                 for pipelined documents.
+    """
+    stages  = stages or build_stages(data_dir)
+    ordered = resolve_targets(stages, targets or list(stages), with_dependencies)
+    done: List[str] = []
+    failures: Dict[str, Exception] = {}
+
+    if verbose:
+        print(f"Running pipeline stages: {ordered}")
+
+    while len(done) < len(ordered):
+        remaining = [name for name in ordered if name not in done]
+
+        # The stages depending on a failed stage are skipped, which fails their own dependents in turn.
+        blocked = next((name for name in remaining if any(d in failures for d in stages[name].dependencies)), None)
+        if blocked is not None:
+            failed_dependencies = [d for d in stages[blocked].dependencies if d in failures]
+            failures[blocked] = Exception(f"Skipped, the stages it depends on failed: {failed_dependencies}")
+            print(f"Stage '{blocked}' skipped: {failed_dependencies} failed")
+            done.append(blocked)
+            continue
+
+        # Per-document stages whose inputs are complete or produced within the wave.
+        wave: List[str] = []
+        for name in remaining:
+            stage = stages[name]
+            if pipelined and stage.per_document and all(d in done + wave or d not in ordered for d in stage.dependencies) \
+                    and all(d in done or d not in ordered for d in stage.after):
+                wave.append(name)
+
+        if not wave:
+            # A corpus stage, or any stage when not pipelined, runs on all of its inputs at once.
+            name  = remaining[0]
+            start = time.monotonic()
+            try:
+                result = stages[name].run(None, force)
+                # The failed files of a stage that processes files in a pool, the other files go on.
+                if isinstance(result, dict):
+                    failures.update({f"{name}:{input_path}": e for input_path, e in result.items()})
+            except Exception as e:
+                failures[name] = e
+                print(f"Stage '{name}' failed: {type(e).__name__}: {e}")
+            done.append(name)
+            if verbose:
+                print(f"Stage '{name}' done in {time.monotonic() - start:.1f}s")
+            continue
+
+        start = time.monotonic()
+        roots = [name for name in wave if stages[name].input_from not in wave]
+        for root in roots:
+            # The stages fed by the root, directly or not; the wave is in execution order, so the input
+            # stage of each one is already in the chain.
+            chain = [root]
+            for name in wave:
+                if name != root and stages[name].input_from in chain:
+                    chain.append(name)
+            wave_failures = process_files_concurrently(
+                stages[root].list_inputs(),
+                lambda input_path: _run_document(data_dir, stages, chain, input_path, force),
+                max_workers = max_workers,
+                desc        = " -> ".join(chain),
+                verbose     = verbose,
+            )
+            failures.update({f"{root}:{input_path}": e for input_path, e in wave_failures.items()})
+        done.extend(wave)
+        if verbose:
+            print(f"Stages {wave} done in {time.monotonic() - start:.1f}s")
+
+    if failures:
+        print(f"Pipeline finished with {len(failures)} failures.")
+    return failures
+
+
+class RunLock:
+    """
+        Exclusive lock of a data directory, so scheduled runs never overlap.
+        A lock left behind by a crashed run (its process is gone) is taken over.
+    """
+
+    def __init__(self, data_dir: str):
+        self.lock_path = path.join(data_dir, ".manifests", "runner.lock")
+
+    def __enter__(self) -> "RunLock":
+        os.makedirs(path.dirname(self.lock_path), exist_ok=True)
+        for _ in range(2):
+            try:
+                fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if self._holder_alive():
+                    raise Exception(f"Another pipeline run holds {self.lock_path}")
+                os.remove(self.lock_path)
+                continue
+            with os.fdopen(fd, "w") as f:
+                f.write(str(os.getpid()))
+            return self
+        raise Exception(f"Could not take the pipeline lock {self.lock_path}")
+
+    def __exit__(self, *exc: Any) -> None:
+        if path.exists(self.lock_path):
+            os.remove(self.lock_path)
+
+    def _holder_alive(self) -> bool:
+        try:
+            with open(self.lock_path, "r") as f:
+                pid = int(f.read().strip())
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except (ValueError, OSError):
+            # Unreadable lock file, or a process we can't signal: assume it's alive.
+            return True
+        return True
@@ -0,0 +1,94 @@
+import os
+import json
+import hashlib
+import threading
+
+from os         import path
+from typing     import Any, Dict, Optional
+
+from utils.base_operations.serialization import truncate_torn_line
+
+
+def paragraph_key(paragraph: Dict[str, Any], *extra: Any) -> str:
+    """
+    Checkpoint key of a paragraph: its "chunk_id" (or the md5 of its text), plus any extra
+    value the result depends on, e.g. the entities the relations are extracted from.
+    """
+    key = paragraph.get("chunk_id") or hashlib.md5(paragraph["text"].encode()).hexdigest()
+    if extra:
+        key += ":" + hashlib.md5(json.dumps(extra, sort_keys=True, default=str).encode()).hexdigest()
+    return key
+
+
+class ParagraphCheckpoint:
+    """
+        Write-ahead, append-only log of per-paragraph results of a long LLM stage.
+
+        Each result is appended (and flushed to disk) as soon as the model answers, so after a crash
+        the stage only reprocesses the paragraphs missing from the log: recovering costs one paragraph,
+        not one document. Results recorded with another stage configuration are ignored.
+        The log is removed once the stage output of the document is saved.
+    """
+
+    def __init__(self, checkpoint_path: str, config_hash: str = ""):
+        """
+        Args:
+            - checkpoint_path: str - Path of the checkpoint JSONL file, created on the first record.
+            - config_hash: str - Hash of the stage configuration, results of other configurations are ignored.
+        """
+        self.checkpoint_path    = checkpoint_path
+        self.config_hash        = config_hash
+        self.results: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+        if path.exists(checkpoint_path):
+            # A torn last line after a crash is cut off, so the next record starts on its own line;
+            # that paragraph will be reprocessed.
+            truncate_torn_line(checkpoint_path)
+            with open(checkpoint_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if entry.get("config_hash") == config_hash:
+                        self.results[entry["key"]] = entry["result"]
+
+    @classmethod
+    def for_file(cls, output_dir: str, stage: str, input_path: str, config_hash: str = "") -> "ParagraphCheckpoint":
+        """
+        The checkpoint of a stage for an input file, stored in "<output_dir>/.checkpoints/<stage>-<file name>.jsonl".
+        """
+        file_name = path.splitext(path.basename(input_path))[0]
+        return cls(path.join(output_dir, ".checkpoints", f"{stage}-{file_name}.jsonl"), config_hash)
+
+    def __len__(self) -> int:
+        return len(self.results)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.results
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self.results.get(key, default)
+
+    def record(self, key: str, result: Any) -> None:
+        """
+        Append the result of a paragraph to the log, durably. Thread-safe.
+        """
+        line = json.dumps({"key": key, "config_hash": self.config_hash, "result": result}, ensure_ascii=False)
+        with self._lock:
+            self.results[key] = result
+            os.makedirs(path.dirname(self.checkpoint_path) or ".", exist_ok=True)
+            with open(self.checkpoint_path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def remove(self) -> None:
+        """
+        Delete the log, once the results are saved in the stage output.
+        """
+        with self._lock:
+            self.results = {}
+            if path.exists(self.checkpoint_path):
+                os.remove(self.checkpoint_path)
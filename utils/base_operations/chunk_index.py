@@ -0,0 +1,45 @@
+import numpy as np
+
+from typing                     import Any, Dict, Iterable, Iterator, List, Tuple
+from langchain_core.embeddings  import Embeddings
+
+from utils.vector_index                     import VectorIndex
+from utils.base_operations.document_io      import iter_batches
+
+
+def chunk_text(paragraph: Dict[str, Any]) -> str:
+    """
+    The text embedded for a chunk: its contextual preamble (see 'contextualize_chunks'), then the chunk.
+    """
+    context = (paragraph.get("context") or "").strip()
+    return f"{context}\n\n{paragraph['text']}" if context else paragraph["text"]
+
+
+def embed_chunks(
+                    embeddings:     Embeddings,
+                    paragraphs:     Iterable[Dict[str, Any]],
+                    batch_size:     int = 64,
+                ) -> Iterator[Tuple[List[Dict[str, Any]], np.ndarray]]:
+    """
+    Embed the chunks batch by batch, one request per batch, for 'VectorIndex.add_document'.
+
+    Args:
+        - embeddings: Embeddings - The embeddings model.
+        - paragraphs: Iterable[Dict[str, Any]] - The contextualized paragraphs, with their "chunk_id", "text" and "context".
+                      The paragraphs can be streamed.
+        - batch_size: int - Number of chunks embedded per request.
+
+    Returns:
+        - Iterator[Tuple[List[Dict[str, Any]], np.ndarray]] - The records of the chunks (chunk id, context and text)
+                                                              and their embeddings.
+    """
+    for batch in iter_batches((p for p in paragraphs if p.get("text", "").strip()), batch_size):
+        records = [{"chunk_id": p.get("chunk_id"), "context": p.get("context", ""), "text": p["text"]} for p in batch]
+        yield records, np.asarray(embeddings.embed_documents([chunk_text(p) for p in batch]), dtype=np.float32)
+
+
+def retrieve_chunks(embeddings: Embeddings, index: VectorIndex, query: str, k: int = 5) -> List[Dict[str, Any]]:
+    """
+    The 'k' chunks of the index closest to the query, best first, with their "score" and "document".
+    """
+    return index.search(np.asarray(embeddings.embed_query(query), dtype=np.float32), k=k)
@@ -0,0 +1,212 @@
+import re
+import json
+import hashlib
+import networkx as nx
+
+from collections        import defaultdict
+from typing             import Any, Dict, List, Optional, Set, Union
+from langchain_ollama   import ChatOllama
+from langchain_aws      import ChatBedrockConverse
+from tqdm               import tqdm
+
+from utils.graph_store                          import GraphStore
+from utils.tokens                               import head_by_tokens
+from utils.base_operations.checkpoint           import ParagraphCheckpoint
+from utils.base_operations.concurrent_invoke    import invoke_concurrently
+from utils.prompts.graphrag.community_summary_prompts import (community_summary_prompt,
+                                                              community_of_communities_summary_prompt)
+
+
+def community_graph(store: GraphStore) -> nx.Graph:
+    """
+    Undirected graph of the live relations of the graph store, weighted by the number of relations
+    between each pair of entities. Self relations are left out.
+    """
+    graph = nx.Graph()
+    for relation in store.iter_relations():
+        source, target = relation["source"], relation["target"]
+        if source == target:
+            continue
+        if graph.has_edge(source, target):
+            graph[source][target]["weight"] += 1
+        else:
+            graph.add_edge(source, target, weight=1)
+    return graph
+
+
+def detect_communities(
+                        graph:                  nx.Graph,
+                        resolution:             float = 1.0,
+                        min_community_size:     int = 2,
+                        max_levels:             Optional[int] = None,
+                        seed:                   int = 42,
+                        ) -> List[Dict[str, Any]]:
+    """
+    Hierarchical communities of the graph, with the Louvain method: every pass of the algorithm merges the
+    communities of the previous one, so the partitions are nested. Level 0 is the coarsest partition.
+
+    Args:
+        - graph: nx.Graph - The weighted entity graph, see 'community_graph'.
+        - resolution: float - Louvain resolution, higher values give smaller communities.
+        - min_community_size: int - Communities with fewer entities are left out.
+        - max_levels: Optional[int] - Keep only the finest 'max_levels' levels.
+        - seed: int - Random seed of the Louvain method, so unchanged graphs give the same communities.
+
+    Returns:
+        - List[Dict[str, Any]] - The communities, with their "id", "level", "parent" and "children" ids,
+                                 and their "entities", coarsest level first.
+    """
+    if graph.number_of_nodes() == 0:
+        return []
+
+    # Finest partition first.
+    partitions = [list(p) for p in nx.community.louvain_partitions(graph, weight="weight", resolution=resolution, seed=seed)]
+    if max_levels:
+        partitions = partitions[:max_levels]
+    partitions.reverse()
+
+    communities: List[Dict[str, Any]] = []
+    parent_of: Dict[str, str] = {}
+    for level, partition in enumerate(partitions):
+        members = sorted((sorted(c) for c in partition if len(c) >= min_community_size), key=lambda c: (-len(c), c[0]))
+        current_of: Dict[str, str] = {}
+        for index, entities in enumerate(members):
+            community_id = f"{level}-{index}"
+            parent = parent_of.get(entities[0])
+            communities.append({"id": community_id, "level": level, "parent": parent, "children": [], "entities": entities})
+            current_of.update({entity: community_id for entity in entities})
+        parent_of = current_of
+
+    by_id = {c["id"]: c for c in communities}
+    for community in communities:
+        if community["parent"] is not None:
+            by_id[community["parent"]]["children"].append(community["id"])
+    return communities
+
+
+def attach_relations(store: GraphStore, communities: List[Dict[str, Any]], max_relations: int = 200) -> None:
+    """
+    Add to every community the number of relations among its entities, and to the communities without
+    children ("leaves") up to 'max_relations' of these relations, the most repeated first, for their summary.
+    Every community gets a "signature": the hash of what its summary is made from.
+    """
+    leaf_of = {entity: c["id"] for c in communities if not c["children"] for entity in c["entities"]}
+    member_of = defaultdict(list)
+    for community in communities:
+        for entity in community["entities"]:
+            member_of[entity].append(community["id"])
+
+    counts: Dict[str, int] = defaultdict(int)
+    details: Dict[str, Dict[tuple, int]] = defaultdict(lambda: defaultdict(int))
+    for relation in store.iter_relations():
+        shared = set(member_of.get(relation["source"], [])) & set(member_of.get(relation["target"], []))
+        for community_id in shared:
+            counts[community_id] += 1
+        leaf = leaf_of.get(relation["source"])
+        if leaf is not None and leaf == leaf_of.get(relation["target"]):
+            details[leaf][(relation["source"], relation["target"], relation["detail"])] += 1
+
+    by_id = {c["id"]: c for c in communities}
+    # Finest level first, the signature of a parent is made from the signatures of its children.
+    for community in sorted(communities, key=lambda c: -c["level"]):
+        community["relation_count"] = counts[community["id"]]
+        if community["children"]:
+            content = [community["entities"], [by_id[child]["signature"] for child in community["children"]]]
+        else:
+            ranked = sorted(details[community["id"]].items(), key=lambda item: (-item[1], item[0]))[:max_relations]
+            community["relations"] = [{"source": s, "target": t, "detail": d} for (s, t, d), _ in ranked]
+            content = [community["entities"], community["relations"]]
+        community["signature"] = hashlib.md5(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+def parse_community_report(response: str) -> Dict[str, str]:
+    """
+    The title and summary of a community report response.
+    """
+    response = re.sub(r'<think>[\s\S]*?</think>', '', response).strip()
+    title   = re.search(r'<title>([\s\S]*?)</title>', response)
+    summary = re.search(r'<summary>([\s\S]*?)</summary>', response)
+    return {
+        "title":    title.group(1).strip() if title else "",
+        "summary":  summary.group(1).strip() if summary else re.sub(r'</?(title|summary)>', '', response).strip(),
+    }
+
+
+def summarize_communities(
+                            llm:                    Union[ChatOllama, ChatBedrockConverse],
+                            store:                  GraphStore,
+                            communities:            List[Dict[str, Any]],
+                            previous:               Optional[Dict[str, Dict[str, str]]] = None,
+                            checkpoint:             Optional[ParagraphCheckpoint] = None,
+                            max_concurrency:        int = 1,
+                            max_input_tokens:       int = 3000,
+                            verbose:                bool = False,
+                            ) -> Dict[str, int]:
+    """
+    Add a "title" and a "summary" to every community, see 'attach_relations' for what they need.
+
+    The leaves are summarized from their entities and relations, and every other community from the summaries
+    of its children, so the levels are summarized from the finest to the coarsest, each level with up to
+    'max_concurrency' requests in flight. A community whose signature is in 'previous' (the reports of
+    the last run) reuses its report, so only the communities touched by new documents are summarized again.
+    A community with a single child of the same entities reuses the report of its child.
+
+    Each report is recorded in the 'checkpoint' (keyed by the community signature) as soon as the LLM answers,
+    so a failed request only loses the reports still in flight: the next run reuses the recorded ones.
+
+    Returns:
+        - Dict[str, int] - The number of "summarized" and "reused" communities.
+    """
+    previous = previous or {}
+    by_id = {c["id"]: c for c in communities}
+    stats = {"summarized": 0, "reused": 0}
+
+    for level in sorted({c["level"] for c in communities}, reverse=True):
+        pending = []
+        for community in (c for c in communities if c["level"] == level):
+            children = [by_id[child] for child in community["children"]]
+            if community["signature"] in previous:
+                community.update(previous[community["signature"]])
+                stats["reused"] += 1
+            elif checkpoint is not None and community["signature"] in checkpoint:
+                community.update(checkpoint.get(community["signature"]))
+                stats["reused"] += 1
+            elif len(children) == 1 and children[0]["entities"] == community["entities"]:
+                community.update(title=children[0]["title"], summary=children[0]["summary"])
+                stats["reused"] += 1
+            else:
+                pending.append(community)
+
+        inputs = []
+        for community in pending:
+            if community["children"]:
+                summaries = "\n\n".join(f"Title: {by_id[child]['title']}\nSummary: {by_id[child]['summary']}"
+                                        for child in community["children"])
+                inputs.append({"summaries": head_by_tokens(summaries, max_input_tokens)})
+            else:
+                entities = []
+                for name in community["entities"]:
+                    entity = store.entity(name) or {}
+                    entities.append(f"- {name} ({entity.get('type')}): {entity.get('context', '')}")
+                relations = [f"- {r['source']} -> {r['target']}: {r['detail']}" for r in community["relations"]]
+                inputs.append({"entities":  head_by_tokens("\n".join(entities), max_input_tokens // 2),
+                               "relations": head_by_tokens("\n".join(relations), max_input_tokens // 2)})
+
+        leaves   = [i for i, c in enumerate(pending) if not c["children"]]
+        parents  = [i for i, c in enumerate(pending) if c["children"]]
+        progress_bar = tqdm(total=len(pending), desc=f"Summarizing communities [level {level}]", disable=not verbose)
+
+        for chain, indexes in [(community_summary_prompt | llm, leaves), (community_of_communities_summary_prompt | llm, parents)]:
+            def on_result(position: int, response: str) -> None:
+                community = pending[indexes[position]]
+                report = parse_community_report(response)
+                community.update(report)
+                if checkpoint is not None:
+                    checkpoint.record(community["signature"], report)
+                progress_bar.update(1)
+
+            invoke_concurrently(chain, [inputs[i] for i in indexes], max_concurrency=max_concurrency, on_result=on_result)
+        progress_bar.close()
+        stats["summarized"] += len(pending)
+
+    return stats
@@ -0,0 +1,76 @@
+import asyncio
+import threading
+
+from typing                     import Any, Callable, Dict, List, Optional
+from langchain_core.runnables   import Runnable
+
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_guard = threading.Lock()
+
+
+def _event_loop() -> asyncio.AbstractEventLoop:
+    """
+    The event loop of the concurrent requests, run forever in a daemon thread and shared by every caller.
+    The async HTTP clients of the LLMs are shared (see 'get_llm'), and their keep-alive connections are bound
+    to the loop that opened them: a loop per call would hand closed-loop connections to the next call.
+    """
+    global _loop
+    with _loop_guard:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="invoke-concurrently", daemon=True).start()
+        return _loop
+
+
+def invoke_concurrently(
+                        chain:              Runnable,
+                        inputs:             List[Dict[str, Any]],
+                        max_concurrency:    int = 1,
+                        on_result:          Optional[Callable[[int, str], None]] = None,
+                        ) -> List[str]:
+    """
+    Invoke a (prompt | llm) chain once per input, keeping at most 'max_concurrency' requests in flight.
+    Requests are fanned out through 'abatch_as_completed', on one event loop shared by every caller (including
+    concurrent threads), so slow calls do not block the fast ones, but the returned list is always in the same
+    order as 'inputs'. 'on_result' is called from the thread of the event loop.
+
+    Args:
+        - chain: Runnable - The prompt | llm chain to invoke.
+        - inputs: List[Dict[str, Any]] - The prompt variables for each call.
+        - max_concurrency: int - Maximum number of requests in flight. 1 keeps the old sequential behaviour.
+        - on_result: Callable[[int, str], None] - Optional callback called with (input index, stripped response)
+                     as soon as each response arrives, e.g. to update progress bars.
+
+    Returns:
+        - List[str] - The stripped response contents, in input order.
+    """
+    results: List[Optional[str]] = [None] * len(inputs)
+
+    def _handle(index: int, message: Any) -> None:
+        content = message.content.strip()
+        results[index] = content
+        if on_result:
+            on_result(index, content)
+
+    if max_concurrency <= 1:
+        for i, variables in enumerate(inputs):
+            _handle(i, chain.invoke(variables))
+        return results
+
+    # The other requests are completed, and their results handled (e.g. checkpointed), before the first
+    # failure is raised, so no task is left running on the shared loop.
+    errors: List[Exception] = []
+
+    async def _run() -> None:
+        async for i, message in chain.abatch_as_completed(inputs, config={"max_concurrency": max_concurrency},
+                                                          return_exceptions=True):
+            if isinstance(message, Exception):
+                errors.append(message)
+            else:
+                _handle(i, message)
+
+    asyncio.run_coroutine_threadsafe(_run(), _event_loop()).result()
+    if errors:
+        raise errors[0]
+    return results
@@ -1,17 +1,20 @@
 import re
 import tqdm
 
-from typing                 import List, Dict, Union
+from typing                 import List, Dict, Optional, Union
 from langchain_ollama       import ChatOllama
 from langchain_aws          import ChatBedrockConverse
 
 from utils.prompts.contextual_retrieval.contextualize_chunks_prompts import contextualize_chunk_prompt
+from utils.base_operations.checkpoint import ParagraphCheckpoint, paragraph_key
 
 
 def contextualize_doc(
                         llm:                    Union[ChatOllama, ChatBedrockConverse],
                         document:               List[Dict[str, str]],
                         strategy:               str = "full_document",
+                        document_context:       Optional[str] = None,
+                        checkpoint:             Optional[ParagraphCheckpoint] = None,
                         verbose:                bool = False,
                      ):
     """
@@ -23,46 +26,43 @@ def contextualize_doc(
          document (List[str]): The document to contextualize.
          based_on (str): The type of context to use for contextualization. Default: "document". 
                         Options: "full_document", "document_summary". 
+         document_context (Optional[str]): The context to place the chunks in, instead of the one the strategy
+                        builds from the document. Used to contextualize a streamed document batch by batch.
+         checkpoint (Optional[ParagraphCheckpoint]): Log of the preambles already written, scoped to the document.
+                        Each preamble is logged as soon as it is written, and logged chunks are not sent again.
 
     """
 
     preambles = []
 
-    if strategy == "full_document":
+    if strategy not in ["full_document", "document_summary"]:
+        raise ValueError("Invalid value for 'based_on'. Options: 'full_document', 'document_summary'.")
 
-        full_document   = " ".join([para["text"] for para in document["grouped_paragraphs"]])
-        paragraphs      = [para["text"] for para in document["grouped_paragraphs"]]
+    if strategy == "full_document":
+        context = " ".join([para["text"] for para in document["grouped_paragraphs"]]) if document_context is None else document_context
+        desc    = "Summarizing document chunks [File level]"
 
-        for p in tqdm.tqdm(paragraphs, desc="Summarizing document chunks [File level]"):
-            response = (contextualize_chunk_prompt | llm).invoke({
-                "document": full_document,
-                "chunk": p,
-            }).content.strip()
+    else:
+        context = document["summary"] if document_context is None else document_context
+        desc    = "Summarizing document chunks [Summary level]"
 
-            response = re.sub(r'<think>[\s\S]*?</think>', '', response).strip().lower()
-            response = re.sub(r'<context>', '', response).strip()
-            response = re.sub(r'</context>', '', response).strip()
-            preambles.append(response)
-        
-        return preambles
+    for para in tqdm.tqdm(document["grouped_paragraphs"], desc=desc):
+        key = paragraph_key(para)
+        if checkpoint is not None and key in checkpoint:
+            preambles.append(checkpoint.get(key))
+            continue
 
-    elif strategy == "document_summary":
-        
-        summary         = document["summary"]
-        paragraphs      = [para["text"] for para in document["grouped_paragraphs"]]
+        response = (contextualize_chunk_prompt | llm).invoke({
+            "document": context,
+            "chunk": para["text"],
+        }).content.strip()
 
-        for p in tqdm.tqdm(paragraphs, desc="Summarizing document chunks [Summary level]"):
-            response = (contextualize_chunk_prompt | llm).invoke({
-                "document": summary,
-                "chunk": p,
-            }).content.strip()
+        response = re.sub(r'<think>[\s\S]*?</think>', '', response).strip().lower()
+        response = re.sub(r'<context>', '', response).strip()
+        response = re.sub(r'</context>', '', response).strip()
+        preambles.append(response)
 
-            response = re.sub(r'<think>[\s\S]*?</think>', '', response).strip().lower()
-            response = re.sub(r'<context>', '', response).strip()
-            response = re.sub(r'</context>', '', response).strip()
-            preambles.append(response)
-        
-        return preambles
+        if checkpoint is not None:
+            checkpoint.record(key, response)
 
-    else:
-        raise ValueError("Invalid value for 'based_on'. Options: 'full_document', 'document_summary'.")
\ No newline at end of file
+    return preambles
@@ -0,0 +1,201 @@
+import re
+import hashlib
+import numpy as np
+
+from collections    import defaultdict
+from typing         import Any, Dict, Hashable, Iterable, List, Optional, Tuple
+
+
+class DisjointSet:
+    """
+        Union-find over hashable items, with path halving and union by size.
+    """
+
+    def __init__(self):
+        self.parent: Dict[Hashable, Hashable] = {}
+        self.size: Dict[Hashable, int] = {}
+
+    def add(self, item: Hashable) -> None:
+        if item not in self.parent:
+            self.parent[item] = item
+            self.size[item] = 1
+
+    def find(self, item: Hashable) -> Hashable:
+        self.add(item)
+        while self.parent[item] != item:
+            self.parent[item] = self.parent[self.parent[item]]
+            item = self.parent[item]
+        return item
+
+    def union(self, a: Hashable, b: Hashable) -> Hashable:
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a == root_b:
+            return root_a
+        if self.size[root_a] < self.size[root_b]:
+            root_a, root_b = root_b, root_a
+        self.parent[root_b] = root_a
+        self.size[root_a] += self.size[root_b]
+        return root_a
+
+    def groups(self) -> List[List[Hashable]]:
+        """
+        The items grouped by set.
+        """
+        groups: Dict[Hashable, List[Hashable]] = defaultdict(list)
+        for item in self.parent:
+            groups[self.find(item)].append(item)
+        return list(groups.values())
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize a paragraph for duplicate detection: lowercase, numbers masked (page numbers, dates,
+    revision numbers vary between copies of the same header) and whitespace collapsed.
+    """
+    text = re.sub(r"\d+", "0", text.lower())
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def exact_fingerprint(text: str) -> str:
+    """
+    md5 of the normalized paragraph, shared by exact duplicates.
+    """
+    return hashlib.md5(normalize_text(text).encode()).hexdigest()
+
+
+def simhash(text: str, shingle_size: int = 2) -> int:
+    """
+    64-bit SimHash of the word shingles of the normalized paragraph. Near-duplicate paragraphs have
+    fingerprints at a small Hamming distance.
+    """
+    words = normalize_text(text).split()
+    shingles = [" ".join(words[i:i + shingle_size]) for i in range(max(1, len(words) - shingle_size + 1))]
+
+    hashes = np.array([int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "little") for s in shingles],
+                      dtype=np.uint64)
+    bits = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1, bitorder="little")
+    votes = (2 * bits.astype(np.int32) - 1).sum(axis=0)
+    return int.from_bytes(np.packbits(votes > 0, bitorder="little").tobytes(), "little")
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def near_duplicate_groups(
+                            simhashes:          Dict[Hashable, Optional[int]],
+                            max_distance:       int = 3,
+                            ) -> List[List[Hashable]]:
+    """
+    Group texts that are near duplicates of each other (transitively), by their SimHash.
+
+    Candidates are found with locality-sensitive hashing: the 64 bits are split in 'max_distance' + 1 bands,
+    and two fingerprints within 'max_distance' bits necessarily share a band (pigeonhole principle), so only
+    texts sharing a band are compared, instead of every pair.
+
+    Args:
+        - simhashes: Dict[Hashable, Optional[int]] - The SimHash of every text, by key. None for the texts
+                     too short for SimHash to be reliable, which stay alone.
+        - max_distance: int - Maximum Hamming distance between the SimHashes of near duplicates.
+
+    Returns:
+        - List[List[Hashable]] - The keys grouped by near duplicates, singletons included.
+    """
+    groups = DisjointSet()
+    for key in simhashes:
+        groups.add(key)
+    fingerprints = {key: fingerprint for key, fingerprint in simhashes.items() if fingerprint is not None}
+
+    band_count = max_distance + 1
+    band_width = 64 // band_count
+    buckets: Dict[Tuple[int, int], List[Hashable]] = defaultdict(list)
+    for key, fingerprint in fingerprints.items():
+        for band in range(band_count):
+            buckets[(band, (fingerprint >> (band * band_width)) & ((1 << band_width) - 1))].append(key)
+
+    for bucket in buckets.values():
+        for i, key in enumerate(bucket):
+            for other in bucket[i + 1:]:
+                if groups.find(key) != groups.find(other) \
+                        and hamming_distance(fingerprints[key], fingerprints[other]) <= max_distance:
+                    groups.union(key, other)
+
+    return groups.groups()
+
+
+def find_boilerplate(
+                        documents:          Dict[str, Iterable[Dict[str, Any]]],
+                        min_pages:          int = 3,
+                        min_documents:      int = 2,
+                        max_distance:       int = 3,
+                        min_words:          int = 5,
+                        ) -> Dict[str, Any]:
+    """
+    Find the boilerplate paragraphs of a corpus: exact or near duplicates repeated on at least 'min_pages'
+    pages of a document (headers, footers, notices) or, for paragraphs of at least 'min_words' words, in at
+    least 'min_documents' documents and on several pages of one of them (running notices and disclaimers
+    shared by a collection). A section shared by documents but found once per document (e.g. in a new version
+    of a manual) is content, it is kept in every document so it stays retrievable from each of them.
+
+    The first occurrence of each boilerplate paragraph (by document path and position) is kept as its
+    canonical copy, the other occurrences are excluded from the LLM stages.
+
+    Args:
+        - documents: Dict[str, Iterable[Dict[str, Any]]] - The paragraphs of every document, by document path.
+        - min_pages: int - Number of pages of a document from which a repeated paragraph is boilerplate.
+        - min_documents: int - Number of documents from which a paragraph repeated on several pages is boilerplate.
+        - max_distance: int - Maximum SimHash Hamming distance between near duplicates.
+        - min_words: int - Shorter paragraphs are only grouped with their exact duplicates.
+
+    Returns:
+        - Dict[str, Any] - "excluded_paragraphs": the excluded paragraph positions of each document, with the
+                           id of their boilerplate cluster; "clusters": every boilerplate cluster, with its
+                           canonical text and its occurrences, as provenance.
+    """
+    # Occurrences (document, position, page) of each exact fingerprint. Only fingerprints and a preview
+    # of each distinct paragraph are kept in memory, the documents can be streamed.
+    occurrences: Dict[str, List[Tuple[str, int, Optional[int]]]] = defaultdict(list)
+    simhashes: Dict[str, Optional[int]] = {}
+    previews: Dict[str, str] = {}
+    for document in sorted(documents):
+        for position, paragraph in enumerate(documents[document]):
+            fingerprint = exact_fingerprint(paragraph["text"])
+            occurrences[fingerprint].append((document, position, paragraph.get("page_number")))
+            if fingerprint not in simhashes:
+                simhashes[fingerprint] = simhash(paragraph["text"]) if len(paragraph["text"].split()) >= min_words else None
+                previews[fingerprint] = paragraph["text"][:300]
+
+    excluded: Dict[str, Dict[str, int]] = defaultdict(dict)
+    clusters: List[Dict[str, Any]] = []
+    for group in near_duplicate_groups(simhashes, max_distance=max_distance):
+        cluster_occurrences = sorted(o for fingerprint in group for o in occurrences[fingerprint])
+
+        pages_by_document: Dict[str, set] = defaultdict(set)
+        for document, position, page_number in cluster_occurrences:
+            # Without page numbers, every occurrence counts as a page.
+            pages_by_document[document].add(page_number if page_number is not None else f"#{position}")
+
+        # Short paragraphs shared by documents are often section titles ("Introduction"), not boilerplate:
+        # they only count when repeated across the pages of a document (page headers and footers).
+        # The excluded paragraphs leave the grouped documents (and the retrieval index), so a paragraph shared
+        # by documents must also repeat within one of them, as running headers, footers and notices do.
+        repeated_pages = max(len(pages) for pages in pages_by_document.values())
+        across_documents = len(pages_by_document) >= min_documents and repeated_pages >= 2 \
+                           and any(simhashes[f] is not None for f in group)
+        across_pages = repeated_pages >= min_pages
+        if not across_documents and not across_pages:
+            continue
+
+        cluster_id = len(clusters)
+        canonical_document, canonical_position, _ = cluster_occurrences[0]
+        for document, position, _ in cluster_occurrences[1:]:
+            excluded[document][str(position)] = cluster_id
+        clusters.append({
+            "id":           cluster_id,
+            "text":         previews[min(group, key=lambda f: occurrences[f][0][:2])],
+            "canonical":    {"document": canonical_document, "paragraph": canonical_position},
+            "documents":    len(pages_by_document),
+            "occurrences":  [{"document": d, "paragraph": p, "page_number": n} for d, p, n in cluster_occurrences],
+        })
+
+    return {"excluded_paragraphs": dict(excluded), "clusters": clusters}
@@ -0,0 +1,268 @@
+import os
+import time
+import hashlib
+
+from os         import path
+from typing     import Any, Dict, Iterable, Iterator, List, Optional
+
+from utils.base_operations.serialization  import atomic_write, dumps, loads
+
+DOCUMENT_FORMATS = ["json", "jsonl"]
+
+# Lists of a document that are stored record by record in the JSONL format.
+STREAMED_LISTS = ["paragraphs", "grouped_paragraphs", "tables"]
+
+JSONL_FORMAT_VERSION = 1
+
+# Paragraphs processed (and held in memory) at once by the stages that stream documents.
+STREAM_BATCH_SIZE = 64
+
+
+class IncompleteDocumentError(Exception):
+    """
+    Raised when reading a JSONL document whose writer hasn't finished it (no trailer record).
+    """
+
+
+def document_format(file_path: str) -> str:
+    """
+    The format of a document file, from its extension.
+    """
+    return "jsonl" if file_path.endswith(".jsonl") else "json"
+
+
+def with_format(file_path: str, file_format: str) -> str:
+    """
+    The path of the document with the extension of 'file_format'.
+    """
+    if file_format not in DOCUMENT_FORMATS:
+        raise ValueError(f"Invalid document format: {file_format}. Allowed values are: {DOCUMENT_FORMATS}")
+    return f"{path.splitext(file_path)[0]}.{file_format}"
+
+
+class DocumentWriter:
+    """
+        Writes a pipeline document, in either format:
+
+            - "json":  The whole document as a single compact JSON object, buffered, encoded once and
+                       written atomically on 'close'.
+            - "jsonl": One record per line, written as they come: a header with the document fields,
+                       one record per item of the streamed lists ("paragraphs", "grouped_paragraphs", "tables"),
+                       and a trailer with the fields only known at the end (e.g. the summary). Readers can
+                       consume the items while the document is being written; the trailer marks it complete.
+
+        Used as a context manager, the trailer is only written if the block succeeds, so a crashed
+        writer never leaves a document that looks complete.
+    """
+
+    def __init__(self, file_path: str, fields: Optional[Dict[str, Any]] = None):
+        """
+        Args:
+            - file_path: str - Path of the output file, its extension sets the format.
+            - fields: Optional[Dict[str, Any]] - Document fields known upfront, e.g. the metadata.
+        """
+        self.file_path  = file_path
+        self.format     = document_format(file_path)
+        self.counts: Dict[str, int] = {}
+        self._fields    = dict(fields or {})
+        self._lists: Dict[str, List[Any]] = {}
+        self._md5       = hashlib.md5()
+        self._file      = None
+
+        os.makedirs(path.dirname(file_path) or ".", exist_ok=True)
+        if self.format == "jsonl":
+            self._file = open(file_path, "wb")
+            self._write_record({"record": "header", "version": JSONL_FORMAT_VERSION, "fields": self._fields})
+
+    def _write_record(self, record: Dict[str, Any]) -> None:
+        line = dumps(record) + b"\n"
+        self._md5.update(line)
+        self._file.write(line)
+
+    def write(self, list_name: str, item: Any) -> None:
+        """
+        Append an item (e.g. a paragraph) to one of the lists of the document.
+        """
+        self.counts[list_name] = self.counts.get(list_name, 0) + 1
+        if self.format == "jsonl":
+            self._write_record({"record": "item", "list": list_name, "item": item})
+            # Flushed per item, so followers see the paragraphs as soon as they are ready.
+            self._file.flush()
+        else:
+            self._lists.setdefault(list_name, []).append(item)
+
+    def write_many(self, list_name: str, items: Iterable[Any]) -> None:
+        for item in items:
+            self.write(list_name, item)
+
+    def close(self, **fields: Any) -> str:
+        """
+        Finish the document with the fields known at the end. A "metadata" field is merged
+        into the metadata given upfront, and gets the "file_hash" of the document: the md5 of
+        the bytes written, up to the metadata.
+
+        Returns:
+            - str - The path of the written file.
+        """
+        metadata = {**self._fields.get("metadata", {}), **fields.pop("metadata", {})}
+
+        if self.format == "jsonl":
+            metadata["file_hash"] = self._md5.hexdigest()
+            self._write_record({"record": "trailer", "counts": self.counts, "fields": {**fields, "metadata": metadata}})
+            self._file.close()
+            return self.file_path
+
+        lists   = {list_name: self._lists.get(list_name, []) for list_name in self.counts}
+        content = {**{k: v for k, v in self._fields.items() if k != "metadata"}, **lists, **fields}
+
+        # The content is encoded once: its bytes are hashed, then written as is, followed by the metadata.
+        encoded = dumps(content)
+        metadata["file_hash"] = hashlib.md5(encoded).hexdigest()
+        separator = b"," if content else b""
+        atomic_write(self.file_path, encoded[:-1] + separator + b'"metadata":' + dumps(metadata) + b"}")
+        return self.file_path
+
+    def abort(self) -> None:
+        if self._file is not None and not self._file.closed:
+            self._file.close()
+
+    def __enter__(self) -> "DocumentWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        # On success the caller closes the document with its final fields.
+        if exc_type is not None:
+            self.abort()
+
+
+def _iter_records(file_path: str, follow: bool = False, poll_interval: float = 0.2,
+                  timeout: Optional[float] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Iterate over the records of a JSONL document, up to the trailer.
+    With 'follow', wait for the records still being written instead of failing on an unfinished document.
+    """
+    waited = 0.0
+    while follow and not path.exists(file_path):
+        if timeout is not None and waited >= timeout:
+            raise IncompleteDocumentError(f"Document not found after {timeout}s: {file_path}")
+        time.sleep(poll_interval)
+        waited += poll_interval
+
+    with open(file_path, "rb") as f:
+        buffer = b""
+        waited = 0.0
+        while True:
+            line = f.readline()
+            if line:
+                buffer += line
+                if not buffer.endswith(b"\n"):
+                    # Partial line, the writer is in the middle of it.
+                    continue
+                record, buffer, waited = loads(buffer), b"", 0.0
+                yield record
+                if record["record"] == "trailer":
+                    return
+            elif not follow:
+                raise IncompleteDocumentError(f"The document has no trailer, its writer didn't finish it: {file_path}")
+            elif timeout is not None and waited >= timeout:
+                raise IncompleteDocumentError(f"No new records after {timeout}s: {file_path}")
+            else:
+                time.sleep(poll_interval)
+                waited += poll_interval
+
+
+def iter_items(
+                file_path:      str,
+                list_name:      str = "grouped_paragraphs",
+                follow:         bool = False,
+                poll_interval:  float = 0.2,
+                timeout:        Optional[float] = None,
+               ) -> Iterator[Any]:
+    """
+    Lazily iterate over the items of a list of a document (e.g. its paragraphs), one at a time.
+    JSONL documents are streamed, so memory is bounded by one item; JSON documents are loaded whole.
+
+    Args:
+        - file_path: str - The document, in either format.
+        - list_name: str - The list to iterate over, e.g. "paragraphs" or "grouped_paragraphs".
+        - follow: bool - JSONL only, consume the document while its writer is still producing it.
+        - poll_interval: float - Seconds between checks for new records while following.
+        - timeout: Optional[float] - Seconds to wait for a new record while following, None waits forever.
+    """
+    if document_format(file_path) == "json":
+        with open(file_path, "rb") as f:
+            yield from loads(f.read()).get(list_name, [])
+        return
+
+    for record in _iter_records(file_path, follow, poll_interval, timeout):
+        if record["record"] == "item" and record["list"] == list_name:
+            yield record["item"]
+
+
+def iter_batches(items: Iterable[Any], batch_size: int = STREAM_BATCH_SIZE) -> Iterator[List[Any]]:
+    """
+    Group a lazy stream of items in lists of at most 'batch_size' items.
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def read_fields(file_path: str, follow: bool = False) -> Dict[str, Any]:
+    """
+    The fields of a document without its streamed lists, e.g. its metadata and summary.
+    JSONL documents are scanned without keeping their items in memory.
+    """
+    if document_format(file_path) == "json":
+        with open(file_path, "rb") as f:
+            document = loads(f.read())
+        return {key: value for key, value in document.items() if key not in STREAMED_LISTS}
+
+    fields: Dict[str, Any] = {}
+    for record in _iter_records(file_path, follow):
+        if record["record"] in ["header", "trailer"]:
+            metadata = {**fields.get("metadata", {}), **record["fields"].get("metadata", {})}
+            fields.update(record["fields"])
+            if metadata:
+                fields["metadata"] = metadata
+    return fields
+
+
+def read_document(file_path: str, follow: bool = False) -> Dict[str, Any]:
+    """
+    Load a whole document in memory, in either format. Prefer 'iter_items' for large documents.
+    """
+    if document_format(file_path) == "json":
+        with open(file_path, "rb") as f:
+            return loads(f.read())
+
+    document: Dict[str, Any] = {}
+    for record in _iter_records(file_path, follow):
+        if record["record"] == "item":
+            document.setdefault(record["list"], []).append(record["item"])
+        else:
+            metadata = {**document.get("metadata", {}), **record["fields"].get("metadata", {})}
+            document.update(record["fields"])
+            if metadata:
+                document["metadata"] = metadata
+            for list_name in record.get("counts", {}):
+                document.setdefault(list_name, [])
+    return document
+
+
+def write_document(file_path: str, document: Dict[str, Any]) -> str:
+    """
+    Write a whole document, in the format of the file extension.
+    """
+    fields = {key: value for key, value in document.items() if key not in STREAMED_LISTS}
+    writer = DocumentWriter(file_path, fields)
+    for list_name in STREAMED_LISTS:
+        if list_name in document:
+            writer.counts.setdefault(list_name, 0)
+            writer.write_many(list_name, document[list_name])
+    return writer.close()
@@ -1,11 +1,23 @@
 import re
 import tqdm
 
-from typing                 import List, Dict, Union
+from typing                 import List, Dict, Optional, Union
 from langchain_ollama       import ChatOllama
 from langchain_aws          import ChatBedrockConverse
 
-from utils.prompts.general.summary_prompts import summarize_prompt, summary_of_summaries_prompt
+from utils.prompts.general.summary_prompts      import summarize_prompt, summary_of_summaries_prompt
+from utils.base_operations.concurrent_invoke    import invoke_concurrently
+from utils.tokens                               import pack_by_token_budget, CHARS_PER_TOKEN
+
+
+def clean_summary(response: str) -> str:
+    """
+    Remove the think section and the summary tags from a summary response, the text itself is kept as is.
+    """
+    response = re.sub(r'<think>[\s\S]*?</think>', '', response).strip()
+    response = re.sub(r'<summary>', '', response).strip()
+    response = re.sub(r'</summary>', '', response).strip()
+    return response
 
 
 def summarize_document(
@@ -13,6 +25,10 @@ def summarize_document(
                         document:               List[str],
                         max_document_len:       int = 5000,
                         verbose:                bool = False,
+                        strategy:               str = "sequential",
+                        max_split_tokens:       Optional[int] = None,
+                        reduce_fan_in:          int = 8,
+                        max_concurrency:        int = 1,
                        ):
     """
        Summerizes the document using an LLM, with a maximum document length of 4000 characters.
@@ -24,7 +40,20 @@ def summarize_document(
          document (List[str]): List of paragraphs from the document.
          max_document_length (int): Maximum length of the context window for the LLM.
          model_name (str): Name of the LLM model to use.
+         strategy (str): "sequential" (described above) or "map_reduce" (see 'map_reduce_summarize').
+         max_split_tokens (int): "map_reduce" strategy, token budget of each split. Defaults to 'max_document_len' in tokens.
+         reduce_fan_in (int): "map_reduce" strategy, maximum number of summaries merged by each reduce call.
+         max_concurrency (int): "map_reduce" strategy, maximum number of requests in flight at once.
     """
+    if strategy == "map_reduce":
+        return map_reduce_summarize(llm,
+                                    document,
+                                    max_split_tokens    = max_split_tokens or max_document_len // CHARS_PER_TOKEN,
+                                    reduce_fan_in       = reduce_fan_in,
+                                    max_concurrency     = max_concurrency,
+                                    verbose             = verbose)
+    elif strategy != "sequential":
+        raise ValueError("Invalid value for 'strategy'. Options: 'sequential', 'map_reduce'.")
 
     document = document.get("grouped_paragraphs", [])
     document = [para["text"] for para in document]
@@ -47,14 +76,76 @@ def summarize_document(
         response = (summarize_prompt | llm).invoke({
             "document": doc
         }).content.strip()
-        response = re.sub(r'<think>[\s\S]*?</think>', '', response).strip().lower()
-        response = re.sub(r'<summary>', '', response).strip()
-        response = re.sub(r'</summary>', '', response).strip()
-        summaries.append(response)
+        summaries.append(clean_summary(response))
     
     # Finally, we will merge the summaries of all chunks into a single summary
     response = (summary_of_summaries_prompt | llm).invoke({
         "summaries": "\n".join(summaries)
     }).content.strip()
          
-    return response
\ No newline at end of file
+    return clean_summary(response)
+
+
+def map_reduce_summarize(
+                            llm:                Union[ChatOllama, ChatBedrockConverse],
+                            document:           Dict,
+                            max_split_tokens:   int = 1250,
+                            reduce_fan_in:      int = 8,
+                            max_concurrency:    int = 1,
+                            verbose:            bool = False,
+                        ) -> str:
+    """
+       Summarizes the document with a map-reduce over a tree of bounded fan-in.
+
+       The paragraphs are packed into splits of at most 'max_split_tokens' estimated tokens, and all splits
+       are summarized concurrently (map). Then the summaries are merged 'reduce_fan_in' at a time (and within
+       the same token budget) with the summary of summaries prompt, level after level, until a single summary
+       remains (reduce). No call ever sees more than one split worth of text, and the wall-clock time is
+       roughly the depth of the tree times the model latency. A document with a single split is summarized
+       by one call, its map summary is the document summary.
+
+       Args:
+         llm (Union[ChatOllama, ChatBedrockConverse]): The LLM model to use for summarization.
+         document (Dict): The grouped document, with its "grouped_paragraphs".
+         max_split_tokens (int): Token budget of each split and of each reduce call.
+         reduce_fan_in (int): Maximum number of summaries merged by each reduce call.
+         max_concurrency (int): Maximum number of requests in flight at once.
+         verbose (bool): Whether to print the progress.
+    """
+    paragraphs = [para["text"] for para in document.get("grouped_paragraphs", [])]
+    if not paragraphs:
+        return ""
+
+    reduce_fan_in   = max(2, reduce_fan_in)
+    splits          = [" ".join(paragraphs[i] for i in split) for split in pack_by_token_budget(paragraphs, max_split_tokens)]
+
+    if verbose:
+        print(f"Number of document splits for summarization task: {len(splits)}")
+
+    # Map: summarize every split concurrently.
+    summaries = invoke_concurrently(summarize_prompt | llm,
+                                    [{"document": split} for split in splits],
+                                    max_concurrency = max_concurrency)
+    summaries = [clean_summary(summary) for summary in summaries]
+
+    # Reduce: merge the summaries level by level until one remains.
+    level = 0
+    while len(summaries) > 1:
+        groups = pack_by_token_budget(summaries, max_split_tokens, reduce_fan_in)
+        if len(groups) == len(summaries):
+            # Every summary is over the budget on its own, merge by fan-in only to keep making progress.
+            groups = [list(range(i, min(i + reduce_fan_in, len(summaries)))) for i in range(0, len(summaries), reduce_fan_in)]
+
+        level += 1
+        if verbose:
+            print(f"Reduce level {level}: merging {len(summaries)} summaries into {len(groups)}")
+
+        # A group with a single summary goes up to the next level as it is.
+        to_merge = [group for group in groups if len(group) > 1]
+        merged   = invoke_concurrently(summary_of_summaries_prompt | llm,
+                                       [{"summaries": "\n".join(summaries[i] for i in group)} for group in to_merge],
+                                       max_concurrency = max_concurrency)
+        merged    = iter(clean_summary(summary) for summary in merged)
+        summaries = [next(merged) if len(group) > 1 else summaries[group[0]] for group in groups]
+
+    return summaries[0]
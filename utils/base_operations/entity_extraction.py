@@ -8,7 +8,10 @@ from langchain_aws      import ChatBedrockConverse
 from tqdm               import tqdm
 
 from utils.models.graphrag_models import Entity
-from utils.prompts.graphrag.entity_extraction_prompts import entity_extraction_prompt
+from utils.prompts.graphrag.entity_extraction_prompts import entity_extraction_prompt, batched_entity_extraction_prompt
+from utils.base_operations.concurrent_invoke import invoke_concurrently
+from utils.base_operations.checkpoint import ParagraphCheckpoint, paragraph_key
+from utils.tokens import pack_by_token_budget
     
 
 def clean_response(response: str, verbose: bool = False) -> str:
@@ -56,11 +59,45 @@ def extract_entities_from_response(response: str, verbose: bool = False) -> List
     
     return entities
 
+def format_paragraphs_batch(texts: List[str]) -> str:
+    """
+    Render paragraphs with 1-based ids, for the packed prompts.
+    """
+    return "\n".join(f'<paragraph id="{i}">\n{text}\n</paragraph>' for i, text in enumerate(texts, start=1))
+
+def extract_batched_entities_from_response(response: str, batch_size: int, verbose: bool = False) -> Dict[int, List[Entity]]:
+    """
+    Extract the entities of each paragraph from a packed response, tagged as <entities id="N">.
+
+    Returns:
+        - Dict[int, List[Entity]] - The entities by 0-based position in the batch. Paragraphs whose tag
+          is missing or doesn't hold valid JSON are left out, so they can be retried on their own.
+    """
+    pattern_entities = re.compile(r'<entities id="?(\d+)"?>([\s\S]*?)</entities>')
+    response = clean_response(response, verbose)
+
+    entities_by_position: Dict[int, List[Entity]] = {}
+    for match in pattern_entities.finditer(response):
+        position = int(match.group(1)) - 1
+        if not 0 <= position < batch_size:
+            continue
+        try:
+            entities_by_position[position] = [Entity(**entity) for entity in json.loads(match.group(2))]
+        except Exception as e:
+            if verbose:
+                tqdm.write(f"Error extracting entities of paragraph {position + 1} from the packed response: {e}")
+
+    return entities_by_position
+
 def extract_entities_from_paragraphs(
                                         llm:                    Union[ChatOllama, ChatBedrockConverse],                 
                                         paragraphs:             List[Dict[str, str]],
                                         relevant_entity_types:  List[str] = [],
                                         usecase_context:        str = "",
+                                        max_concurrency:        int = 1,
+                                        paragraphs_per_call:    int = 1,
+                                        max_tokens_per_call:    int = 3000,
+                                        checkpoint:             Optional[ParagraphCheckpoint] = None,
                                         verbose:                bool = False
                                      ) -> Dict[str, List[Entity]]:
     
@@ -68,11 +105,23 @@ def extract_entities_from_paragraphs(
         Extract entities from given paragraphs using the provided language model as well as the relevant entity types,
         or the usecase context if available.
 
+        Every request is independent, so up to 'max_concurrency' of them are sent to the model at once.
+        With 'paragraphs_per_call' > 1 several paragraphs are packed in a single request (up to 'max_tokens_per_call'
+        tokens of paragraph text), so the instructions are sent once per pack. Paragraphs whose entities
+        can't be parsed from a packed response are retried with one request each.
+        The paragraphs keep their order and each one gets its own "entities" key.
+        With a 'checkpoint', each paragraph's entities are logged as soon as they are parsed,
+        and paragraphs already in the log are not sent again.
+
         Args:
             - llm: Union[ChatOllama, ChatBedrockConverse] - The language model to use for entity extraction.
             - paragraphs: List[str] - The paragraphs to extract entities from.
             - relevant_entity_types: List[str] - The relevant entity types to consider.
             - usecase_context: str - The context of the usecase.
+            - max_concurrency: int - Maximum number of requests in flight at once.
+            - paragraphs_per_call: int - Maximum number of paragraphs packed in a single request.
+            - max_tokens_per_call: int - Estimated token budget of the paragraphs packed in a single request.
+            - checkpoint: Optional[ParagraphCheckpoint] - Per-paragraph progress log to resume from.
             - verbose: bool - Whether to print the progress.
     """
 
@@ -88,28 +137,76 @@ def extract_entities_from_paragraphs(
     progress_bar = tqdm(total=len(paragraphs), desc="Extracting Entities from paragraph")
     entity_count = 0
 
-    for p in paragraphs:
-        ptext = p["text"]
+    def set_entities(index: int, entities_: List[Entity]) -> None:
+        nonlocal entity_count
 
-        response = (entity_extraction_prompt | llm).invoke({
-            "paragraph_text": ptext,
+        paragraphs[index]["entities"] = [entity.model_dump() for entity in entities_]
+        if checkpoint is not None:
+            checkpoint.record(paragraph_key(paragraphs[index]), paragraphs[index]["entities"])
+
+        # Update the progress bar
+        entity_count += len(entities_)
+        progress_bar.update(1)
+        progress_bar.set_postfix(entity_count=entity_count)
+
+    pending = list(range(len(paragraphs)))
+
+    # Resume from the checkpoint, only the missing paragraphs are sent to the model.
+    if checkpoint is not None:
+        for i in pending:
+            if paragraph_key(paragraphs[i]) in checkpoint:
+                paragraphs[i]["entities"] = checkpoint.get(paragraph_key(paragraphs[i]))
+                entity_count += len(paragraphs[i]["entities"])
+                progress_bar.update(1)
+        pending = [i for i in pending if paragraph_key(paragraphs[i]) not in checkpoint]
+
+    # Packed requests, the paragraphs that fail to parse stay pending.
+    if paragraphs_per_call > 1:
+        batches = [[pending[i] for i in batch] for batch in
+                   pack_by_token_budget([paragraphs[i]["text"] for i in pending], max_tokens_per_call, paragraphs_per_call)]
+        failed  = []
+
+        def on_batch_response(batch_index: int, response: str) -> None:
+            batch  = batches[batch_index]
+            parsed = extract_batched_entities_from_response(response, len(batch), verbose)
+            for position, index in enumerate(batch):
+                if position in parsed:
+                    set_entities(index, parsed[position])
+                else:
+                    failed.append(index)
+
+        inputs = [{
+            "paragraphs": format_paragraphs_batch([paragraphs[i]["text"] for i in batch]),
             "example_entity_types": example_entity_types
-        }).content.strip()
-        
+        } for batch in batches]
+
+        invoke_concurrently(batched_entity_extraction_prompt | llm,
+                            inputs,
+                            max_concurrency = max_concurrency,
+                            on_result       = on_batch_response)
+
+        pending = sorted(failed)
+        if verbose and pending:
+            tqdm.write(f"Falling back to single paragraph requests for {len(pending)} paragraphs.")
+
+    # One request per paragraph.
+    def on_response(position: int, response: str) -> None:
         #if verbose:
         #    tqdm.write(f"Response from entity extraction: {response}")
-        
+
         # Clean and extract the entities from the response
-        entities_ = extract_entities_from_response(response, verbose)
-        entities_ = [entity.model_dump() for entity in entities_]
-        p["entities"] = entities_
+        set_entities(pending[position], extract_entities_from_response(response, verbose))
 
+    inputs = [{
+        "paragraph_text": paragraphs[i]["text"],
+        "example_entity_types": example_entity_types
+    } for i in pending]
 
-        # Update the progress bar
-        entity_count += len(entities_)
-        progress_bar.update(1)
-        progress_bar.set_postfix(entity_count=entity_count)
+    invoke_concurrently(entity_extraction_prompt | llm,
+                        inputs,
+                        max_concurrency = max_concurrency,
+                        on_result       = on_response)
     
     progress_bar.close()
 
-    return paragraphs
\ No newline at end of file
+    return paragraphs
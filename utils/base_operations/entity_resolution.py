@@ -0,0 +1,231 @@
+import re
+import zlib
+import unicodedata
+import numpy as np
+
+from collections                    import Counter, defaultdict
+from langchain_core.embeddings      import Embeddings
+from typing                         import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from utils.base_operations.deduplication import DisjointSet
+
+ARTICLES = {"the", "a", "an"}
+
+# Singular nouns with a plural suffix, left unchanged by '_singular'.
+SINGULAR_NOUNS = {"species", "series", "rabies", "scabies", "diabetes", "herpes", "news", "lens",
+                  "genetics", "physics", "economics", "mathematics", "statistics", "politics", "ethics"}
+
+
+def _singular(word: str) -> str:
+    # Plural suffixes of English nouns, leaving the words that only look plural ("glass", "virus", "Texas", "species").
+    if len(word) <= 3 or word in SINGULAR_NOUNS or word.endswith(("ss", "us", "is", "as", "os")):
+        return word
+    if word.endswith("ies") and len(word) > 4:
+        return word[:-3] + "y"
+    if word.endswith(("sses", "shes", "ches", "xes", "zes")) or (word.endswith("oes") and len(word) > 6):
+        return word[:-2]
+    if word.endswith("s"):
+        return word[:-1]
+    return word
+
+
+def normalize_entity_name(name: str) -> str:
+    """
+    Normalize an entity name: accents, case, punctuation and whitespace removed, leading article dropped
+    and last word singularized, so "The Tomatoes" and "tomato" share the same key.
+    """
+    name = unicodedata.normalize("NFKD", name)
+    name = "".join(c for c in name if not unicodedata.combining(c)).lower().replace("&", " and ")
+    words = re.sub(r"[^\w]+", " ", name).split()
+    if len(words) > 1 and words[0] in ARTICLES:
+        words = words[1:]
+    if words:
+        words[-1] = _singular(words[-1])
+    return " ".join(words)
+
+
+def char_ngrams(text: str, n: int = 3) -> Set[str]:
+    """
+    Character n-grams of a text, padded with spaces so short names still have some.
+    """
+    text = f" {text} "
+    return {text[i:i + n] for i in range(max(1, len(text) - n + 1))}
+
+
+def jaccard_similarity(a: Set[str], b: Set[str]) -> float:
+    return len(a & b) / len(a | b) if a or b else 0.0
+
+
+def minhash_signatures(
+                        texts:          List[str],
+                        num_perm:       int = 128,
+                        ngram_size:     int = 3,
+                        chunk_size:     int = 10000,
+                        seed:           int = 0,
+                        ) -> np.ndarray:
+    """
+    MinHash signatures of the character n-grams of each text, shape (len(texts), num_perm).
+
+    The n-grams are hashed once, and the 'num_perm' hash functions (multiply-shift hashing) are applied with
+    numpy to all the n-grams of 'chunk_size' texts at a time, so memory stays bounded on millions of names.
+    """
+    rng = np.random.default_rng(seed)
+    multipliers = rng.integers(1, 2**63, size=num_perm, dtype=np.uint64) | np.uint64(1)
+    increments  = rng.integers(0, 2**63, size=num_perm, dtype=np.uint64)
+
+    signatures = np.empty((len(texts), num_perm), dtype=np.uint32)
+    for start in range(0, len(texts), chunk_size):
+        grams = [sorted(char_ngrams(text, ngram_size)) for text in texts[start:start + chunk_size]]
+        hashes = np.array([zlib.crc32(g.encode()) for text_grams in grams for g in text_grams], dtype=np.uint64)
+        boundaries = np.cumsum([0] + [len(text_grams) for text_grams in grams[:-1]])
+
+        # (a * h + b) mod 2^64, top 32 bits. The uint64 overflow is the modulo.
+        with np.errstate(over="ignore"):
+            permuted = ((hashes[:, None] * multipliers[None, :] + increments[None, :]) >> np.uint64(32)).astype(np.uint32)
+        signatures[start:start + len(grams)] = np.minimum.reduceat(permuted, boundaries, axis=0)
+    return signatures
+
+
+def hyperplane_signatures(vectors: np.ndarray, bits: int = 64, seed: int = 0) -> np.ndarray:
+    """
+    Random hyperplane signatures of vectors, shape (len(vectors), bits) booleans. Vectors with a high cosine
+    similarity share most of their bits.
+    """
+    planes = np.random.default_rng(seed).standard_normal((vectors.shape[1], bits)).astype(np.float32)
+    return vectors @ planes > 0
+
+
+def band_candidates(
+                        signatures:         np.ndarray,
+                        bands:              int,
+                        max_bucket_size:    int = 1000,
+                        ) -> Set[Tuple[int, int]]:
+    """
+    Candidate pairs of locality-sensitive hashing: the rows sharing every value of at least one band of their signature.
+
+    Args:
+        - signatures: np.ndarray - One signature per row, MinHash values or hyperplane bits.
+        - bands: int - Number of bands the signature is split in. More bands find more, less similar, pairs.
+        - max_bucket_size: int - Buckets larger than this are skipped, they hold very generic names and would
+                           make the comparisons quadratic.
+
+    Returns:
+        - Set[Tuple[int, int]] - The (i, j) pairs of row indexes, with i < j.
+    """
+    rows = signatures.shape[1] // bands
+    candidates: Set[Tuple[int, int]] = set()
+    for band in range(bands):
+        keys = np.ascontiguousarray(signatures[:, band * rows:(band + 1) * rows])
+        _, bucket_of = np.unique(keys.view(np.dtype((np.void, keys.dtype.itemsize * rows))).ravel(), return_inverse=True)
+
+        # Only the buckets of more than one row are visited.
+        order = np.argsort(bucket_of, kind="stable")
+        starts = np.flatnonzero(np.r_[True, np.diff(bucket_of[order]) != 0])
+        sizes = np.diff(np.r_[starts, len(order)])
+        shared = (sizes > 1) & (sizes <= max_bucket_size)
+        for start, size in zip(starts[shared], sizes[shared]):
+            bucket = order[start:start + size].tolist()
+            candidates.update((i, j) for k, i in enumerate(bucket) for j in bucket[k + 1:])
+    return candidates
+
+
+def resolve_entities(
+                        documents:              Dict[str, Iterable[Dict[str, Any]]],
+                        embeddings:             Optional[Embeddings] = None,
+                        name_threshold:         float = 0.7,
+                        embedding_threshold:    float = 0.9,
+                        num_perm:               int = 128,
+                        bands:                  int = 16,
+                        embedding_batch_size:   int = 256,
+                        ) -> Dict[str, Any]:
+    """
+    Resolve the entities extracted from the paragraphs of a corpus into canonical entities.
+
+    Mentions are first merged by normalized name ("Tomatoes", "tomato"), so the rest of the work grows with
+    the number of distinct names. Candidate pairs of names are then blocked with MinHash LSH on their character
+    n-grams and, with 'embeddings', with random hyperplane LSH on their embeddings, instead of comparing every
+    pair. A candidate pair of compatible types is merged when its n-gram Jaccard similarity reaches
+    'name_threshold' or its embedding cosine similarity reaches 'embedding_threshold'.
+
+    Args:
+        - documents: Dict[str, Iterable[Dict[str, Any]]] - The grouped paragraphs of every document, with their
+                     "entities" and "chunk_id", by document path. The paragraphs can be streamed.
+        - embeddings: Optional[Embeddings] - Embeddings model of the names, to also merge synonyms and variants.
+        - name_threshold: float - Character n-gram Jaccard similarity from which two names are merged.
+        - embedding_threshold: float - Embedding cosine similarity from which two names are merged.
+        - num_perm: int - Number of MinHash functions.
+        - bands: int - Number of LSH bands, for both blockers. With 128 / 16 = 8 values per band, pairs above
+                 ~0.7 similarity are very likely candidates, and pairs under ~0.5 rarely are.
+        - embedding_batch_size: int - Number of names embedded per request.
+
+    Returns:
+        - Dict[str, Any] - "entities": the canonical entities, with their name, type, aliases, number of mentions
+                           and provenance (chunk ids and documents); "aliases": the id of the canonical entity of
+                           every normalized name; "candidate_pairs" and "merged_pairs" counters.
+    """
+    # Mentions by normalized name, only their counts and provenance are kept.
+    surface_forms:  Dict[str, Counter] = defaultdict(Counter)
+    types:          Dict[str, Counter] = defaultdict(Counter)
+    chunk_ids:      Dict[str, Set[str]] = defaultdict(set)
+    sources:        Dict[str, Set[str]] = defaultdict(set)
+    for document in sorted(documents):
+        for paragraph in documents[document]:
+            for entity in paragraph.get("entities") or []:
+                key = normalize_entity_name(entity.get("name", ""))
+                if not key:
+                    continue
+                surface_forms[key][entity["name"].strip()] += 1
+                types[key][entity.get("type")] += 1
+                if paragraph.get("chunk_id"):
+                    chunk_ids[key].add(paragraph["chunk_id"])
+                sources[key].add(document)
+
+    names = sorted(surface_forms)
+    main_type = {key: types[key].most_common(1)[0][0] for key in names}
+
+    candidates = band_candidates(minhash_signatures(names, num_perm=num_perm), bands) if names else set()
+    vectors = None
+    if embeddings is not None and names:
+        vectors = np.vstack([np.asarray(embeddings.embed_documents(names[i:i + embedding_batch_size]), dtype=np.float32)
+                             for i in range(0, len(names), embedding_batch_size)])
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        candidates |= band_candidates(hyperplane_signatures(vectors, bits=num_perm), bands)
+
+    # Verify the candidates: n-gram similarity for every pair, cosine similarity vectorized over all the pairs.
+    pairs = sorted((i, j) for i, j in candidates
+                   if main_type[names[i]] == main_type[names[j]] or main_type[names[i]] is None or main_type[names[j]] is None)
+    similar = np.zeros(len(pairs), dtype=bool)
+    if vectors is not None and pairs:
+        left, right = np.array(pairs).T
+        similar |= np.einsum("ij,ij->i", vectors[left], vectors[right]) >= embedding_threshold
+    grams = {}
+    clusters = DisjointSet()
+    for key in names:
+        clusters.add(key)
+    merged_pairs = 0
+    for (i, j), embedding_match in zip(pairs, similar):
+        for key in (names[i], names[j]):
+            if key not in grams:
+                grams[key] = char_ngrams(key)
+        if embedding_match or jaccard_similarity(grams[names[i]], grams[names[j]]) >= name_threshold:
+            clusters.union(names[i], names[j])
+            merged_pairs += 1
+
+    entities, aliases = [], {}
+    for group in sorted(clusters.groups(), key=lambda g: min(g)):
+        forms = sum((surface_forms[key] for key in group), Counter())
+        group_types = sum((types[key] for key in group), Counter())
+        entity_id = len(entities)
+        entities.append({
+            "id":           entity_id,
+            # The most frequent surface form, the shortest on ties.
+            "name":         min(forms, key=lambda form: (-forms[form], len(form), form)),
+            "type":         group_types.most_common(1)[0][0],
+            "aliases":      sorted(forms),
+            "mentions":     sum(forms.values()),
+            "chunk_ids":    sorted(set().union(*(chunk_ids[key] for key in group))),
+            "documents":    sorted(set().union(*(sources[key] for key in group))),
+        })
+        aliases.update({key: entity_id for key in group})
+
+    return {"entities": entities, "aliases": aliases, "candidate_pairs": len(pairs), "merged_pairs": merged_pairs}
@@ -0,0 +1,49 @@
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing             import Any, Callable, Dict, List
+from tqdm               import tqdm
+
+
+def process_files_concurrently(
+                                files:          List[str],
+                                process_file:   Callable[[str], Any],
+                                max_workers:    int = 1,
+                                desc:           str = "Processing files",
+                                verbose:        bool = False,
+                                ) -> Dict[str, Exception]:
+    """
+    Run 'process_file' on every file with a pool of 'max_workers' threads.
+    Each worker loads its own file, so memory is bounded by the files in flight, not by the corpus.
+
+    A failing file doesn't abort the batch: its exception is reported and returned.
+
+    Args:
+        - files: List[str] - The file paths to process.
+        - process_file: Callable[[str], Any] - Loads, processes and saves a single file.
+        - max_workers: int - Number of files processed at the same time.
+        - desc: str - Description of the progress bar.
+        - verbose: bool - Whether to print the tracebacks of the failures.
+
+    Returns:
+        - Dict[str, Exception] - The files that failed, with their exception.
+    """
+    failures: Dict[str, Exception] = {}
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {executor.submit(process_file, file): file for file in files}
+
+        for future in tqdm(as_completed(futures), total=len(futures), desc=desc, unit="file"):
+            file = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                failures[file] = e
+                tqdm.write(f"Failed to process {file}: {type(e).__name__}: {e}")
+                if verbose:
+                    tqdm.write("".join(traceback.format_exception(e)))
+
+    if failures:
+        tqdm.write(f"{desc}: {len(failures)} of {len(files)} files failed.")
+
+    return failures
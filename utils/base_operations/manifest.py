@@ -0,0 +1,151 @@
+import os
+import json
+import hashlib
+import threading
+
+from os         import path
+from datetime   import datetime
+from typing     import Any, Callable, Dict, List, Optional, Tuple
+
+from utils.base_operations.serialization import truncate_torn_line
+
+
+def hash_file(file_path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    md5 of the bytes of a file, read in chunks.
+    """
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def llm_fingerprint(llm: Any) -> str:
+    """
+    Identity of an LLM (model name and parameters), the same string langchain uses for its cache keys.
+    Embeddings models, which have no such string, are identified by their model name.
+    """
+    if llm is None:
+        return "None"
+    try:
+        return llm._get_llm_string()
+    except Exception:
+        model_name = getattr(llm, "model_id", None) or getattr(llm, "model", None)
+        return f"{type(llm).__name__}:{model_name}"
+
+
+def prompt_fingerprint(prompt: Any) -> str:
+    """
+    Identity of a prompt template, its rendered template text.
+    """
+    try:
+        return prompt.pretty_repr()
+    except Exception:
+        return repr(prompt)
+
+
+def hash_config(**config: Any) -> str:
+    """
+    Hash of a stage configuration: its parameters, prompts and model fingerprints.
+    """
+    return hashlib.md5(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class StageManifest:
+    """
+        Per-stage manifest of the processed inputs, so reruns only process new or changed documents.
+
+        Each entry records the input hash, the stage configuration hash (parameters, prompts, model)
+        and the output path. An input is up to date when both hashes match and the output still exists.
+        The manifest is an append-only JSONL file, so recording an entry is cheap and survives crashes.
+    """
+
+    # One lock per manifest file, shared by the instances of the documents processed concurrently.
+    _locks: Dict[str, threading.Lock] = {}
+    _locks_guard = threading.Lock()
+
+    def __init__(self, manifest_path: str, config_hash: str):
+        """
+        Args:
+            - manifest_path: str - Path of the manifest JSONL file, created if missing.
+            - config_hash: str - Hash of the current stage configuration, see 'hash_config'.
+        """
+        self.manifest_path  = manifest_path
+        self.config_hash    = config_hash
+        self.entries: Dict[str, Dict] = {}
+        with StageManifest._locks_guard:
+            self._lock = StageManifest._locks.setdefault(path.abspath(manifest_path), threading.Lock())
+
+        os.makedirs(path.dirname(manifest_path) or ".", exist_ok=True)
+        if path.exists(manifest_path):
+            # A torn last line after a crash is cut off, so the next record starts on its own line;
+            # that entry will be recomputed.
+            truncate_torn_line(manifest_path)
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.entries[entry["input_path"]] = entry
+
+    @classmethod
+    def for_stage(cls, data_dir: str, stage: str, config_hash: str) -> "StageManifest":
+        """
+        The manifest of a stage, stored in "<data_dir>/.manifests/<stage>.jsonl".
+        """
+        return cls(path.join(data_dir, ".manifests", f"{stage}.jsonl"), config_hash)
+
+    def is_up_to_date(self, input_path: str, input_hash: str) -> bool:
+        """
+        Whether the input was already processed, unchanged, with the current stage configuration.
+        """
+        entry = self.entries.get(input_path)
+        return bool(entry
+                    and entry["input_hash"] == input_hash
+                    and entry["config_hash"] == self.config_hash
+                    and entry.get("output_path") and path.exists(entry["output_path"]))
+
+    def output_path(self, input_path: str) -> Optional[str]:
+        """
+        The last recorded output of the input, if it still exists.
+        """
+        entry = self.entries.get(input_path)
+        if entry and entry.get("output_path") and path.exists(entry["output_path"]):
+            return entry["output_path"]
+        return None
+
+    def record(self, input_path: str, input_hash: str, output_path: str) -> None:
+        """
+        Record a processed input. Thread-safe.
+        """
+        entry = {
+            "input_path":   input_path,
+            "input_hash":   input_hash,
+            "config_hash":  self.config_hash,
+            "output_path":  output_path,
+            "timestamp":    datetime.now().isoformat(),
+        }
+        with self._lock:
+            self.entries[input_path] = entry
+            with open(self.manifest_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def pending(self, input_paths: List[str], force: bool = False, verbose: bool = False,
+                input_salt: Optional[Callable[[str], str]] = None) -> List[Tuple[str, str]]:
+        """
+        Hash the inputs and keep the ones that need to be processed.
+        'input_salt' adds what else the output of an input depends on to its hash, e.g. its excluded paragraphs.
+
+        Returns:
+            - List[Tuple[str, str]] - The (input path, input hash) pairs to process.
+        """
+        hashed  = [(input_path, hash_file(input_path) + (f":{input_salt(input_path)}" if input_salt else ""))
+                   for input_path in input_paths]
+        pending = [(p, h) for p, h in hashed if force or not self.is_up_to_date(p, h)]
+
+        if verbose:
+            print(f"{len(input_paths) - len(pending)} of {len(input_paths)} inputs are up to date in {self.manifest_path}")
+
+        return pending
@@ -1,16 +1,22 @@
 import re
 import json
+import difflib
 from datetime import datetime
 
-from typing             import List, Dict, Optional, Union
+from typing             import Any, List, Dict, Optional, Tuple, Union
 from langchain_ollama   import ChatOllama
 from langchain_aws      import ChatBedrockConverse
 from tqdm               import tqdm
 
 from utils.models.graphrag_models                   import Entity, Relation
 from utils.prompts.graphrag.relationship_extraction_prompts import (relationship_extraction_prompt,
+                                                            batched_relationship_extraction_prompt,
                                                             missing_relations_check_prompt,
                                                             additional_relations_extraction_prompt)
+from utils.base_operations.concurrent_invoke    import invoke_concurrently
+from utils.base_operations.checkpoint           import ParagraphCheckpoint, paragraph_key
+from utils.base_operations.entity_resolution    import normalize_entity_name
+from utils.tokens                               import pack_by_token_budget
 
 def clean_response(response: str, verbose: bool = False) -> str:
     """
@@ -28,11 +34,79 @@ def clean_response(response: str, verbose: bool = False) -> str:
     return response
 
 
+class EntityIndex:
+    """
+        Lookup of the entities the relations of a paragraph can refer to.
+
+        The names returned by the model are looked up by exact name, then by normalized name (case, accents,
+        punctuation, plural), then by alias (the canonical entity of the name, see 'resolve_entities'), then by
+        the closest normalized name, and finally in the 'fallback' index (e.g. the entities of the whole document).
+        Every lookup but the fuzzy one is a dictionary access.
+    """
+
+    def __init__(
+                    self,
+                    entities:       List[Entity],
+                    aliases:        Optional[Dict[str, int]] = None,
+                    fallback:       Optional["EntityIndex"] = None,
+                    fuzzy_cutoff:   float = 0.85,
+                ):
+        """
+        Args:
+            - entities: List[Entity] - The entities found in the paragraph.
+            - aliases: Optional[Dict[str, int]] - The canonical entity id of each normalized name, from the
+                       resolved entities index. None to skip the alias lookup.
+            - fallback: Optional[EntityIndex] - Index searched when a name is not found in this one.
+            - fuzzy_cutoff: float - Minimum difflib similarity ratio of the closest name, 1 to disable the fuzzy lookup.
+        """
+        self.aliases        = aliases or {}
+        self.fallback       = fallback
+        self.fuzzy_cutoff   = fuzzy_cutoff
+
+        self.by_name:  Dict[str, Entity] = {}
+        self.by_key:   Dict[str, Entity] = {}
+        self.by_alias: Dict[int, Entity] = {}
+        for entity in entities:
+            key = normalize_entity_name(entity.name)
+            self.by_name.setdefault(entity.name, entity)
+            self.by_key.setdefault(key, entity)
+            if key in self.aliases:
+                self.by_alias.setdefault(self.aliases[key], entity)
+
+    def lookup(self, name: Any) -> Tuple[Optional[Entity], bool]:
+        """
+        The entity a name refers to.
+
+        Returns:
+            - Tuple[Optional[Entity], bool] - The entity (None if not found), and whether it was recovered,
+              i.e. found by any lookup but the exact name.
+        """
+        if isinstance(name, dict):
+            name = name.get("name")
+        if not isinstance(name, str):
+            return None, False
+
+        if name in self.by_name:
+            return self.by_name[name], False
+
+        key = normalize_entity_name(name)
+        entity = self.by_key.get(key)
+        if entity is None and key in self.aliases:
+            entity = self.by_alias.get(self.aliases[key])
+        if entity is None and self.fuzzy_cutoff < 1:
+            closest = difflib.get_close_matches(key, list(self.by_key), n=1, cutoff=self.fuzzy_cutoff)
+            entity = self.by_key[closest[0]] if closest else None
+        if entity is None and self.fallback is not None:
+            entity, _ = self.fallback.lookup(name)
+        return entity, entity is not None
+
+
 def extract_relations_from_response(response: str,
-                                    entities: List[Entity],
-                                    verbose: bool = False) -> List[Relation]:
+                                    entities: Union[List[Entity], EntityIndex],
+                                    verbose: bool = False,
+                                    counts: Optional[Dict[str, int]] = None) -> List[Relation]:
     """
-    Extract the relations from the response.
+    Extract the relations from the response. See 'validate_relations' for the 'counts'.
     """
     # Set up some variables
     relationships: List[Relation] = []
@@ -51,7 +125,7 @@ def extract_relations_from_response(response: str,
 
         try:
             relationship_list = json.loads(relationship_str)
-            relationship_list = validate_relations(entities, relationship_list, verbose)
+            relationship_list = validate_relations(entities, relationship_list, verbose, counts)
             relationships.extend([Relation(**r) for r in relationship_list])
         except json.JSONDecodeError as e:
             if verbose:
@@ -64,34 +138,91 @@ def extract_relations_from_response(response: str,
     return relationships
 
 
-def validate_relations(entities: List[Entity],
+def validate_relations(entities: Union[List[Entity], EntityIndex],
                        relations: List[Dict],
-                       verbose: bool = False) -> List[Relation]:
+                       verbose: bool = False,
+                       counts: Optional[Dict[str, int]] = None) -> List[Relation]:
     """
         Validate the relations extracted from the response.
-        Relations should only contain entities that are present in the entities list.
+        Relations should only contain entities that are present in the entities list, looked up in an
+        'EntityIndex' so names that differ in case, plural or spelling are recovered instead of dropped.
+
+        The numbers of recovered and rejected relations are added to 'counts["recovered"]' and 'counts["rejected"]'.
     """
-    valid_relations = []
-    entity_names = [entity.name for entity in entities]
+    index = entities if isinstance(entities, EntityIndex) else EntityIndex(entities)
+    counts = counts if counts is not None else {}
+    counts.setdefault("recovered", 0)
+    counts.setdefault("rejected", 0)
 
+    valid_relations = []
     for relation in relations:
-        if relation.get("source_entity") in entity_names and relation.get("target_entity") in entity_names:
-            valid_relations.append(relation)
+        source, source_recovered = index.lookup(relation.get("source_entity")) if isinstance(relation, dict) else (None, False)
+        target, target_recovered = index.lookup(relation.get("target_entity")) if isinstance(relation, dict) else (None, False)
+
+        # Map the source and target entities to their respective objects
+        if source is not None and target is not None and isinstance(relation.get("relation_detail"), str):
+            valid_relations.append({**relation, "source_entity": source, "target_entity": target})
+            counts["recovered"] += source_recovered or target_recovered
         else:
+            counts["rejected"] += 1
             if verbose:
                 tqdm.write(f"Invalid relation: {relation}")
 
-    # Map the source and target entities to their respective objects
-    for r in valid_relations:
-        r["source_entity"] = next(e for e in entities if e.name == r["source_entity"])
-        r["target_entity"] = next(e for e in entities if e.name == r["target_entity"])
-    
     return valid_relations
 
 
+def format_paragraphs_batch(paragraphs: List[Dict], entities: List[List[Entity]]) -> str:
+    """
+    Render paragraphs and their found entities with 1-based ids, for the packed prompt.
+    """
+    rendered = []
+    for i, (p, paragraph_entities) in enumerate(zip(paragraphs, entities), start=1):
+        entity_list = json.dumps([{"name": e.name, "type": e.type} for e in paragraph_entities], ensure_ascii=False)
+        rendered.append(f'<paragraph id="{i}">\nText: {p["text"]}\nFound entities: {entity_list}\n</paragraph>')
+    return "\n".join(rendered)
+
+def extract_batched_relations_from_response(response: str,
+                                            entities: List[Union[List[Entity], EntityIndex]],
+                                            verbose: bool = False,
+                                            counts: Optional[Dict[int, Dict[str, int]]] = None) -> Dict[int, List[Relation]]:
+    """
+    Extract the relations of each paragraph from a packed response, tagged as <relationships id="N">.
+    The recovered and rejected relations of each paragraph are counted in 'counts', by position (see 'validate_relations').
+
+    Returns:
+        - Dict[int, List[Relation]] - The relations by 0-based position in the batch. Paragraphs whose tag
+          is missing or doesn't hold valid JSON are left out, so they can be retried on their own.
+    """
+    pattern_relationship = re.compile(r'<relationships id="?(\d+)"?>(.*?)</relationships>', re.DOTALL)
+    response = clean_response(response, False)
+
+    relations_by_position: Dict[int, List[Relation]] = {}
+    for match in pattern_relationship.finditer(response):
+        position = int(match.group(1)) - 1
+        if not 0 <= position < len(entities):
+            continue
+        try:
+            paragraph_counts = {}
+            relationship_list = validate_relations(entities[position], json.loads(match.group(2).strip()), verbose, paragraph_counts)
+            relations_by_position[position] = [Relation(**r) for r in relationship_list]
+            if counts is not None:
+                counts[position] = paragraph_counts
+        except Exception as e:
+            if verbose:
+                tqdm.write(f"Error parsing relations of paragraph {position + 1} from the packed response: {e}")
+
+    return relations_by_position
+
 def extract_relations_from_paragraphs(
                                         llm:                    Union[ChatOllama, ChatBedrockConverse],                 
                                         paragraphs:             List[Dict[str, str]],
+                                        max_concurrency:        int = 1,
+                                        paragraphs_per_call:    int = 1,
+                                        max_tokens_per_call:    int = 3000,
+                                        aliases:                Optional[Dict[str, int]] = None,
+                                        document_entities:      Optional[EntityIndex] = None,
+                                        fuzzy_cutoff:           float = 0.85,
+                                        checkpoint:             Optional[ParagraphCheckpoint] = None,
                                         verbose:                bool = False
                                      ) -> Dict[str, List[Relation]]:
     
@@ -99,39 +230,55 @@ def extract_relations_from_paragraphs(
         Extract relationships among entities from given paragraphs using the provided language model,
         in combination with the original paragraphs and entities extracted from them.
 
+        Up to 'max_concurrency' requests are sent to the model at once. With 'paragraphs_per_call' > 1
+        several paragraphs are packed in a single request (up to 'max_tokens_per_call' tokens of paragraph text),
+        and paragraphs whose relations can't be parsed from a packed response are retried with one request each.
+        With a 'checkpoint', each paragraph's relations are logged as soon as they are parsed,
+        and paragraphs already in the log (with the same entities) are not sent again.
+
+        The entity names of the relations are looked up in an 'EntityIndex' of each paragraph, so the relations
+        naming an entity slightly differently are recovered. The numbers of recovered and rejected relations
+        are saved in the "relations_metadata" of each paragraph.
+
         Args:
             - llm: Union[ChatOllama, ChatBedrockConverse] - The language model to use for entity extraction.
             - paragraphs: List[Dict[str, str]] - The grouped paragraphs to extract relationships from.
+            - max_concurrency: int - Maximum number of requests in flight at once.
+            - paragraphs_per_call: int - Maximum number of paragraphs packed in a single request.
+            - max_tokens_per_call: int - Estimated token budget of the paragraphs packed in a single request.
+            - aliases: Optional[Dict[str, int]] - The canonical entity id of each normalized name, to look up aliases.
+            - document_entities: Optional[EntityIndex] - Index of the entities of the whole document, searched
+                                 when a name is not found in the paragraph.
+            - fuzzy_cutoff: float - Minimum similarity of the closest entity name for a near miss, 1 to disable it.
+            - checkpoint: Optional[ParagraphCheckpoint] - Per-paragraph progress log to resume from.
             - verbose: bool - Whether to print the progress.
     """
 
     # Initialize the progress bar
     progress_bar = tqdm(total=len(paragraphs), desc="Extracting relations from paragraph")
     relations_count = 0
-    invalid_relations = 0
 
-    for p in paragraphs:
-        ptext = p["text"]
-        entities = [Entity(**e) for e in p["entities"]]
+    entities = [[Entity(**e) for e in p["entities"]] for p in paragraphs]
+    indexes  = [EntityIndex(e, aliases=aliases, fallback=document_entities, fuzzy_cutoff=fuzzy_cutoff) for e in entities]
+
+    def set_relations(index: int, relations: List[Relation], counts: Dict[str, int]) -> None:
+        nonlocal relations_count
 
-        response = (relationship_extraction_prompt | llm).invoke({
-            "paragraph_text": ptext,
-            "found_entities": entities,
-        }).content.strip()
-        
-        print(response)
-        
-        # Clean and extract the entities from the response
-        relations = extract_relations_from_response(response, entities, verbose)
         relations = [r.model_dump() for r in relations]
-        print("Extracted Relations: ", relations)
+        if verbose:
+            tqdm.write(f"Extracted Relations: {relations}")
 
+        p = paragraphs[index]
         p["relations"] = relations
         p["relations_metadata"] = {
             "relations_extraction_timestamp": datetime.now().isoformat(),
-            "invalid_relations": invalid_relations,
+            "invalid_relations": counts.get("rejected", 0),
+            "recovered_relations": counts.get("recovered", 0),
             "total_relations": len(relations),
         }
+        if checkpoint is not None:
+            checkpoint.record(paragraph_key(p, p["entities"]),
+                              {"relations": p["relations"], "relations_metadata": p["relations_metadata"]})
 
         # Update the progress bar
         relations_count += len(relations)
@@ -139,8 +286,67 @@ def extract_relations_from_paragraphs(
         progress_bar.set_postfix(rel_count=relations_count)
         progress_bar.refresh()  
 
-        # Only once iter for testing
-        # break
+    pending = list(range(len(paragraphs)))
+
+    # Resume from the checkpoint, only the missing paragraphs are sent to the model.
+    if checkpoint is not None:
+        for i in pending:
+            result = checkpoint.get(paragraph_key(paragraphs[i], paragraphs[i]["entities"]))
+            if result is not None:
+                paragraphs[i].update(result)
+                relations_count += len(result["relations"])
+                progress_bar.update(1)
+        pending = [i for i in pending if paragraph_key(paragraphs[i], paragraphs[i]["entities"]) not in checkpoint]
+
+    # Packed requests, the paragraphs that fail to parse stay pending.
+    if paragraphs_per_call > 1:
+        batches = [[pending[i] for i in batch] for batch in
+                   pack_by_token_budget([paragraphs[i]["text"] for i in pending], max_tokens_per_call, paragraphs_per_call)]
+        failed  = []
+
+        def on_batch_response(batch_index: int, response: str) -> None:
+            batch  = batches[batch_index]
+            counts = {}
+            parsed = extract_batched_relations_from_response(response, [indexes[i] for i in batch], verbose, counts)
+            for position, index in enumerate(batch):
+                if position in parsed:
+                    set_relations(index, parsed[position], counts[position])
+                else:
+                    failed.append(index)
+
+        inputs = [{
+            "paragraphs": format_paragraphs_batch([paragraphs[i] for i in batch], [entities[i] for i in batch]),
+        } for batch in batches]
+
+        invoke_concurrently(batched_relationship_extraction_prompt | llm,
+                            inputs,
+                            max_concurrency = max_concurrency,
+                            on_result       = on_batch_response)
+
+        pending = sorted(failed)
+        if verbose and pending:
+            tqdm.write(f"Falling back to single paragraph requests for {len(pending)} paragraphs.")
+
+    # One request per paragraph.
+    def on_response(position: int, response: str) -> None:
+        index = pending[position]
+        if verbose:
+            tqdm.write(response)
+
+        # Clean and extract the entities from the response
+        counts = {}
+        relations = extract_relations_from_response(response, indexes[index], verbose, counts)
+        set_relations(index, relations, counts)
+
+    inputs = [{
+        "paragraph_text": paragraphs[i]["text"],
+        "found_entities": entities[i],
+    } for i in pending]
+
+    invoke_concurrently(relationship_extraction_prompt | llm,
+                        inputs,
+                        max_concurrency = max_concurrency,
+                        on_result       = on_response)
         
     progress_bar.close()
 
@@ -1,79 +1,430 @@
 import re
 import hashlib
 import tqdm
+import numpy as np
 
 from langchain_ollama       import ChatOllama
 from langchain_aws          import ChatBedrockConverse
-from typing                 import List, Dict, Optional, Union
+from langchain_core.embeddings import Embeddings
+from typing                 import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 from utils.prompts.general.semantic_grouping_prompts import similarity_prompt
+from utils.tokens                                    import head_by_tokens, tail_by_tokens
+from utils.base_operations.checkpoint                import ParagraphCheckpoint, paragraph_key
+
+MERGE_KEYWORDS = ["true", "merge", "group", "yes", "join", "combine"]
+
+def is_merge_response(response: str) -> bool:
+    """
+    Parse the response of the similarity prompt robustly.
+    """
+    return any(kw in response for kw in MERGE_KEYWORDS)
+
+def grouping_record(chunk: str) -> Dict[str, str]:
+    """
+    A grouped paragraph, with its chunk id.
+    """
+    return {"text": chunk, "chunk_id": hashlib.md5(chunk.encode()).hexdigest()}
+
+def build_grouping_output(grouped: List[str], **processing_metadata) -> Dict:
+    """
+    Build the output of the grouping functions: the grouped paragraphs with their chunk ids, and processing metadata.
+    """
+    grouped = [grouping_record(chunk) for chunk in grouped]
+
+    return {
+            "grouped_paragraphs": grouped,
+            "processing_metadata": {
+                "average_chunk_length": sum(len(c) for c in [g["text"] for g in grouped])//len(grouped) if grouped else 0,
+                **processing_metadata
+                }
+            }
+
+def build_similarity_inputs(
+                            previous_group:         Optional[str],
+                            current_chunk:          List[str],
+                            new_para:               str,
+                            next_para:              Optional[str],
+                            context_token_budget:   Optional[int] = None,
+                            ) -> Dict[str, str]:
+    """
+    Build the variables of the similarity prompt.
+
+    Without a 'context_token_budget' the previous group and the current chunk are sent whole, so the prompt
+    grows with the chunk. With a budget (in estimated tokens) only a rolling window is kept: the tail of the
+    current chunk (half of the budget), the tail of the previous group (a quarter) and the head of the
+    next paragraph (a quarter). The new paragraph is always sent whole.
+    """
+    context     = previous_group if previous_group else "None. Start of document."
+    joined      = " ".join(current_chunk) if current_chunk else "None. Start of chunk."
+    next_para   = next_para if next_para is not None else "None. End of document."
+
+    if context_token_budget:
+        context     = tail_by_tokens(context, context_token_budget // 4)
+        joined      = tail_by_tokens(joined, context_token_budget // 2)
+        next_para   = head_by_tokens(next_para, context_token_budget // 4)
+
+    return {
+        "context": context,
+        "joined_current_chunk": joined,
+        "new_para": new_para,
+        "next_para": next_para,
+    }
+
+def with_lookahead(items: Iterable[Any]) -> Iterator[Tuple[Any, Optional[Any]]]:
+    """
+    Iterate over (item, next item) pairs, the next item is None for the last one.
+    Only one item is read ahead, so the input can be a lazy stream of paragraphs.
+    """
+    items = iter(items)
+    current = next(items, None)
+    while current is not None:
+        following = next(items, None)
+        yield current, following
+        current = following
+
+def merge_paragraph(
+                    merge:         bool,
+                    clean_para:    str,
+                    current_chunk: List[str],
+                    max_chunk:     int,
+                    ) -> Tuple[Optional[str], List[str]]:
+    """
+    Merge the paragraph into the current chunk, or finalize the chunk and start a new one
+    when the paragraph is not related or the chunk would exceed 'max_chunk' characters.
+
+    Returns:
+        - Tuple[Optional[str], List[str]] - The finalized chunk (if any) and the new current chunk.
+    """
+    if merge:
+        # Check chunk limits
+        new_length = sum(len(p) for p in current_chunk) + len(clean_para)
+        if new_length <= max_chunk:
+            return None, current_chunk + [clean_para]
+    # Finalize current chunk
+    return (" ".join(current_chunk) if current_chunk else None), [clean_para]
+
+# --- Element type rules ---
+
+# Element types (see 'extract_paragraphs_and_tables') dropped before grouping, page furniture rather than content.
+DROPPED_TYPES = {"Footer"}
+
+def grouping_stats(stats: Optional[Dict[str, int]] = None) -> Dict[str, int]:
+    """
+    The counters of the grouping functions, created in 'stats' if given: the LLM calls made, the calls
+    avoided by the element type rules, and the paragraphs dropped by type.
+    """
+    stats = stats if stats is not None else {}
+    for counter in ["llm_calls", "llm_calls_avoided", "dropped_paragraphs"]:
+        stats.setdefault(counter, 0)
+    return stats
+
+def drop_by_type(paragraphs: Iterable[Dict[str, str]], stats: Dict[str, int]) -> Iterator[Dict[str, str]]:
+    """
+    Skip the paragraphs whose element type is in 'DROPPED_TYPES', counted in 'stats["dropped_paragraphs"]'.
+    """
+    for para in paragraphs:
+        if para.get("type") in DROPPED_TYPES:
+            stats["dropped_paragraphs"] += 1
+            continue
+        yield para
+
+def type_rule_decision(
+                       para:                Dict[str, str],
+                       previous_para:       Optional[Dict[str, str]],
+                       min_fragment_chars:  int = 40,
+                       ) -> Optional[bool]:
+    """
+    Decide from the element types whether a paragraph is merged into the current chunk, without the model.
+
+    - The first paragraph starts the first chunk.
+    - A "Title" starts a new chunk.
+    - Consecutive "ListElement"s are merged.
+    - A "Title", or a fragment shorter than 'min_fragment_chars', is merged forward with the paragraph that follows.
+
+    Returns:
+        - Optional[bool] - Whether to merge, None when the boundary is ambiguous and left to the model.
+    """
+    if previous_para is None:
+        return True
+    if para.get("type") == "Title":
+        return False
+    if para.get("type") == "ListElement" and previous_para.get("type") == "ListElement":
+        return True
+    if previous_para.get("type") == "Title" or len(previous_para["text"].strip()) < min_fragment_chars:
+        return True
+    return None
 
 # --- Semantic Grouping Function ---
 
+def iter_semantic_groups(
+                         llm:                      Union[ChatOllama, ChatBedrockConverse],
+                         paragraphs:               Iterable[Dict[str, str]],
+                         max_chunk:                int = 4000,
+                         context_token_budget:     Optional[int] = None,
+                         checkpoint:               Optional[ParagraphCheckpoint] = None,
+                         type_rules:               bool = True,
+                         min_fragment_chars:       int = 40,
+                         stats:                    Optional[Dict[str, int]] = None,
+                         verbose:                  bool = False,
+                         ) -> Iterator[str]:
+    """
+    Groups paragraphs semantically using Ollama LLM with non-sense detection
+    and context window maintenance. See 'semantic_grouping'.
+
+    The paragraphs are consumed lazily and each chunk is yielded as soon as it is finalized,
+    so a streamed document is grouped with the memory of a single chunk. The LLM calls made and
+    avoided are counted in 'stats' (see 'grouping_stats').
+    """
+    stats = grouping_stats(stats)
+    if type_rules:
+        paragraphs = drop_by_type(paragraphs, stats)
+
+    previous_group = None
+    previous_para = None
+    current_chunk = []
+    
+    for i, (para, next_para) in tqdm.tqdm(enumerate(with_lookahead(paragraphs)), desc="Semantic Grouping [File level]"):
+        # Clean paragraph and check length
+        clean_para = para["text"].strip()
+
+        # Decide from the element types, or replay the decision logged before a crash.
+        key = paragraph_key(para, i)
+        merge = type_rule_decision(para, previous_para, min_fragment_chars) if type_rules else None
+        if merge is not None:
+            stats["llm_calls_avoided"] += 1
+        elif checkpoint is not None and key in checkpoint:
+            merge = checkpoint.get(key)
+        else:
+            # Get LLM judgment
+            stats["llm_calls"] += 1
+            prompt_inputs = build_similarity_inputs(
+                previous_group          = previous_group,
+                current_chunk           = current_chunk,
+                new_para                = clean_para,
+                next_para               = next_para["text"].strip() if next_para is not None else None,
+                context_token_budget    = context_token_budget,
+            )
+            response = (similarity_prompt | llm).invoke(prompt_inputs).content.strip().lower()
+
+            if verbose:
+                print("---------------------------------------------------------")
+                print(f"Context: {prompt_inputs['context']}")
+                print(f"Current chunk: {prompt_inputs['joined_current_chunk']}")
+                print(f"New Paragraph: {clean_para}")
+            
+            # remove the text within the <think> </think> tags from the response
+            # and extract only the remaining text
+            if verbose:
+                response = re.sub(r'<think>[\s\S]*?</think>', '', response).strip().lower()
+                print(f"Response: {response}")
+                print("---------------------------------------------------------")
+
+            # Parse response robustly
+            merge = is_merge_response(response)
+            if checkpoint is not None:
+                checkpoint.record(key, merge)
+
+        finished, current_chunk = merge_paragraph(merge, clean_para, current_chunk, max_chunk)
+        previous_para = para
+        if finished is not None:
+            previous_group = finished
+            yield finished
+
+    # Add final chunk
+    if current_chunk:
+        yield " ".join(current_chunk)
+
 def semantic_grouping(
                       llm:                      Union[ChatOllama, ChatBedrockConverse],
                       partially_chunked_file:   Dict[str, str],
                       max_chunk:                int = 4000,
+                      context_token_budget:     Optional[int] = None,
+                      checkpoint:               Optional[ParagraphCheckpoint] = None,
+                      type_rules:               bool = True,
+                      min_fragment_chars:       int = 40,
                       verbose:                  bool = False,
                       ) -> List[Dict[str, str]]:
     """
     Groups paragraphs semantically using Ollama LLM with non-sense detection
     and context window maintenance.
+
+    With 'type_rules', the unambiguous boundaries are decided from the element types of the paragraphs
+    (see 'type_rule_decision') and the footers are dropped, so the LLM is only asked about the others.
+
+    With a 'context_token_budget' the prompt only carries a bounded rolling window of the
+    previous group and the current chunk, so the tokens per decision stay flat instead of
+    growing with the chunk (see 'build_similarity_inputs').
+
+    With a 'checkpoint', every merge decision is logged as soon as the model answers. On resume the
+    logged decisions are replayed, which rebuilds the same chunks, and only the missing ones are asked.
+    The checkpoint must be scoped to the input file, since each decision depends on the previous ones.
     """
-    
-    paragraphs = partially_chunked_file['paragraphs']
-    grouped = []
-    current_chunk = []
-    
-    for i, para in tqdm.tqdm(enumerate(paragraphs), total=len(paragraphs), desc="Semantic Grouping [File level]"):
-        # Clean paragraph and check length
-        clean_para = para["text"].strip()
-            
-        # Get LLM judgment
-        response = (similarity_prompt | llm).invoke({
-            "context": grouped[-1] if grouped else "None. Start of document.",
-            "joined_current_chunk": " ".join(current_chunk) if current_chunk else "None. Start of chunk.",
-            "new_para": clean_para,
-            "next_para": paragraphs[i+1] if i+1 < len(paragraphs) else "None. End of document."
-        }).content.strip().lower()
-
-        if verbose:
-            print("---------------------------------------------------------")
-            print(f"Context: {grouped[-1] if grouped else 'None. Start of document.'}")
-            print(f"Current chunk: {' '.join(current_chunk) if current_chunk else 'None. Start of chunk.'}")
-            print(f"New Paragraph: {clean_para}")
-        
-        # remove the text within the <think> </think> tags from the response
-        # and extract only the remaining text
-        if verbose:
-            response = re.sub(r'<think>[\s\S]*?</think>', '', response).strip().lower()
-            print(f"Response: {response}")
-            print("---------------------------------------------------------")
-
-        # Parse response robustly
-        if any(kw in response for kw in ["true", "merge", "group", "yes", "join", "combine"]):
-            # Check chunk limits
-            new_length = sum(len(p) for p in current_chunk) + len(clean_para)
-            if new_length <= max_chunk:
-                current_chunk.append(clean_para)
-            else:
-                grouped.append(" ".join(current_chunk))
-                current_chunk = [clean_para]
+    stats = grouping_stats()
+    grouped = list(iter_semantic_groups(llm, partially_chunked_file['paragraphs'],
+                                        max_chunk               = max_chunk,
+                                        context_token_budget    = context_token_budget,
+                                        checkpoint              = checkpoint,
+                                        type_rules              = type_rules,
+                                        min_fragment_chars      = min_fragment_chars,
+                                        stats                   = stats,
+                                        verbose                 = verbose))
+    return build_grouping_output(grouped, **stats)
+
+# --- Embedding based Semantic Grouping Function ---
+
+def adjacent_similarities(vectors: np.ndarray) -> np.ndarray:
+    """
+    Cosine similarity between each vector and the next one. Returns an array of len(vectors) - 1.
+    """
+    norms   = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors = vectors / np.where(norms == 0, 1, norms)
+    return np.einsum("ij,ij->i", vectors[:-1], vectors[1:])
+
+def iter_embedding_semantic_groups(
+                                   llm:                      Union[ChatOllama, ChatBedrockConverse],
+                                   embeddings:               Embeddings,
+                                   paragraphs:               Iterable[Dict[str, str]],
+                                   max_chunk:                int = 4000,
+                                   merge_threshold:          float = 0.80,
+                                   split_threshold:          float = 0.60,
+                                   context_token_budget:     Optional[int] = None,
+                                   checkpoint:               Optional[ParagraphCheckpoint] = None,
+                                   embedding_batch_size:     int = 64,
+                                   type_rules:               bool = True,
+                                   min_fragment_chars:       int = 40,
+                                   stats:                    Optional[Dict[str, int]] = None,
+                                   verbose:                  bool = False,
+                                   ) -> Iterator[str]:
+    """
+    Groups paragraphs semantically using the similarity of their embeddings. See 'embedding_semantic_grouping'.
+
+    The paragraphs are consumed lazily and embedded in batches of 'embedding_batch_size', and each chunk
+    is yielded as soon as it is finalized. The LLM calls made and avoided are counted in 'stats' (see
+    'grouping_stats'), a call is avoided when the element types decide an ambiguous boundary.
+    """
+    stats = grouping_stats(stats)
+    if type_rules:
+        paragraphs = drop_by_type(paragraphs, stats)
+
+    previous_group  = None
+    previous_para   = None
+    previous_vector = None
+    current_chunk   = []
+    batch: List[Tuple[int, Dict[str, str], Optional[Dict[str, str]]]] = []
+
+    def group_batch() -> Iterator[str]:
+        nonlocal previous_group, previous_para, previous_vector, current_chunk
+
+        texts   = [para["text"].strip() for _, para, _ in batch]
+        vectors = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+        if previous_vector is not None:
+            similarities = adjacent_similarities(np.vstack([previous_vector, vectors]))
         else:
-            # Finalize current chunk
-            if current_chunk:
-                grouped.append(" ".join(current_chunk))
-            current_chunk = [clean_para]
+            similarities = np.concatenate([[np.nan], adjacent_similarities(vectors)])
+        previous_vector = vectors[-1:]
+
+        for (i, para, next_para), clean_para, similarity in zip(batch, texts, similarities):
+            similarity = float(similarity)
+            key = paragraph_key(para, i)
+            rule = type_rule_decision(para, previous_para, min_fragment_chars) if type_rules else None
+            previous_para = para
+
+            if i == 0:
+                # Start of document.
+                current_chunk = [clean_para]
+                continue
+            elif rule is not None:
+                merge = rule
+                if split_threshold <= similarity < merge_threshold:
+                    stats["llm_calls_avoided"] += 1
+            elif similarity >= merge_threshold:
+                merge = True
+            elif similarity < split_threshold:
+                merge = False
+            elif checkpoint is not None and key in checkpoint:
+                # Ambiguous boundary already decided by the LLM before a crash.
+                merge = checkpoint.get(key)
+            else:
+                # Ambiguous boundary, ask the LLM.
+                stats["llm_calls"] += 1
+                response = (similarity_prompt | llm).invoke(build_similarity_inputs(
+                    previous_group          = previous_group,
+                    current_chunk           = current_chunk,
+                    new_para                = clean_para,
+                    next_para               = next_para["text"].strip() if next_para is not None else None,
+                    context_token_budget    = context_token_budget,
+                )).content.strip().lower()
+                response = re.sub(r'<think>[\s\S]*?</think>', '', response).strip()
+                merge = is_merge_response(response)
+                if checkpoint is not None:
+                    checkpoint.record(key, merge)
+
+            if verbose:
+                print(f"Similarity: {similarity:.3f} - Merge: {merge} - Paragraph: {clean_para[:80]}")
+
+            finished, current_chunk = merge_paragraph(merge, clean_para, current_chunk, max_chunk)
+            if finished is not None:
+                previous_group = finished
+                yield finished
+
+    for i, (para, next_para) in tqdm.tqdm(enumerate(with_lookahead(paragraphs)),
+                                          desc="Semantic Grouping by embeddings [File level]", disable=not verbose):
+        batch.append((i, para, next_para))
+        if len(batch) >= embedding_batch_size:
+            yield from group_batch()
+            batch = []
+    if batch:
+        yield from group_batch()
 
-    # Add final chunk
     if current_chunk:
-        grouped.append(" ".join(current_chunk))
+        yield " ".join(current_chunk)
 
-    grouped = [{"text": chunk, "chunk_id": hashlib.md5(chunk.encode()).hexdigest()} for chunk in grouped]
+def embedding_semantic_grouping(
+                                llm:                      Union[ChatOllama, ChatBedrockConverse],
+                                embeddings:               Embeddings,
+                                partially_chunked_file:   Dict[str, str],
+                                max_chunk:                int = 4000,
+                                merge_threshold:          float = 0.80,
+                                split_threshold:          float = 0.60,
+                                context_token_budget:     Optional[int] = None,
+                                checkpoint:               Optional[ParagraphCheckpoint] = None,
+                                type_rules:               bool = True,
+                                min_fragment_chars:       int = 40,
+                                verbose:                  bool = False,
+                                ) -> List[Dict[str, str]]:
+    """
+    Groups paragraphs semantically using the similarity of their embeddings.
 
-    return {
-            "grouped_paragraphs": grouped,
-            "processing_metadata": {
-                "average_chunk_length": sum(len(c) for c in [g["text"] for g in grouped])//len(grouped) if grouped else 0
-                }
-            }
\ No newline at end of file
+    The paragraphs are embedded in batches, and each paragraph is compared with the previous one:
+    a similarity >= 'merge_threshold' merges it into the current chunk, a similarity < 'split_threshold'
+    starts a new chunk, and only the ambiguous boundaries in between are escalated to the LLM with
+    the same similarity prompt used by 'semantic_grouping'. The output format is the same.
+    With 'type_rules', the element types decide first (see 'type_rule_decision').
+
+    Args:
+        - llm: Union[ChatOllama, ChatBedrockConverse] - The LLM used for the ambiguous boundaries.
+        - embeddings: Embeddings - The embeddings model.
+        - partially_chunked_file: Dict[str, str] - The processed file, with its "paragraphs".
+        - max_chunk: int - The maximum length of the merged chunks. Character wise.
+        - merge_threshold: float - Similarity from which paragraphs are merged without asking the LLM.
+        - split_threshold: float - Similarity under which paragraphs are split without asking the LLM.
+        - context_token_budget: Optional[int] - Token budget of the rolling context sent to the LLM.
+        - checkpoint: Optional[ParagraphCheckpoint] - Log of the LLM decisions to resume from, scoped to the input file.
+        - type_rules: bool - Decide the unambiguous boundaries from the element types, and drop the footers.
+        - min_fragment_chars: int - Paragraphs shorter than this are merged with the paragraph that follows.
+        - verbose: bool - Whether to print the decisions.
+    """
+    stats = grouping_stats()
+    grouped = list(iter_embedding_semantic_groups(llm, embeddings, partially_chunked_file['paragraphs'],
+                                                  max_chunk             = max_chunk,
+                                                  merge_threshold       = merge_threshold,
+                                                  split_threshold       = split_threshold,
+                                                  context_token_budget  = context_token_budget,
+                                                  checkpoint            = checkpoint,
+                                                  type_rules            = type_rules,
+                                                  min_fragment_chars    = min_fragment_chars,
+                                                  stats                 = stats,
+                                                  verbose               = verbose))
+
+    return build_grouping_output(grouped, grouping_strategy="embeddings", **stats)
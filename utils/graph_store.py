@@ -0,0 +1,307 @@
+import os
+import threading
+import numpy as np
+
+from os         import path
+from typing     import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from utils.base_operations.serialization import atomic_write, dumps, loads, save_array, truncate_file
+
+# An edge is a (source entity id, target entity id, document id) int32 triple.
+EDGE_DTYPE = np.dtype([("source", "<i4"), ("target", "<i4"), ("document", "<i4")])
+OFFSET_DTYPE = np.dtype("<i8")
+
+
+class GraphStore:
+    """
+        Corpus-level knowledge graph, persisted in a directory:
+
+        - entities.jsonl: the interned entities (name, type, context), the line number is the entity id.
+        - relations.jsonl: the relation side table (detail, document, chunk id), the line number is the relation
+          id, and relation_offsets.bin: the byte offset of each line, so a relation is read without the others.
+        - edges.bin: the (source, target, document) ids of every relation, appended in place.
+        - documents.json: the live document id of each document. A document appended again gets a new id,
+          which drops its previous relations, and a removed document drops them all.
+        - csr/: out and in adjacency in CSR form (indptr, neighbor ids, relation ids), rebuilt from edges.bin
+          when documents were appended or removed, and memory mapped.
+
+        Only the entity names are held in memory, so building and querying the graph grows with the number
+        of unique entities, not with the relations repeated across the related documents.
+        The documents processed concurrently share one instance per directory, see 'for_directory'.
+    """
+
+    _instances: Dict[str, "GraphStore"] = {}
+    _instances_guard = threading.Lock()
+
+    def __init__(self, directory: str):
+        """
+        Args:
+            - directory: str - Directory of the graph files, created if missing.
+        """
+        self.directory = directory
+        os.makedirs(path.join(directory, "csr"), exist_ok=True)
+
+        self._lock = threading.RLock()
+        self._csr: Optional[Dict[str, np.ndarray]] = None
+
+        self._repair()
+        self.names: List[str] = []
+        self.ids: Dict[str, int] = {}
+        self._entity_offsets: List[int] = []
+        with open(self._path("entities.jsonl"), "a+b") as f:
+            f.seek(0)
+            offset = 0
+            for line in f:
+                self._intern(loads(line)["name"])
+                self._entity_offsets.append(offset)
+                offset += len(line)
+
+        documents = {}
+        if path.exists(self._path("documents.json")):
+            with open(self._path("documents.json"), "rb") as f:
+                documents = loads(f.read())
+        self.documents: Dict[str, int] = documents.get("documents", {})
+        self.next_document_id: int = documents.get("next_document_id", 0)
+
+    @classmethod
+    def for_directory(cls, directory: str) -> "GraphStore":
+        """
+        The shared store of a directory, so concurrent appends intern the entities in the same table.
+        """
+        with cls._instances_guard:
+            key = path.abspath(directory)
+            if key not in cls._instances:
+                cls._instances[key] = cls(directory)
+            return cls._instances[key]
+
+    def _path(self, *parts: str) -> str:
+        return path.join(self.directory, *parts)
+
+    def _repair(self) -> None:
+        # An append interrupted by a crash is dropped: edges.bin is written last, so it sets the number of
+        # relations, and the other files are cut back to it. The relations of the interrupted document
+        # are not live anyway, documents.json is only updated once they are all written.
+        relation_count = path.getsize(self._path("edges.bin")) // EDGE_DTYPE.itemsize if path.exists(self._path("edges.bin")) else 0
+        truncate_file(self._path("edges.bin"), relation_count * EDGE_DTYPE.itemsize)
+        truncate_file(self._path("relation_offsets.bin"), relation_count * OFFSET_DTYPE.itemsize)
+
+        relations_end = 0
+        if relation_count:
+            last_offset = int(np.fromfile(self._path("relation_offsets.bin"), dtype=OFFSET_DTYPE)[-1])
+            with open(self._path("relations.jsonl"), "rb") as f:
+                f.seek(last_offset)
+                relations_end = last_offset + len(f.readline())
+        truncate_file(self._path("relations.jsonl"), relations_end)
+
+        # A half-written last entity.
+        if path.exists(self._path("entities.jsonl")) and path.getsize(self._path("entities.jsonl")):
+            with open(self._path("entities.jsonl"), "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                complete = f.read(1) == b"\n"
+                if not complete:
+                    f.seek(0)
+                    end = f.read().rfind(b"\n") + 1
+            if not complete:
+                truncate_file(self._path("entities.jsonl"), end)
+
+    def _intern(self, name: str) -> int:
+        entity_id = self.ids.get(name)
+        if entity_id is None:
+            entity_id = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return entity_id
+
+    @property
+    def relation_count(self) -> int:
+        """
+        Number of relations appended, live or not.
+        """
+        return path.getsize(self._path("edges.bin")) // EDGE_DTYPE.itemsize if path.exists(self._path("edges.bin")) else 0
+
+    # --- Appends ---
+
+    def add_document(self, document: str, paragraphs: Iterable[Dict[str, Any]]) -> int:
+        """
+        Append the entities and relations of a related document (see 'relate_entities_'), replacing the
+        relations of a previous version of the document. The paragraphs can be streamed.
+
+        Args:
+            - document: str - Path of the related document, its key in the graph.
+            - paragraphs: Iterable[Dict[str, Any]] - The grouped paragraphs, with their "entities" and "relations".
+
+        Returns:
+            - int - The number of relations appended.
+        """
+        document = path.normpath(document)
+        with self._lock:
+            document_id = self.next_document_id
+
+            # The new entities are only interned once written, a failing document leaves the table unchanged.
+            new_entities: List[Dict[str, Any]] = []
+            new_ids: Dict[str, int] = {}
+
+            def entity_id(entity: Dict[str, Any]) -> int:
+                name = entity.get("name", "").strip()
+                if name in self.ids:
+                    return self.ids[name]
+                if name not in new_ids:
+                    new_ids[name] = len(self.names) + len(new_entities)
+                    new_entities.append({"name": name, "type": entity.get("type"), "context": entity.get("context", "")})
+                return new_ids[name]
+
+            relations, edges = [], []
+            for paragraph in paragraphs:
+                for entity in paragraph.get("entities") or []:
+                    if entity.get("name", "").strip():
+                        entity_id(entity)
+                for relation in paragraph.get("relations") or []:
+                    source, target = relation.get("source_entity") or {}, relation.get("target_entity") or {}
+                    if not source.get("name", "").strip() or not target.get("name", "").strip():
+                        continue
+                    edges.append((entity_id(source), entity_id(target), document_id))
+                    relations.append(dumps({"detail":   relation.get("relation_detail", ""),
+                                            "document": document,
+                                            "chunk_id": paragraph.get("chunk_id")}) + b"\n")
+
+            # Entities first, then the side table, and the edges last (see '_repair').
+            with open(self._path("entities.jsonl"), "ab") as f:
+                for entity in new_entities:
+                    self._entity_offsets.append(f.tell())
+                    self._intern(entity["name"])
+                    f.write(dumps(entity) + b"\n")
+            with open(self._path("relations.jsonl"), "ab") as f:
+                start = f.tell()
+                f.write(b"".join(relations))
+            offsets = start + np.concatenate([[0], np.cumsum([len(r) for r in relations[:-1]], dtype=np.int64)]) if relations else []
+            with open(self._path("relation_offsets.bin"), "ab") as f:
+                f.write(np.asarray(offsets, dtype=OFFSET_DTYPE).tobytes())
+            with open(self._path("edges.bin"), "ab") as f:
+                f.write(np.array(edges, dtype=EDGE_DTYPE).tobytes())
+
+            self.documents[document] = document_id
+            self.next_document_id += 1
+            self._save_documents()
+            return len(edges)
+
+    def remove_document(self, document: str) -> None:
+        """
+        Drop the relations of a document, e.g. once its related file was deleted. Its entities stay interned.
+        """
+        with self._lock:
+            if self.documents.pop(path.normpath(document), None) is not None:
+                self._save_documents()
+
+    def _save_documents(self) -> None:
+        atomic_write(self._path("documents.json"), dumps({"documents": self.documents,
+                                                          "next_document_id": self.next_document_id}))
+        self._csr = None
+
+    # --- Adjacency ---
+
+    def _state(self) -> Dict[str, int]:
+        return {"entities": len(self.names), "relations": self.relation_count, "next_document_id": self.next_document_id,
+                "documents": len(self.documents)}
+
+    def build(self) -> None:
+        """
+        Rebuild the CSR adjacency from the live relations. Called by the queries when documents were appended or removed.
+        """
+        with self._lock:
+            edges = np.fromfile(self._path("edges.bin"), dtype=EDGE_DTYPE) if self.relation_count else np.zeros(0, EDGE_DTYPE)
+            live_relations = np.flatnonzero(np.isin(edges["document"], np.fromiter(self.documents.values(), dtype=np.int32)))
+
+            for direction, (origin, neighbor) in {"out": ("source", "target"), "in": ("target", "source")}.items():
+                origins = edges[origin][live_relations]
+                order = np.argsort(origins, kind="stable")
+
+                indptr = np.zeros(len(self.names) + 1, dtype=np.int64)
+                np.cumsum(np.bincount(origins, minlength=len(self.names)), out=indptr[1:])
+                save_array(self._path("csr", f"{direction}_indptr.npy"), indptr)
+                save_array(self._path("csr", f"{direction}_neighbors.npy"), edges[neighbor][live_relations][order])
+                save_array(self._path("csr", f"{direction}_relations.npy"), live_relations[order].astype(np.int64))
+
+            atomic_write(self._path("csr", "state.json"), dumps(self._state()))
+            self._csr = None
+
+    def _adjacency(self) -> Dict[str, np.ndarray]:
+        with self._lock:
+            if self._csr is None:
+                state_path = self._path("csr", "state.json")
+                state = None
+                if path.exists(state_path):
+                    with open(state_path, "rb") as f:
+                        state = loads(f.read())
+                if state != self._state():
+                    self.build()
+                self._csr = {f"{direction}_{array}": np.load(self._path("csr", f"{direction}_{array}.npy"), mmap_mode="r")
+                             for direction in ["out", "in"] for array in ["indptr", "neighbors", "relations"]}
+            return self._csr
+
+    def neighbors(self, name: str, direction: str = "both") -> List[Tuple[str, int]]:
+        """
+        The neighbors of an entity, with the id of the relation to each of them (see 'relation').
+
+        Args:
+            - name: str - The entity name.
+            - direction: str - "out" for the targets of its relations, "in" for their sources, or "both".
+        """
+        if direction not in ["out", "in", "both"]:
+            raise ValueError(f"Invalid neighbor direction: {direction}. Options: 'out', 'in', 'both'.")
+        entity_id = self.ids.get(name.strip())
+        if entity_id is None:
+            return []
+
+        csr = self._adjacency()
+        neighbors = []
+        for d in (["out", "in"] if direction == "both" else [direction]):
+            start, end = csr[f"{d}_indptr"][entity_id], csr[f"{d}_indptr"][entity_id + 1]
+            neighbors.extend((self.names[n], int(r)) for n, r in zip(csr[f"{d}_neighbors"][start:end],
+                                                                     csr[f"{d}_relations"][start:end]))
+        return neighbors
+
+    # --- Side tables ---
+
+    def entity(self, name: str) -> Optional[Dict[str, Any]]:
+        """
+        The interned entity (name, type, and the context it was first seen with).
+        """
+        entity_id = self.ids.get(name.strip())
+        if entity_id is None:
+            return None
+        with open(self._path("entities.jsonl"), "rb") as f:
+            f.seek(self._entity_offsets[entity_id])
+            return loads(f.readline())
+
+    def iter_entities(self) -> Iterator[Dict[str, Any]]:
+        with open(self._path("entities.jsonl"), "rb") as f:
+            for line in f:
+                yield loads(line)
+
+    def relation(self, relation_id: int) -> Dict[str, Any]:
+        """
+        A relation: its source and target names, its detail, and the document and chunk it was extracted from.
+        """
+        offsets = np.memmap(self._path("relation_offsets.bin"), dtype=OFFSET_DTYPE, mode="r")
+        edges   = np.memmap(self._path("edges.bin"), dtype=EDGE_DTYPE, mode="r")
+        with open(self._path("relations.jsonl"), "rb") as f:
+            f.seek(int(offsets[relation_id]))
+            relation = loads(f.readline())
+        return {"source": self.names[edges[relation_id]["source"]], "target": self.names[edges[relation_id]["target"]],
+                **relation}
+
+    def iter_relations(self) -> Iterator[Dict[str, Any]]:
+        """
+        The live relations, in the order they were appended.
+        """
+        live = set(self.documents.values())
+        if not self.relation_count:
+            return
+        edges = np.memmap(self._path("edges.bin"), dtype=EDGE_DTYPE, mode="r")
+        with open(self._path("relations.jsonl"), "rb") as f:
+            for edge, line in zip(edges, f):
+                if int(edge["document"]) in live:
+                    yield {"source": self.names[edge["source"]], "target": self.names[edge["target"]], **loads(line)}
+
+    def stats(self) -> Dict[str, int]:
+        csr = self._adjacency()
+        return {"entities": len(self.names), "relations": len(csr["out_relations"]), "documents": len(self.documents)}
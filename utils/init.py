@@ -1,17 +1,74 @@
 import os
+import json
 import yaml
+import boto3
+import httpx
 
-from typing             import Dict, List, Union
+from typing             import Any, Dict, List, Optional, Union
 from os                 import getenv
 from dotenv             import load_dotenv
-from langchain_aws      import ChatBedrockConverse
-from langchain_ollama   import ChatOllama   
+from botocore.config    import Config
+from langchain_aws      import ChatBedrockConverse, BedrockEmbeddings
+from langchain_ollama   import ChatOllama, OllamaEmbeddings
 
-# Load the environment variables and configs
+from utils.llm_cache        import SQLiteLLMCache
+from utils.ocr_cache        import SQLiteOCRCache
+from utils.rate_limiting    import AdaptiveRateLimiter, RateLimitedChatModel
+from utils.vector_index     import LocalVectorIndex, VectorIndex
+
+# Load the environment variables, configs are loaded lazily on first use.
 load_dotenv()
-with open('config-aws.yaml', 'r') as f:
-    configs = yaml.load(f, Loader=yaml.SafeLoader)
-#print(f"Loaded configs:\n {configs}")
+DEFAULT_CONFIG_PATH = getenv("RAG_CONFIG_PATH", "config-aws.yaml")
+
+class PooledChatOllama(ChatOllama):
+    """
+    ChatOllama whose identifying params include the model and its options.
+    langchain-ollama leaves them out, which would make every Ollama model share the same LLM cache keys.
+    """
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return self.model_dump(exclude_none = True,
+                               exclude      = {"cache", "callbacks", "callback_manager", "rate_limiter",
+                                               "client_kwargs", "sync_client_kwargs", "async_client_kwargs",
+                                               "custom_get_token_ids", "metadata", "tags", "verbose"})
+
+_configs        = None
+_llm_cache      = None
+_ocr_cache      = None
+_llm_registry   = {}
+_bedrock_client = None
+_rate_limiters  = {}
+_embeddings     = None
+_bedrock_embeddings_client = None
+
+def load_configs(config_path: Optional[str] = None) -> Dict:
+    """
+    Load the YAML configs from an explicit path, or from 'RAG_CONFIG_PATH' (defaults to config-aws.yaml).
+    Loading a new config file resets the memoized clients and cache, since they were built from the old one.
+    """
+    global _configs, _llm_cache, _ocr_cache, _llm_registry, _bedrock_client, _rate_limiters, _embeddings
+    global _bedrock_embeddings_client
+
+    with open(config_path or DEFAULT_CONFIG_PATH, 'r') as f:
+        _configs = yaml.load(f, Loader=yaml.SafeLoader)
+
+    _llm_cache      = None
+    _ocr_cache      = None
+    _llm_registry   = {}
+    _bedrock_client = None
+    _rate_limiters  = {}
+    _embeddings     = None
+    _bedrock_embeddings_client = None
+    return _configs
+
+def get_configs() -> Dict:
+    """
+    Get the loaded configs, loading the default config file on first use.
+    """
+    if _configs is None:
+        load_configs()
+    return _configs
 
 def check_env_vars():
     """
@@ -24,38 +81,232 @@ def check_env_vars():
         if var not in os.environ:
             raise Exception(f"Environment variable {var} is not set.")
 
+def get_llm_cache() -> Union[SQLiteLLMCache, None]:
+    """
+    Get the LLM response cache shared by every usecase, built from the 'llm_cache' section of the configs.
+    The 'LLM_CACHE_MODE' environment variable overrides the configured mode, e.g. LLM_CACHE_MODE=replay
+    reruns the pipeline offline without querying the model.
+    """
+    global _llm_cache
+
+    cache_configs = get_configs()["backend"].get("llm_cache", {})
+    if not cache_configs.get("enabled", False):
+        return None
+
+    if _llm_cache is None:
+        _llm_cache = SQLiteLLMCache(
+            database_path   = cache_configs.get("path", ".cache/llm-cache.sqlite"),
+            mode            = getenv("LLM_CACHE_MODE", cache_configs.get("mode", "read_write")),
+            max_entries     = cache_configs.get("max_entries"),
+            max_age_days    = cache_configs.get("max_age_days"),
+        )
+    return _llm_cache
+
+def get_ocr_cache() -> Union[SQLiteOCRCache, None]:
+    """
+    Get the cache of the PDF pages already OCRed, built from the 'ocr_cache' section of the configs.
+    """
+    global _ocr_cache
+
+    cache_configs = get_configs()["backend"].get("ocr_cache", {})
+    if not cache_configs.get("enabled", False):
+        return None
+
+    if _ocr_cache is None:
+        _ocr_cache = SQLiteOCRCache(
+            database_path   = cache_configs.get("path", ".cache/ocr-cache.sqlite"),
+            max_entries     = cache_configs.get("max_entries"),
+            max_size_mb     = cache_configs.get("max_size_mb"),
+        )
+    return _ocr_cache
+
+def get_usecase_setting(usecase: str, key: str, default: Any = None) -> Any:
+    """
+    Get an optional setting of the usecase (e.g. 'max_concurrency', 'paragraphs_per_call'),
+    using the "default" usecase configs when the usecase is not configured.
+    """
+    llm_configs     = get_configs()["backend"]["llm"]
+    usecase_configs = llm_configs.get(usecase, llm_configs["default"])
+    return usecase_configs.get(key, default)
+
+def get_pipeline_setting(key: str, default: Any = None) -> Any:
+    """
+    Get an optional setting of the 'pipeline' section of the configs (e.g. 'document_format').
+    """
+    return get_configs()["backend"].get("pipeline", {}).get(key, default)
+
+def get_max_concurrency(usecase: str = "default") -> int:
+    """
+    Get the maximum number of in-flight LLM requests configured for the usecase.
+    Falls back to 1 (sequential calls) when 'max_concurrency' is not set.
+    """
+    return int(get_usecase_setting(usecase, "max_concurrency", 1))
+
+def get_connection_pool_size() -> int:
+    """
+    Size of the shared HTTP connection pool: enough connections for every usecase
+    running at its configured concurrency at the same time.
+    """
+    return max(10, sum(get_max_concurrency(usecase) for usecase in get_configs()["backend"]["llm"]))
+
+def get_bedrock_client():
+    """
+    Get the bedrock-runtime client shared by every Bedrock model, with keep-alive
+    and a connection pool sized to the configured concurrency.
+    botocore's own retries are disabled, so throttling reaches the adaptive rate limiter.
+    """
+    global _bedrock_client
+
+    if _bedrock_client is None:
+        check_env_vars()
+        _bedrock_client = boto3.client(
+            "bedrock-runtime",
+            region_name = getenv("AWS_REGION"),
+            config      = Config(
+                max_pool_connections    = get_connection_pool_size(),
+                tcp_keepalive           = True,
+                retries                 = {"mode": "standard", "total_max_attempts": 1},
+            )
+        )
+    return _bedrock_client
+
+def get_bedrock_embeddings_client():
+    """
+    Get the bedrock-runtime client of the embeddings model. The embeddings are not behind the adaptive rate
+    limiter of the chat models, so this client keeps botocore's adaptive retries: throttled embedding requests
+    are retried with backoff (up to 'max_retries' of the 'embeddings' configs) instead of failing the stage.
+    """
+    global _bedrock_embeddings_client
+
+    if _bedrock_embeddings_client is None:
+        check_env_vars()
+        max_retries = get_configs()["backend"]["embeddings"].get("max_retries", 6)
+        _bedrock_embeddings_client = boto3.client(
+            "bedrock-runtime",
+            region_name = getenv("AWS_REGION"),
+            config      = Config(
+                max_pool_connections    = get_connection_pool_size(),
+                tcp_keepalive           = True,
+                retries                 = {"mode": "adaptive", "total_max_attempts": max_retries + 1},
+            )
+        )
+    return _bedrock_embeddings_client
+
+def get_rate_limiter(model_name: str) -> AdaptiveRateLimiter:
+    """
+    Get the rate limiter of a model, built from its entry in the 'rate_limits' section of the configs.
+    Quotas are per model, so every usecase running the same model shares the limiter.
+    """
+    if model_name not in _rate_limiters:
+        limits = get_configs()["backend"].get("rate_limits", {}).get(model_name, {})
+        _rate_limiters[model_name] = AdaptiveRateLimiter(
+            requests_per_minute = limits.get("requests_per_minute"),
+            tokens_per_minute   = limits.get("tokens_per_minute"),
+            max_concurrency     = limits.get("max_concurrency", get_connection_pool_size()),
+        )
+    return _rate_limiters[model_name]
+
 def get_llm(usecase: str = "default") -> Union[ChatBedrockConverse, ChatOllama]:
     """
-    Initialize the LLM API based on the usecase.
+    Initialize the LLM API based on the usecase, or on the "default" usecase when it is not configured.
+
+    Models are memoized per (provider, model, parameters), so usecases sharing a model
+    share the same client and its connection pool instead of opening new connections.
+    Every model is wrapped by a RateLimitedChatModel enforcing the model's 'rate_limits'.
     """
 
     allowed_usecases = ["default", "semantic_grouping",
                         "summary", "extract_entity_types",
-                        "extract_entities", "relate_entities"]
+                        "extract_entities", "relate_entities",
+                        "community_summary"]
 
     if usecase not in allowed_usecases:
         raise Exception(f"Invalid LLM usecase: {usecase}. Allowed values are: {allowed_usecases}")
-    
-    provider    = configs["backend"]["llm"][usecase]["provider"]
-    model_name  = configs["backend"]["llm"][usecase]["model_name"]
-    parameters  = configs["backend"]["llm"][usecase]["parameters"]
+
+    # The usecases that are not configured use the "default" usecase, as in 'get_usecase_setting'.
+    llm_configs     = get_configs()["backend"]["llm"]
+    usecase_configs = llm_configs.get(usecase, llm_configs["default"])
+    provider        = usecase_configs["provider"]
+    model_name      = usecase_configs["model_name"]
+    parameters      = usecase_configs.get("parameters", {})
+
+    registry_key = (provider, model_name, json.dumps(parameters, sort_keys=True))
+    if registry_key in _llm_registry:
+        return _llm_registry[registry_key]
+
+    cache = get_llm_cache()
 
     # Initialize the AWS LLM Converse API
     if  provider == 'aws':
-        check_env_vars()
         LLM = ChatBedrockConverse(
-            model = model_name,
+            model  = model_name,
+            client = get_bedrock_client(),
+            cache  = cache,
             **parameters
         )
-    
+
     # Initialize the Ollama API
     elif provider == 'ollama':
-        LLM = ChatOllama(
-            model = model_name,
+        pool_size = get_connection_pool_size()
+        LLM = PooledChatOllama(
+            model         = model_name,
+            cache         = cache,
+            client_kwargs = {"limits": httpx.Limits(max_connections=pool_size,
+                                                    max_keepalive_connections=pool_size)},
             **parameters
         )
 
     else:
         raise Exception("Invalid LLM provider in the configs.")
 
-    return LLM
\ No newline at end of file
+    max_retries = get_configs()["backend"].get("rate_limits", {}).get(model_name, {}).get("max_retries", 6)
+    LLM = RateLimitedChatModel(LLM, get_rate_limiter(model_name), max_retries=max_retries)
+
+    _llm_registry[registry_key] = LLM
+    return LLM
+
+
+def get_embeddings() -> Union[BedrockEmbeddings, OllamaEmbeddings]:
+    """
+    Initialize the embeddings model configured in the 'embeddings' section of the configs.
+    """
+    global _embeddings
+
+    if _embeddings is not None:
+        return _embeddings
+
+    provider    = get_configs()["backend"]["embeddings"]["provider"]
+    model_name  = get_configs()["backend"]["embeddings"]["model_name"]
+
+    if provider == 'aws':
+        _embeddings = BedrockEmbeddings(
+            model_id = model_name,
+            client   = get_bedrock_embeddings_client(),
+        )
+
+    elif provider == 'ollama':
+        _embeddings = OllamaEmbeddings(
+            model = model_name,
+        )
+
+    else:
+        raise Exception("Invalid embeddings provider in the configs.")
+
+    return _embeddings
+
+def get_vector_index(data_dir: str) -> VectorIndex:
+    """
+    Get the vector index of the chunks configured in the 'vector_db' section of the configs.
+    The "local" provider keeps the index in "<data_dir>/<path>", shared by every caller of the directory.
+    """
+    configs  = get_configs()["backend"].get("vector_db", {})
+    provider = configs.get("provider", "local")
+
+    if provider == "local":
+        return LocalVectorIndex.for_directory(
+            os.path.join(data_dir, configs.get("path", "vector-index")),
+            nprobe              = configs.get("nprobe", 8),
+            ivf_min_vectors     = configs.get("ivf_min_vectors", 4096),
+        )
+
+    raise Exception(f"Invalid vector_db provider in the configs: {provider}. Allowed values are: ['local']")
@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from typing                 import Any, Dict, Optional
+from langchain_core.caches  import BaseCache, RETURN_VAL_TYPE
+from langchain_core.load    import dumps, loads
+
+
+CACHE_MODES = ["read_write", "record", "replay"]
+
+
+class CacheMissError(Exception):
+    """
+    Raised in "replay" mode when a prompt is not in the cache, so the pipeline never reaches the model.
+    """
+
+
+class SQLiteLLMCache(BaseCache):
+    """
+        Persistent, content-addressed cache for LLM responses, shared by every pipeline stage.
+
+        Entries are keyed on the sha256 of the LLM string (model name + parameters, as serialized by langchain)
+        and the fully rendered prompt, so changing a prompt template, model or temperature is a natural miss.
+
+        Modes:
+            - "read_write": Serve hits from the cache and store every new response (default).
+            - "record":     Always query the model and overwrite the stored responses.
+            - "replay":     Never query the model, a miss raises CacheMissError. Useful to rerun offline.
+    """
+
+    def __init__(
+                    self,
+                    database_path:  str,
+                    mode:           str = "read_write",
+                    max_entries:    Optional[int] = None,
+                    max_age_days:   Optional[float] = None,
+                ):
+        """
+        Args:
+            - database_path: str - Path of the SQLite database file, created if missing.
+            - mode: str - One of "read_write", "record", "replay".
+            - max_entries: Optional[int] - Keep at most this many entries, evicting the least recently used.
+            - max_age_days: Optional[float] - Drop entries older than this many days.
+        """
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Invalid LLM cache mode: {mode}. Allowed values are: {CACHE_MODES}")
+
+        self.database_path  = database_path
+        self.mode           = mode
+        self.max_entries    = max_entries
+        self.max_age_days   = max_age_days
+
+        self.hits   = 0
+        self.misses = 0
+        self.writes = 0
+
+        directory = os.path.dirname(database_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # One connection shared by the threads of the concurrent stages, guarded by a lock.
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(database_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                key             TEXT PRIMARY KEY,
+                response        TEXT NOT NULL,
+                created_at      REAL NOT NULL,
+                last_access_at  REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_last_access ON llm_cache (last_access_at)")
+        self._conn.commit()
+
+        self.evict()
+
+    @staticmethod
+    def _key(prompt: str, llm_string: str) -> str:
+        return hashlib.sha256(f"{llm_string}\x00{prompt}".encode()).hexdigest()
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        """
+        Look up the response for the prompt and LLM string.
+        """
+        if self.mode == "record":
+            return None
+
+        key = self._key(prompt, llm_string)
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row:
+                self.hits += 1
+                self._conn.execute("UPDATE llm_cache SET last_access_at = ? WHERE key = ?", (time.time(), key))
+                self._conn.commit()
+            else:
+                self.misses += 1
+
+        if row:
+            generations = [loads(generation) for generation in json.loads(row[0])]
+            # Mark cached messages, so rate limiters don't count them against the provider quotas.
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                if message is not None:
+                    message.response_metadata["cache_hit"] = True
+            return generations
+
+        if self.mode == "replay":
+            raise CacheMissError(f"Prompt not found in the LLM cache ({self.database_path}) while in replay mode.")
+
+        return None
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        """
+        Store the response for the prompt and LLM string.
+        """
+        if self.mode == "replay":
+            return
+
+        key         = self._key(prompt, llm_string)
+        response    = json.dumps([dumps(generation) for generation in return_val])
+        now         = time.time()
+
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, response, created_at, last_access_at) VALUES (?, ?, ?, ?)",
+                (key, response, now, now)
+            )
+            self._conn.commit()
+            self.writes += 1
+            evict_now = self.max_entries is not None and self.writes % 100 == 0
+
+        if evict_now:
+            self.evict()
+
+    def evict(self) -> int:
+        """
+        Drop the entries older than 'max_age_days' and the least recently used ones above 'max_entries'.
+        Returns the number of evicted entries.
+        """
+        evicted = 0
+        with self._lock:
+            if self.max_age_days is not None:
+                oldest_allowed = time.time() - self.max_age_days * 24 * 3600
+                evicted += self._conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (oldest_allowed,)).rowcount
+
+            if self.max_entries is not None:
+                evicted += self._conn.execute(
+                    """
+                    DELETE FROM llm_cache WHERE key IN (
+                        SELECT key FROM llm_cache ORDER BY last_access_at DESC LIMIT -1 OFFSET ?
+                    )
+                    """,
+                    (self.max_entries,)
+                ).rowcount
+
+            self._conn.commit()
+        return evicted
+
+    def clear(self, **kwargs: Any) -> None:
+        """
+        Remove every entry from the cache.
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM llm_cache")
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Hit/miss counters of this process, plus the number of stored entries.
+        """
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+
+        lookups = self.hits + self.misses
+        return {
+            "mode":     self.mode,
+            "hits":     self.hits,
+            "misses":   self.misses,
+            "writes":   self.writes,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries":  entries,
+        }
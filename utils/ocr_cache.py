@@ -0,0 +1,192 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from typing             import Any, Dict, List, Optional
+from pdf2image          import convert_from_path
+
+
+class SQLiteOCRCache:
+    """
+        Persistent cache of the elements extracted from PDF pages by OCR / layout inference.
+
+        Entries are keyed on the sha256 of the rendered page image and of the extraction settings
+        (strategy, languages, table inference, unstructured version), so identical pages are only
+        OCRed once: across reruns, across versions of a document, and across documents sharing pages
+        (covers, safety notices, appendices). Changing a setting is a natural miss.
+
+        The least recently used entries are evicted above 'max_entries' or 'max_size_mb' of elements.
+        The cache can be sent to worker processes: each process opens its own connection.
+    """
+
+    def __init__(
+                    self,
+                    database_path:  str,
+                    max_entries:    Optional[int] = None,
+                    max_size_mb:    Optional[float] = None,
+                    render_dpi:     int = 100,
+                ):
+        """
+        Args:
+            - database_path: str - Path of the SQLite database file, created if missing.
+            - max_entries: Optional[int] - Keep at most this many pages, evicting the least recently used.
+            - max_size_mb: Optional[float] - Keep at most this many megabytes of elements, evicting the least recently used.
+            - render_dpi: int - Resolution of the page images that are hashed, high enough to tell apart small text changes.
+        """
+        self.database_path  = database_path
+        self.max_entries    = max_entries
+        self.max_size_mb    = max_size_mb
+        self.render_dpi     = render_dpi
+
+        self.hits   = 0
+        self.misses = 0
+        self.writes = 0
+
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Connections and locks don't cross process boundaries, the worker opens its own.
+        state = self.__dict__.copy()
+        state["_lock"], state["_conn"] = None, None
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.database_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+            # WAL mode lets the worker processes read while another one writes.
+            self._conn = sqlite3.connect(self.database_path, check_same_thread=False, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS ocr_cache (
+                    key             TEXT PRIMARY KEY,
+                    elements        TEXT NOT NULL,
+                    size            INTEGER NOT NULL,
+                    created_at      REAL NOT NULL,
+                    last_access_at  REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_ocr_cache_last_access ON ocr_cache (last_access_at)")
+            self._conn.commit()
+        return self._conn
+
+    def page_keys(self, file_path: str, page_count: int, settings: Dict[str, Any]) -> List[str]:
+        """
+        Cache keys of the pages of a PDF: the rendered page images hashed with the extraction settings.
+        Pages are rendered one at a time, so memory is bounded by a single page image.
+        """
+        settings_hash = hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
+        keys = []
+        for page_number in range(1, page_count + 1):
+            image = convert_from_path(file_path, dpi=self.render_dpi, first_page=page_number, last_page=page_number)[0]
+            image_hash = hashlib.sha256(f"{image.mode}:{image.size}".encode() + image.tobytes()).hexdigest()
+            keys.append(hashlib.sha256(f"{image_hash}\x00{settings_hash}".encode()).hexdigest())
+        return keys
+
+    def get(self, key: str) -> Optional[List[Dict[str, Any]]]:
+        """
+        The cached elements of a page, as unstructured element dicts.
+        """
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute("SELECT elements FROM ocr_cache WHERE key = ?", (key,)).fetchone()
+            if row:
+                self.hits += 1
+                conn.execute("UPDATE ocr_cache SET last_access_at = ? WHERE key = ?", (time.time(), key))
+                conn.commit()
+            else:
+                self.misses += 1
+
+        return json.loads(row[0]) if row else None
+
+    def put(self, key: str, elements: List[Dict[str, Any]]) -> None:
+        """
+        Store the elements of a page, as unstructured element dicts.
+        """
+        value   = json.dumps(elements, ensure_ascii=False)
+        now     = time.time()
+
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO ocr_cache (key, elements, size, created_at, last_access_at) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value.encode()), now, now)
+            )
+            conn.commit()
+            self.writes += 1
+            evict_now = self.writes % 100 == 0
+
+        if evict_now:
+            self.evict()
+
+    def evict(self) -> int:
+        """
+        Drop the least recently used entries above 'max_entries' and 'max_size_mb'.
+        Returns the number of evicted entries.
+        """
+        evicted = 0
+        with self._lock:
+            conn = self._connection()
+            if self.max_entries is not None:
+                evicted += conn.execute(
+                    """
+                    DELETE FROM ocr_cache WHERE key IN (
+                        SELECT key FROM ocr_cache ORDER BY last_access_at DESC LIMIT -1 OFFSET ?
+                    )
+                    """,
+                    (self.max_entries,)
+                ).rowcount
+
+            if self.max_size_mb is not None:
+                # Keep the most recently used entries whose cumulated size fits in the limit.
+                evicted += conn.execute(
+                    """
+                    DELETE FROM ocr_cache WHERE key IN (
+                        SELECT key FROM (
+                            SELECT key, SUM(size) OVER (ORDER BY last_access_at DESC, key) AS cumulated_size FROM ocr_cache
+                        ) WHERE cumulated_size > ?
+                    )
+                    """,
+                    (int(self.max_size_mb * 1024 * 1024),)
+                ).rowcount
+
+            conn.commit()
+        return evicted
+
+    def clear(self) -> None:
+        """
+        Remove every entry from the cache.
+        """
+        with self._lock:
+            conn = self._connection()
+            conn.execute("DELETE FROM ocr_cache")
+            conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Hit/miss counters of this process, plus the number and size of the stored entries.
+        """
+        with self._lock:
+            entries, size = self._connection().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM ocr_cache").fetchone()
+
+        lookups = self.hits + self.misses
+        return {
+            "hits":     self.hits,
+            "misses":   self.misses,
+            "writes":   self.writes,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries":  entries,
+            "size_mb":  size / (1024 * 1024),
+        }
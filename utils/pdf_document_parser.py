@@ -1,24 +1,142 @@
-from typing import List, Tuple
+import os
+import math
+import signal
+import tempfile
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+from pypdf import PdfReader, PdfWriter
+from unstructured.__version__ import __version__ as unstructured_version
+from unstructured.chunking.title import chunk_by_title
 from unstructured.partition.pdf import partition_pdf
-from unstructured.documents.elements import Text, Table, Image, Title, FigureCaption, NarrativeText, ListItem, Header, Footer
+from unstructured.staging.base import elements_from_dicts, elements_to_dicts
+from unstructured.documents.elements import Element, Text, Table, Image, Title, FigureCaption, NarrativeText, ListItem, Header, Footer
 
-def extract_paragraphs_and_tables(file_path: str, 
-                                  image_output_dir_path: str) -> Tuple[List[dict], List[str]]:
-    """
-    Extracts paragraphs with metadata and tables from a PDF document
-    """
-    elements = partition_pdf(
+from utils.ocr_cache import SQLiteOCRCache
+from utils.pdf_page_classifier import classify_pages, page_runs
+
+# partition_pdf strategy of each page kind: "fast" reads the text layer with pdfminer,
+# "hi_res" runs the layout model, OCR and the table structure inference.
+PAGE_KIND_STRATEGIES = {"text": "fast", "ocr": "hi_res"}
+
+# partition_pdf settings shared by every strategy, part of the OCR cache keys.
+PARTITION_SETTINGS = {
+    "infer_table_structure": True,
+    "languages": ["en", "es"],
+}
+
+
+def _paragraph(element: Text, element_type: str) -> dict:
+    return {
+        "text": element.text.strip(),
+        "type": element_type,
+        "page_number": element.metadata.page_number,
+    }
+
+
+def _write_page_range(reader: PdfReader, first_page: int, last_page: int, output_path: str) -> None:
+    writer = PdfWriter()
+    for page in reader.pages[first_page - 1:last_page]:
+        writer.add_page(page)
+    with open(output_path, "wb") as f:
+        writer.write(f)
+
+
+def _partition_settings(extract_table_images: bool) -> Dict:
+    if extract_table_images:
+        return {**PARTITION_SETTINGS, "extract_image_block_types": ["Table"]}
+    return PARTITION_SETTINGS
+
+
+def _partition_elements(file_path: str,
+                        image_output_dir_path: str,
+                        strategy: str,
+                        starting_page_number: int,
+                        extract_table_images: bool = False) -> List[Element]:
+    return partition_pdf(
         filename=file_path,
-        #strategy="hi_res",
-        strategy="auto",
-        infer_table_structure=True,
-        extract_image_block_types=["Table"],
-        languages=["en", "es"],
+        strategy=strategy,
         image_output_dir_path=image_output_dir_path,
-        chunking_strategy="by_title",
-        combine_text_under_n_chars = 500,
+        starting_page_number=starting_page_number,
+        **_partition_settings(extract_table_images),
     )
 
+
+def _cached_partition_elements(file_path: str,
+                               image_output_dir_path: str,
+                               strategy: str,
+                               starting_page_number: int,
+                               ocr_cache: SQLiteOCRCache,
+                               extract_table_images: bool = False) -> List[Element]:
+    """
+    Partition a PDF page by page through the OCR cache: cached pages are reused, and only the
+    runs of consecutive missing pages are partitioned, then cached.
+    """
+    page_count = count_pages(file_path)
+    try:
+        keys = ocr_cache.page_keys(file_path, page_count, {"strategy": strategy, "unstructured": unstructured_version,
+                                                           **_partition_settings(extract_table_images)})
+    except Exception as e:
+        # Pages that can't be rendered (e.g. poppler is missing) are not cached.
+        print(f"Could not render the pages of {file_path} for the OCR cache: {type(e).__name__}: {e}")
+        return _partition_elements(file_path, image_output_dir_path, strategy, starting_page_number, extract_table_images)
+
+    elements_by_page: Dict[int, List[Element]] = {}
+    for page, key in enumerate(keys, start=1):
+        cached = ocr_cache.get(key)
+        if cached is not None:
+            elements_by_page[page] = elements_from_dicts(cached)
+            # The same page can be at another position of another document.
+            for element in elements_by_page[page]:
+                element.metadata.page_number = starting_page_number + page - 1
+
+    misses = page_runs(["hit" if page in elements_by_page else "miss" for page in range(1, page_count + 1)])
+    reader = PdfReader(file_path)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for _, first_page, last_page in [run for run in misses if run[0] == "miss"]:
+            if first_page == 1 and last_page == page_count:
+                range_path = file_path
+            else:
+                range_path = os.path.join(temp_dir, f"pages-{first_page}-{last_page}.pdf")
+                _write_page_range(reader, first_page, last_page, range_path)
+
+            elements = _partition_elements(range_path, image_output_dir_path, strategy, starting_page_number + first_page - 1,
+                                           extract_table_images)
+            for page in range(first_page, last_page + 1):
+                page_number = starting_page_number + page - 1
+                elements_by_page[page] = [element for element in elements if element.metadata.page_number == page_number]
+                ocr_cache.put(keys[page - 1], elements_to_dicts(elements_by_page[page]))
+
+    return [element for page in sorted(elements_by_page) for element in elements_by_page[page]]
+
+
+def partition_paragraphs_and_tables(file_path: str,
+                                    image_output_dir_path: str,
+                                    strategy: str = "auto",
+                                    starting_page_number: int = 1,
+                                    ocr_cache: Optional[SQLiteOCRCache] = None,
+                                    extract_table_images: bool = False,
+                                    chunk_elements: bool = True) -> Tuple[List[dict], List[str]]:
+    """
+    Extracts paragraphs with metadata and tables from a PDF document with a single partition_pdf strategy
+
+    Args:
+        - ocr_cache: Optional[SQLiteOCRCache] - Reuse the elements of the pages already OCRed, for every strategy but "fast".
+        - extract_table_images: bool - Save an image of every table in 'image_output_dir_path'.
+        - chunk_elements: bool - Combine the elements in chunks of up to 500 characters under each title. The chunks
+                                 are all typed "Text", so the element types (Title, ListElement, Footer...) are
+                                 only kept without it.
+    """
+    if ocr_cache is not None and strategy != "fast":
+        elements = _cached_partition_elements(file_path, image_output_dir_path, strategy, starting_page_number, ocr_cache,
+                                              extract_table_images)
+    else:
+        elements = _partition_elements(file_path, image_output_dir_path, strategy, starting_page_number, extract_table_images)
+
+    # Chunked after partitioning (instead of by partition_pdf) so cached and fresh pages are chunked together.
+    if chunk_elements:
+        elements = chunk_by_title(elements, combine_text_under_n_chars=500)
+
     paragraphs = []
     tables = []
 
@@ -30,62 +148,249 @@ def extract_paragraphs_and_tables(file_path: str,
             continue
 
         elif isinstance(element, Title):
-            element_type = 'Title'
-            clean_text = element.text.strip()
-            paragraphs.append({
-                "text": clean_text,
-                "type": element_type,
-            })
+            paragraphs.append(_paragraph(element, 'Title'))
 
         elif isinstance(element, Header):
-            element_type = 'Header'
-            clean_text = element.text.strip()
-            paragraphs.append({
-                "text": clean_text,
-                "type": element_type,
-            })
-        
+            paragraphs.append(_paragraph(element, 'Header'))
+
         elif isinstance(element, Footer):
-            element_type = 'Footer'
-            clean_text = element.text.strip()
-            paragraphs.append({
-                "text": clean_text,
-                "type": element_type,
-            })
-            
+            paragraphs.append(_paragraph(element, 'Footer'))
+
         elif isinstance(element, FigureCaption):
-            element_type = 'FigureCaption'
-            clean_text = element.text.strip()
-            paragraphs.append({
-                "text": clean_text,
-                "type": element_type,
-            })
-            
+            paragraphs.append(_paragraph(element, 'FigureCaption'))
+
         elif isinstance(element, NarrativeText):
-            element_type = 'NarrativeText'
-            clean_text = element.text.strip()
-            paragraphs.append({
-                "text": clean_text,
-                "type": element_type,
-            })
-            
+            paragraphs.append(_paragraph(element, 'NarrativeText'))
+
         elif isinstance(element, ListItem):
-            element_type = 'ListElement'
-            clean_text = element.text.strip()
-            paragraphs.append({
-                "text": clean_text,
-                "type": element_type,
-            })
-            
+            paragraphs.append(_paragraph(element, 'ListElement'))
+
         elif isinstance(element, Text):
             # Extract element type from metadata
-            element_type = 'Text'
-            clean_text = element.text.strip()
+            if len(element.text.strip()) > 5:
+                paragraphs.append(_paragraph(element, 'Text'))
+
+    return paragraphs, tables
+
+
+def extract_paragraphs_and_tables(file_path: str,
+                                  image_output_dir_path: str,
+                                  starting_page_number: int = 1,
+                                  text_layer_fast_path: bool = True,
+                                  ocr_cache: Optional[SQLiteOCRCache] = None,
+                                  extract_table_images: bool = False,
+                                  chunk_elements: bool = True) -> Tuple[List[dict], List[str]]:
+    """
+    Extracts paragraphs with metadata and tables from a PDF document
+
+    With 'text_layer_fast_path', every page is classified from its pdfminer text layer: runs of born-digital
+    pages are read from that layer directly, and only scanned pages, pages with an unusable text layer and
+    pages that likely hold tables go through the layout model and OCR.
+
+    Args:
+        - file_path: str - The PDF file, or a page range of a larger PDF (see 'extract_page_range').
+        - image_output_dir_path: str - Where the images of the tables are saved, with 'extract_table_images'.
+        - starting_page_number: int - Page number of the first page of the file in the original PDF.
+        - text_layer_fast_path: bool - Only OCR the pages without a usable text layer, instead of
+                                       letting partition_pdf pick one strategy for the whole file.
+        - ocr_cache: Optional[SQLiteOCRCache] - Reuse the elements of the pages already OCRed, keyed on their image.
+        - extract_table_images: bool - Save an image of every table, off by default as it is slow and rarely used.
+        - chunk_elements: bool - See 'partition_paragraphs_and_tables'.
+    """
+    if not text_layer_fast_path:
+        return partition_paragraphs_and_tables(file_path, image_output_dir_path, "auto", starting_page_number, ocr_cache,
+                                               extract_table_images, chunk_elements)
+
+    runs = page_runs(classify_pages(file_path))
+    if len(runs) <= 1:
+        strategy = PAGE_KIND_STRATEGIES[runs[0][0]] if runs else "fast"
+        return partition_paragraphs_and_tables(file_path, image_output_dir_path, strategy, starting_page_number, ocr_cache,
+                                               extract_table_images, chunk_elements)
+
+    paragraphs, tables = [], []
+    reader = PdfReader(file_path)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for kind, first_page, last_page in runs:
+            run_path = os.path.join(temp_dir, f"{kind}-pages-{first_page}-{last_page}.pdf")
+            _write_page_range(reader, first_page, last_page, run_path)
+            run_paragraphs, run_tables = partition_paragraphs_and_tables(run_path,
+                                                                         image_output_dir_path,
+                                                                         PAGE_KIND_STRATEGIES[kind],
+                                                                         starting_page_number + first_page - 1,
+                                                                         ocr_cache,
+                                                                         extract_table_images,
+                                                                         chunk_elements)
+            paragraphs.extend(run_paragraphs)
+            tables.extend(run_tables)
+
+    return paragraphs, tables
+
+
+def count_pages(file_path: str) -> int:
+    """
+    Number of pages of a PDF, read from its page tree without parsing the pages.
+    """
+    return len(PdfReader(file_path).pages)
+
+
+def _on_page_timeout(signum, frame):
+    raise TimeoutError("PDF page range parsing timed out")
+
+
+def extract_page_range(file_path: str,
+                       image_output_dir_path: str,
+                       first_page: int,
+                       last_page: int,
+                       page_timeout: Optional[float] = None,
+                       text_layer_fast_path: bool = True,
+                       ocr_cache: Optional[SQLiteOCRCache] = None,
+                       extract_table_images: bool = False,
+                       chunk_elements: bool = True) -> Tuple[List[dict], List[str]]:
+    """
+    Extracts paragraphs and tables from the pages 'first_page' to 'last_page' (1-based, inclusive) of a PDF.
+    Runs in the worker processes of 'extract_pdfs_concurrently', so it only takes picklable arguments.
+
+    Args:
+        - page_timeout: Optional[float] - Seconds allowed per page, the range fails with a TimeoutError after
+                                          'page_timeout' times its number of pages. Unix only, ignored elsewhere.
+        - text_layer_fast_path: bool - See 'extract_paragraphs_and_tables'.
+        - ocr_cache: Optional[SQLiteOCRCache] - See 'extract_paragraphs_and_tables'.
+        - extract_table_images: bool - See 'extract_paragraphs_and_tables'.
+        - chunk_elements: bool - See 'partition_paragraphs_and_tables'.
+    """
+    use_alarm = page_timeout is not None and hasattr(signal, "SIGALRM")
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _on_page_timeout)
+        signal.alarm(max(1, math.ceil(page_timeout * (last_page - first_page + 1))))
+
+    try:
+        reader = PdfReader(file_path)
+        if first_page == 1 and last_page == len(reader.pages):
+            return extract_paragraphs_and_tables(file_path, image_output_dir_path,
+                                                 text_layer_fast_path=text_layer_fast_path, ocr_cache=ocr_cache,
+                                                 extract_table_images=extract_table_images, chunk_elements=chunk_elements)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            range_path = os.path.join(temp_dir, f"pages-{first_page}-{last_page}.pdf")
+            _write_page_range(reader, first_page, last_page, range_path)
+            return extract_paragraphs_and_tables(range_path, image_output_dir_path, starting_page_number=first_page,
+                                                 text_layer_fast_path=text_layer_fast_path, ocr_cache=ocr_cache,
+                                                 extract_table_images=extract_table_images, chunk_elements=chunk_elements)
+    finally:
+        if use_alarm:
+            signal.alarm(0)
+
+
+def page_ranges(page_count: int, pages_per_shard: int) -> List[Tuple[int, int]]:
+    """
+    Split the pages of a PDF in consecutive (first page, last page) ranges of at most 'pages_per_shard' pages.
+    """
+    pages_per_shard = max(1, pages_per_shard)
+    return [(first, min(first + pages_per_shard - 1, page_count)) for first in range(1, page_count + 1, pages_per_shard)]
+
+
+def iter_paragraphs_and_tables(
+                                file_path:              str,
+                                image_output_dir_path:  str,
+                                pages_per_batch:        int = 25,
+                                text_layer_fast_path:   bool = True,
+                                ocr_cache:              Optional[SQLiteOCRCache] = None,
+                                extract_table_images:   bool = False,
+                                chunk_elements:         bool = True,
+                                ) -> Iterator[Tuple[str, Union[dict, str]]]:
+    """
+    Stream the paragraphs and tables of a PDF, parsed 'pages_per_batch' pages at a time, so memory is bounded
+    by a batch of pages instead of the whole document, however long it is.
+
+    Args:
+        - pages_per_batch: int - Number of pages partitioned at once.
+        - The other arguments: See 'extract_paragraphs_and_tables'.
+
+    Yields:
+        - Tuple[str, Union[dict, str]] - ("paragraphs", paragraph) and ("tables", HTML table) records, in page order.
+    """
+    for first_page, last_page in page_ranges(count_pages(file_path), pages_per_batch):
+        paragraphs, tables = extract_page_range(file_path, image_output_dir_path, first_page, last_page,
+                                                text_layer_fast_path=text_layer_fast_path, ocr_cache=ocr_cache,
+                                                extract_table_images=extract_table_images, chunk_elements=chunk_elements)
+        for paragraph in paragraphs:
+            yield "paragraphs", paragraph
+        for table in tables:
+            yield "tables", table
+
+
+def extract_pdfs_concurrently(
+                                files:                  Dict[str, str],
+                                max_workers:            int = os.cpu_count() or 1,
+                                pages_per_shard:        int = 25,
+                                page_timeout:           Optional[float] = 120,
+                                text_layer_fast_path:   bool = True,
+                                ocr_cache:              Optional[SQLiteOCRCache] = None,
+                                extract_table_images:   bool = False,
+                                chunk_elements:         bool = True,
+                                ) -> Iterator[Tuple[str, Union[Tuple[List[dict], List[str]], Exception]]]:
+    """
+    Parse PDFs with a pool of processes. Large PDFs are split in page ranges parsed in parallel,
+    then stitched back in page order, so a single long manual also uses every core.
+
+    A failing or timed out page range fails its file only, the other files go on.
+
+    Args:
+        - files: Dict[str, str] - The PDF files to parse, with the directory where their table images are saved.
+        - max_workers: int - Number of worker processes.
+        - pages_per_shard: int - Maximum number of pages parsed by a worker at once.
+        - page_timeout: Optional[float] - Seconds allowed per page, None disables the timeout.
+        - text_layer_fast_path: bool - See 'extract_paragraphs_and_tables'.
+        - ocr_cache: Optional[SQLiteOCRCache] - See 'extract_paragraphs_and_tables', shared by the worker processes.
+        - extract_table_images: bool - See 'extract_paragraphs_and_tables'.
+        - chunk_elements: bool - See 'partition_paragraphs_and_tables'.
+
+    Yields:
+        - Tuple[str, Union[Tuple[List[dict], List[str]], Exception]] - Each file, as soon as all of its pages
+          are parsed, with its (paragraphs, tables), or the exception that failed it.
+    """
+    results: Dict[str, Dict[int, Tuple[List[dict], List[str]]]] = {}
+    shard_counts: Dict[str, int] = {}
+    failed: Dict[str, Exception] = {}
+
+    with ProcessPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {}
+        for file, image_output_dir_path in files.items():
+            try:
+                ranges = page_ranges(count_pages(file), pages_per_shard)
+            except Exception as e:
+                yield file, e
+                continue
+            if not ranges:
+                yield file, ([], [])
+                continue
+            results[file], shard_counts[file] = {}, len(ranges)
+            for first_page, last_page in ranges:
+                future = executor.submit(extract_page_range, file, image_output_dir_path, first_page, last_page,
+                                         page_timeout, text_layer_fast_path, ocr_cache, extract_table_images,
+                                         chunk_elements)
+                futures[future] = (file, first_page)
 
-            if len(clean_text) > 5:
-                paragraphs.append({
-                    "text": clean_text,
-                    "type": element_type,
-                })
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                file, first_page = futures.pop(future)
+                if file in failed:
+                    continue
+                try:
+                    results[file][first_page] = future.result()
+                except Exception as e:
+                    failed[file] = e
+                    # The other ranges of the file are useless now, skip the ones not started yet.
+                    for other, (other_file, _) in futures.items():
+                        if other_file == file:
+                            other.cancel()
+                    results.pop(file)
+                    yield file, e
+                    continue
 
-    return paragraphs, tables
\ No newline at end of file
+                if len(results[file]) == shard_counts[file]:
+                    shards = results.pop(file)
+                    paragraphs = [p for first in sorted(shards) for p in shards[first][0]]
+                    tables     = [t for first in sorted(shards) for t in shards[first][1]]
+                    yield file, (paragraphs, tables)
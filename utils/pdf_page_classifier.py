@@ -0,0 +1,75 @@
+from typing import Iterable, List, Optional, Tuple
+from pdfminer.high_level import extract_pages
+from pdfminer.layout import LAParams, LTCurve, LTFigure, LTImage, LTLine, LTPage, LTRect, LTTextContainer
+
+
+def _iter_layout(objects: Iterable) -> Iterable:
+    for obj in objects:
+        yield obj
+        if isinstance(obj, LTFigure):
+            yield from _iter_layout(obj)
+
+
+def classify_page(
+                    page:               LTPage,
+                    min_chars:          int = 50,
+                    max_image_coverage: float = 0.5,
+                    max_garbled_ratio:  float = 0.1,
+                    min_table_rulings:  int = 8,
+                    ) -> str:
+    """
+    Classify a page parsed by pdfminer as "text" (born-digital, its text layer can be used as is)
+    or "ocr" (scanned, garbled text layer, or likely table that needs structure inference).
+
+    Args:
+        - page: LTPage - The page layout, from pdfminer's 'extract_pages'.
+        - min_chars: int - Minimum number of non-blank characters of a usable text layer.
+        - max_image_coverage: float - Fraction of the page covered by images above which it is considered scanned.
+        - max_garbled_ratio: float - Fraction of unmapped glyphs ("(cid:N)") above which the text layer is unusable.
+        - min_table_rulings: int - Number of ruling lines and rectangles from which the page likely holds a table.
+    """
+    text        = ""
+    image_area  = 0.0
+    rulings     = 0
+
+    for obj in _iter_layout(page):
+        if isinstance(obj, LTTextContainer):
+            text += obj.get_text()
+        elif isinstance(obj, LTImage):
+            image_area += obj.width * obj.height
+        elif isinstance(obj, (LTLine, LTRect, LTCurve)):
+            rulings += 1
+
+    chars = sum(1 for c in text if not c.isspace())
+    page_area = max(page.width * page.height, 1.0)
+
+    if chars < min_chars or image_area / page_area > max_image_coverage:
+        return "ocr"
+    # pdfminer renders the glyphs missing from the font's unicode map as "(cid:N)".
+    if text.count("(cid:") * 7 / chars > max_garbled_ratio:
+        return "ocr"
+    if rulings >= min_table_rulings:
+        return "ocr"
+    return "text"
+
+
+def classify_pages(file_path: str, page_numbers: Optional[List[int]] = None, **thresholds) -> List[str]:
+    """
+    Classify every page of a PDF (or the 0-based 'page_numbers'), see 'classify_page'.
+    Only the text layer is read, no page is rendered.
+    """
+    return [classify_page(page, **thresholds)
+            for page in extract_pages(file_path, page_numbers=page_numbers, laparams=LAParams())]
+
+
+def page_runs(page_kinds: List[str]) -> List[Tuple[str, int, int]]:
+    """
+    Group consecutive pages of the same kind in (kind, first page, last page) runs, 1-based and inclusive.
+    """
+    runs: List[Tuple[str, int, int]] = []
+    for page_number, kind in enumerate(page_kinds, start=1):
+        if runs and runs[-1][0] == kind:
+            runs[-1] = (kind, runs[-1][1], page_number)
+        else:
+            runs.append((kind, page_number, page_number))
+    return runs
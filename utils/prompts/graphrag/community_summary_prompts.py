@@ -0,0 +1,49 @@
+from langchain_core.prompts import ChatPromptTemplate
+
+# Summary of a community of the knowledge graph, from its entities and relations.
+community_summary_prompt = ChatPromptTemplate.from_template(
+    """
+    You are a knowledge graph analyst. You are given a community of closely related entities extracted from a
+    document collection, with the relationships among them. Write a report of the community that answers:
+    what is this group of entities about, which entities are central, and what are the key facts connecting them.
+
+    Follow these rules:
+    1. Give the community a short, specific title (at most 10 words).
+    2. Limit the summary to no more than 8 sentences.
+    3. Only use the information in the entities and relationships below; do not hallucinate.
+    4. Mention the most important entities by name.
+
+    Entities:
+    {entities}
+
+    Relationships:
+    {relations}
+
+    Use <think> </think> tags to indicate your thought process.
+    However, please ensure that your internal reasoning is not included in your final response.
+
+    Use <title> </title> tags to indicate the title of the community, and <summary> </summary> tags to indicate its summary.
+    """
+)
+
+# Summary of a higher level community, from the summaries of its sub-communities.
+community_of_communities_summary_prompt = ChatPromptTemplate.from_template(
+    """
+    You are a knowledge graph analyst. You are given the reports of several sub-communities of entities that
+    together form a larger community of a document collection. Combine them into one report of the larger community:
+    its overall theme, its most important entities, and how the sub-communities relate to each other.
+
+    Follow these rules:
+    1. Give the community a short, specific title (at most 10 words).
+    2. Limit the summary to no more than 8 sentences.
+    3. Only use the information in the reports below; do not hallucinate.
+
+    Sub-community reports:
+    {summaries}
+
+    Use <think> </think> tags to indicate your thought process.
+    However, please ensure that your internal reasoning is not included in your final response.
+
+    Use <title> </title> tags to indicate the title of the community, and <summary> </summary> tags to indicate its summary.
+    """
+)
@@ -81,4 +81,43 @@ additional_entity_extraction_prompt = ChatPromptTemplate.from_template(
 
     Now, extract any additional entities:
     """
-)
\ No newline at end of file
+)
+
+# Packed entity extraction prompt, several paragraphs per request to send the instructions only once.
+batched_entity_extraction_prompt = ChatPromptTemplate.from_template(
+    """
+    You are an entity extraction assistant.
+    Your goal is to identify all major relevant entities in each of the paragraphs below and output them in valid JSON. 
+
+    Follow these rules:
+    1. For each entity, create a JSON object with three fields:
+       - "name": The entity’s name or label as mentioned in the text.
+       - "type": One of the following relevant categories or derivated (use your best judgment):
+         for example {example_entity_types}.
+       - "context": A brief (one-sentence) explanation of how this entity is referenced or what it is, based on the paragraph.
+    2. Return the entities of each paragraph as a separate JSON array.
+    3. If no entities are found in a paragraph, return an empty array `[]` for it.
+    4. Do not include any additional commentary or chain-of-thought in the final answer. 
+    5. Only include information that is explicitly in the paragraph; do not hallucinate.
+    6. Treat each paragraph on its own, entities of one paragraph must not be reported for another one.
+
+    Paragraphs:
+    {paragraphs}
+
+    Use <think> </think> tags to indicate your thought process.
+    Finally, for EVERY paragraph, use <entities id="N"> </entities> tags, where N is the id of the paragraph,
+    to indicate the entities extracted from it.
+    For example:
+    <entities id="1">
+    [
+        json object 1,
+        json object 2,
+    ]
+    </entities>
+    <entities id="2">
+    []
+    </entities>
+
+    Now extract the entities and return them in valid JSON:
+    """
+)
@@ -90,4 +90,42 @@ additional_relations_extraction_prompt = ChatPromptTemplate.from_template(
 
     Now, extract any additional relationships:
     """
-)
\ No newline at end of file
+)
+
+# Packed relationship extraction prompt, several paragraphs per request to send the instructions only once.
+batched_relationship_extraction_prompt = ChatPromptTemplate.from_template(
+    """
+    You are a relationship extraction assistant.
+    Your goal is to identify all major relevant relationships among entities in each of the paragraphs below and output them in valid JSON. 
+
+    Follow these rules:
+    1. For each relationship, create a JSON object with three fields:
+       - "source_entity": The entity that is the source of the relationship.
+       - "target_entity": The entity that is the target or object of the relationship.
+       - "relation_detail": A brief description of the relationship between the two entities, could be a verb or a phrase.
+    2. Return the relationships of each paragraph as a separate JSON array.
+    3. Make sure the "source_entity" and "target_entity" fields belong to the entities found in that same paragraph.
+    4. If no relationships are found in a paragraph, return an empty array `[]` for it.
+    5. Do not include any additional commentary or chain-of-thought in the final answer. 
+    6. Only include information that is explicitly in the paragraph; do not hallucinate.
+
+    Paragraphs, each one with its found entities:
+    {paragraphs}
+
+    Use <think> </think> tags to indicate your thought process.
+    Finally, for EVERY paragraph, use <relationships id="N"> </relationships> tags, where N is the id of the paragraph,
+    to indicate the relationships extracted from it.
+    For example:
+    <relationships id="1">
+    [
+        json object 1,
+        json object 2,
+    ]
+    </relationships>
+    <relationships id="2">
+    []
+    </relationships>
+
+    Now extract the relationships and return them in valid JSON:
+    """
+)
@@ -0,0 +1,272 @@
+import time
+import random
+import asyncio
+import threading
+
+from typing                         import Any, Dict, Optional, Tuple
+from langchain_core.messages        import BaseMessage
+from langchain_core.runnables       import Runnable, RunnableConfig
+
+from utils.tokens import estimate_tokens
+
+# Error codes/names that mean "slow down" rather than "this request is wrong".
+THROTTLING_ERROR_CODES = {"ThrottlingException", "TooManyRequestsException",
+                          "ServiceUnavailableException", "ModelNotReadyException"}
+THROTTLING_STATUS_CODES = {429, 503}
+TRANSIENT_ERROR_NAMES   = {"ConnectError", "ConnectTimeout", "ReadTimeout", "RemoteProtocolError",
+                           "ReadTimeoutError", "EndpointConnectionError"}
+
+
+def is_throttling_error(error: Exception) -> bool:
+    """
+    Whether the error is Bedrock/Ollama asking us to slow down (or an overloaded server dropping the connection).
+    """
+    response = getattr(error, "response", None)
+    if isinstance(response, dict):
+        code = response.get("Error", {}).get("Code")
+        if code in THROTTLING_ERROR_CODES:
+            return True
+
+    if getattr(error, "status_code", None) in THROTTLING_STATUS_CODES:
+        return True
+
+    return type(error).__name__ in TRANSIENT_ERROR_NAMES or "throttl" in str(error).lower()
+
+
+class AdaptiveRateLimiter:
+    """
+        Client-side limiter for one model.
+
+        It enforces requests-per-minute and tokens-per-minute budgets with token buckets, and keeps
+        a concurrency limit that adapts AIMD-style: it grows by ~1 request per round of successful calls
+        and is halved on throttling (or reduced on latency spikes), between 1 and 'max_concurrency'.
+        Thread-safe, and usable from both sync and async code.
+    """
+
+    def __init__(
+                    self,
+                    requests_per_minute:    Optional[float] = None,
+                    tokens_per_minute:      Optional[float] = None,
+                    max_concurrency:        int = 8,
+                    latency_spike_factor:   float = 3.0,
+                    check_every_n_seconds:  float = 0.05,
+                ):
+        """
+        Args:
+            - requests_per_minute: Optional[float] - Request budget, None for unlimited.
+            - tokens_per_minute: Optional[float] - Input + output token budget, None for unlimited.
+            - max_concurrency: int - Ceiling (and starting value) of the adaptive concurrency limit.
+            - latency_spike_factor: float - A call slower than this factor times the average latency counts as congestion.
+            - check_every_n_seconds: float - Polling interval while waiting for budget.
+        """
+        self.requests_per_minute    = requests_per_minute
+        self.tokens_per_minute      = tokens_per_minute
+        self.max_concurrency        = max(1, max_concurrency)
+        self.latency_spike_factor   = latency_spike_factor
+        self.check_every_n_seconds  = check_every_n_seconds
+
+        self.concurrency_limit  = float(self.max_concurrency)
+        self.in_flight          = 0
+        self.avg_latency        = None
+        self.throttled_count    = 0
+
+        # Buckets hold at most one second worth of budget, so bursts stay small.
+        self._request_bucket    = self._capacity(requests_per_minute)
+        self._token_bucket      = self._capacity(tokens_per_minute)
+        self._last_refill       = time.monotonic()
+        self._lock              = threading.Lock()
+
+    @staticmethod
+    def _capacity(per_minute: Optional[float]) -> float:
+        return max(1.0, per_minute / 60) if per_minute else 0.0
+
+    def _refill(self) -> None:
+        now     = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+
+        if self.requests_per_minute:
+            self._request_bucket = min(self._capacity(self.requests_per_minute),
+                                       self._request_bucket + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute:
+            self._token_bucket = min(self._capacity(self.tokens_per_minute),
+                                     self._token_bucket + elapsed * self.tokens_per_minute / 60)
+
+    def try_acquire(self, estimated_tokens: int = 0) -> bool:
+        """
+        Take a concurrency slot and budget for one request if available, without waiting.
+        """
+        with self._lock:
+            self._refill()
+
+            if self.in_flight >= int(self.concurrency_limit):
+                return False
+            if self.requests_per_minute and self._request_bucket < 1:
+                return False
+            # A request bigger than the bucket is let through once the bucket is full, leaving it in debt.
+            if self.tokens_per_minute and self._token_bucket < min(estimated_tokens, self._capacity(self.tokens_per_minute)):
+                return False
+
+            self.in_flight += 1
+            if self.requests_per_minute:
+                self._request_bucket -= 1
+            if self.tokens_per_minute:
+                self._token_bucket -= estimated_tokens
+            return True
+
+    def acquire(self, estimated_tokens: int = 0) -> None:
+        """
+        Block until a request of 'estimated_tokens' can be sent.
+        """
+        while not self.try_acquire(estimated_tokens):
+            time.sleep(self.check_every_n_seconds)
+
+    async def aacquire(self, estimated_tokens: int = 0) -> None:
+        """
+        Wait (without blocking the event loop) until a request of 'estimated_tokens' can be sent.
+        """
+        while not self.try_acquire(estimated_tokens):
+            await asyncio.sleep(self.check_every_n_seconds)
+
+    def release(
+                self,
+                estimated_tokens:   int = 0,
+                used_tokens:        Optional[int] = None,
+                latency:            Optional[float] = None,
+                throttled:          bool = False,
+                cache_hit:          bool = False,
+                ) -> None:
+        """
+        Give back the concurrency slot and adapt the limit to the outcome of the request.
+
+        Args:
+            - estimated_tokens: int - Tokens reserved on acquire.
+            - used_tokens: Optional[int] - Tokens actually used, to correct the reservation.
+            - latency: Optional[float] - Seconds the request took.
+            - throttled: bool - Whether the provider throttled the request.
+            - cache_hit: bool - The response came from the LLM cache, so the whole reservation is given back.
+        """
+        with self._lock:
+            self.in_flight -= 1
+
+            if cache_hit:
+                if self.requests_per_minute:
+                    self._request_bucket += 1
+                if self.tokens_per_minute:
+                    self._token_bucket += estimated_tokens
+                return
+
+            if self.tokens_per_minute and used_tokens is not None:
+                self._token_bucket += estimated_tokens - used_tokens
+
+            # Multiplicative decrease on throttling.
+            if throttled:
+                self.throttled_count += 1
+                self.concurrency_limit = max(1.0, self.concurrency_limit / 2)
+                return
+
+            if latency is None:
+                return
+
+            # Gentler decrease on latency spikes, additive increase otherwise.
+            if self.avg_latency and latency > self.latency_spike_factor * self.avg_latency:
+                self.concurrency_limit = max(1.0, self.concurrency_limit * 0.8)
+            else:
+                self.concurrency_limit = min(float(self.max_concurrency),
+                                             self.concurrency_limit + 1 / self.concurrency_limit)
+
+            self.avg_latency = latency if self.avg_latency is None else 0.9 * self.avg_latency + 0.1 * latency
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Current state of the limiter, for logging.
+        """
+        with self._lock:
+            return {
+                "concurrency_limit":    round(self.concurrency_limit, 2),
+                "in_flight":            self.in_flight,
+                "avg_latency":          self.avg_latency,
+                "throttled_count":      self.throttled_count,
+            }
+
+
+class RateLimitedChatModel(Runnable):
+    """
+        Wraps a chat model so every call goes through an AdaptiveRateLimiter,
+        and throttled calls are retried with exponential backoff and full jitter.
+        It behaves like the wrapped model in a (prompt | llm) chain, and other attributes are delegated to it.
+    """
+
+    def __init__(
+                    self,
+                    llm:            Runnable,
+                    limiter:        AdaptiveRateLimiter,
+                    max_retries:    int = 6,
+                    base_backoff:   float = 1.0,
+                    max_backoff:    float = 60.0,
+                ):
+        self.llm            = llm
+        self.limiter        = limiter
+        self.max_retries    = max_retries
+        self.base_backoff   = base_backoff
+        self.max_backoff    = max_backoff
+
+    def __getattr__(self, name: str) -> Any:
+        # Only called for attributes missing on the wrapper, e.g. 'model' or 'cache'.
+        if name == "llm":
+            raise AttributeError(name)
+        return getattr(self.llm, name)
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt))
+
+    @staticmethod
+    def _usage(input_tokens: int, response: BaseMessage) -> Tuple[bool, int]:
+        """
+        Whether the response is a cache hit, and the tokens it used.
+        """
+        cache_hit = bool(getattr(response, "response_metadata", {}).get("cache_hit"))
+        usage     = getattr(response, "usage_metadata", None)
+        if usage and usage.get("total_tokens"):
+            return cache_hit, usage["total_tokens"]
+        return cache_hit, input_tokens + estimate_tokens(response.content)
+
+    def invoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> BaseMessage:
+        estimated = estimate_tokens(input)
+
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire(estimated)
+            start = time.monotonic()
+            try:
+                response = self.llm.invoke(input, config, **kwargs)
+            except Exception as e:
+                throttled = is_throttling_error(e)
+                self.limiter.release(estimated, throttled=throttled)
+                if not throttled or attempt == self.max_retries:
+                    raise
+                time.sleep(self._backoff(attempt))
+                continue
+
+            cache_hit, used = self._usage(estimated, response)
+            self.limiter.release(estimated, used, time.monotonic() - start, cache_hit=cache_hit)
+            return response
+
+    async def ainvoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> BaseMessage:
+        estimated = estimate_tokens(input)
+
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.aacquire(estimated)
+            start = time.monotonic()
+            try:
+                response = await self.llm.ainvoke(input, config, **kwargs)
+            except Exception as e:
+                throttled = is_throttling_error(e)
+                self.limiter.release(estimated, throttled=throttled)
+                if not throttled or attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(self._backoff(attempt))
+                continue
+
+            cache_hit, used = self._usage(estimated, response)
+            self.limiter.release(estimated, used, time.monotonic() - start, cache_hit=cache_hit)
+            return response
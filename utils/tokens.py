@@ -0,0 +1,62 @@
+from typing import Any, List, Optional
+
+# Rough number of characters per token for the English/Spanish text we process.
+# Good enough to size budgets without pulling a tokenizer for every provider.
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: Any) -> int:
+    """
+    Estimate the number of tokens of a text, a prompt value or a list of messages.
+    """
+    if hasattr(text, "to_string"):
+        text = text.to_string()
+    elif isinstance(text, list):
+        text = " ".join(str(getattr(m, "content", m)) for m in text)
+
+    return max(1, len(str(text)) // CHARS_PER_TOKEN)
+
+
+def pack_by_token_budget(texts: List[str], max_tokens: int, max_items: Optional[int] = None) -> List[List[int]]:
+    """
+    Greedily pack consecutive texts into batches of at most 'max_tokens' estimated tokens
+    (and at most 'max_items' texts). A text bigger than the budget gets a batch of its own.
+
+    Returns:
+        - List[List[int]] - The indexes of the texts in each batch, in order.
+    """
+    batches: List[List[int]] = []
+    batch_tokens = 0
+
+    for i, text in enumerate(texts):
+        tokens = estimate_tokens(text)
+        full   = batches and (batch_tokens + tokens > max_tokens or (max_items and len(batches[-1]) >= max_items))
+
+        if not batches or full:
+            batches.append([i])
+            batch_tokens = tokens
+        else:
+            batches[-1].append(i)
+            batch_tokens += tokens
+
+    return batches
+
+
+def head_by_tokens(text: str, max_tokens: int) -> str:
+    """
+    Keep the beginning of a text, up to 'max_tokens' estimated tokens, cut at a word boundary.
+    """
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars].rsplit(" ", 1)[0] + " ..."
+
+
+def tail_by_tokens(text: str, max_tokens: int) -> str:
+    """
+    Keep the end of a text, up to 'max_tokens' estimated tokens, cut at a word boundary.
+    """
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    return "... " + text[-max_chars:].split(" ", 1)[-1]
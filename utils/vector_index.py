@@ -0,0 +1,445 @@
+import os
+import shutil
+import threading
+import numpy as np
+
+from abc        import ABC, abstractmethod
+from os         import path
+from typing     import Any, Dict, Iterable, List, Optional, Tuple
+
+from utils.graph_store                   import OFFSET_DTYPE
+from utils.base_operations.serialization import atomic_write, dumps, loads, save_array, truncate_file
+
+VECTOR_DTYPE = np.dtype("<f4")
+ROW_DTYPE    = np.dtype("<i4")
+
+# Rows scored at once by the exact search, bounds the memory of a query.
+SCAN_BLOCK_SIZE = 65536
+
+
+def normalize_vectors(vectors: np.ndarray) -> np.ndarray:
+    """
+    Unit-length float32 rows, so the cosine similarity is a dot product.
+    """
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def _top_k(scores: np.ndarray, rows: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    if len(scores) > k:
+        best = np.argpartition(-scores, k - 1)[:k]
+        scores, rows = scores[best], rows[best]
+    order = np.argsort(-scores, kind="stable")
+    return scores[order], rows[order]
+
+
+class VectorIndex(ABC):
+    """
+        Vector index of the chunks of the corpus, searched by cosine similarity.
+
+        A document is indexed as a whole and replaces its previous chunks, so reindexing a changed document
+        never leaves stale chunks behind. Implemented in process by 'LocalVectorIndex'; a vector database
+        (e.g. the configured 'vector_db') plugs in by implementing the same methods.
+    """
+
+    @abstractmethod
+    def add_document(self, document: str, batches: Iterable[Tuple[List[Dict[str, Any]], np.ndarray]]) -> int:
+        """
+        Index the chunks of a document, replacing its previous chunks.
+
+        Args:
+            - document: str - Path of the document, its key in the index.
+            - batches: Iterable[Tuple[List[Dict[str, Any]], np.ndarray]] - The chunk records (with their "chunk_id")
+                       and their embeddings, batch by batch, so the document can be streamed.
+
+        Returns:
+            - int - The number of chunks indexed.
+        """
+
+    @abstractmethod
+    def delete_document(self, document: str) -> None:
+        """
+        Remove the chunks of a document from the search results.
+        """
+
+    @abstractmethod
+    def search(self, vector: np.ndarray, k: int = 5) -> List[Dict[str, Any]]:
+        """
+        The 'k' chunks closest to the query embedding, best first: their record with its "score" and "document".
+        """
+
+    @abstractmethod
+    def build(self) -> None:
+        """
+        Update the search structures with the chunks added since the last build.
+        """
+
+    @property
+    @abstractmethod
+    def documents(self) -> Dict[str, int]:
+        """
+        The indexed documents.
+        """
+
+    def compact(self, max_dead_ratio: float = 0.3) -> bool:
+        """
+        Reclaim the space of the deleted and replaced chunks once they are more than 'max_dead_ratio' of the
+        rows. A no-op for the backends that reclaim it themselves. Returns whether the index was compacted.
+        """
+        return False
+
+
+class LocalVectorIndex(VectorIndex):
+    """
+        In-process vector index, persisted in a directory:
+
+        - vectors.f32: the normalized embeddings, one float32 row per chunk, appended in place and memory mapped.
+        - records.jsonl: the chunk records (chunk id, document, text), the line number is the row, and
+          record_offsets.bin: the byte offset of each line, so only the records of the results are read.
+        - rows.bin: the document id of each row, written last, so it sets the number of rows.
+        - ivf/: an inverted file index (k-means centroids, and the rows of each centroid in CSR form), trained
+          once there are 'ivf_min_vectors' rows and retrained when the rows grew by 'ivf_retrain_ratio'.
+        - documents.json: the live document id of each document. A document indexed again gets a new id,
+          which drops its previous rows.
+        - state.json: the dimension of the vectors and the current generation of the row files above.
+
+        The rows of deleted and replaced documents are dead until 'compact' copies the live rows to a new
+        generation directory ("generation-<n>", the first generation is the index directory itself) and
+        switches state.json to it. The previous generation is kept for the queries still reading it.
+
+        A query scores the rows of the 'nprobe' centroids closest to it, plus the rows added since the last
+        training, instead of every row. Below 'ivf_min_vectors' rows, or with exact=True, every row is scored,
+        block by block. The documents indexed concurrently share one instance per directory, see 'for_directory'.
+    """
+
+    _instances: Dict[str, "LocalVectorIndex"] = {}
+    _instances_guard = threading.Lock()
+
+    # The row files of a generation.
+    ROW_FILES = ["vectors.f32", "records.jsonl", "record_offsets.bin", "rows.bin"]
+
+    def __init__(
+                    self,
+                    directory:          str,
+                    nprobe:             int = 8,
+                    ivf_min_vectors:    int = 4096,
+                    ivf_retrain_ratio:  float = 2.0,
+                    seed:               int = 42,
+                ):
+        """
+        Args:
+            - directory: str - Directory of the index files, created if missing.
+            - nprobe: int - Number of IVF centroids whose rows are scored by a query.
+            - ivf_min_vectors: int - Number of rows from which the IVF index is trained, the rows are all scored below.
+            - ivf_retrain_ratio: float - The IVF index is trained again when the rows grew by this factor since the last training.
+            - seed: int - Random seed of the k-means training.
+        """
+        self.directory          = directory
+        self.nprobe             = nprobe
+        self.ivf_min_vectors    = ivf_min_vectors
+        self.ivf_retrain_ratio  = ivf_retrain_ratio
+        self.seed               = seed
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.RLock()
+        self._ivf: Optional[Dict[str, Any]] = None
+
+        state = {}
+        if path.exists(self._path("state.json")):
+            with open(self._path("state.json"), "rb") as f:
+                state = loads(f.read())
+        self.dimension: Optional[int] = state.get("dimension")
+        self.generation: int = state.get("generation", 0)
+        os.makedirs(self._rows_path("ivf"), exist_ok=True)
+        self._repair()
+
+        documents = {}
+        if path.exists(self._path("documents.json")):
+            with open(self._path("documents.json"), "rb") as f:
+                documents = loads(f.read())
+        self._documents: Dict[str, int] = documents.get("documents", {})
+        self.next_document_id: int = documents.get("next_document_id", 0)
+
+    @classmethod
+    def for_directory(cls, directory: str, **settings: Any) -> "LocalVectorIndex":
+        """
+        The shared index of a directory, so concurrent appends do not interleave their rows.
+        """
+        with cls._instances_guard:
+            key = path.abspath(directory)
+            if key not in cls._instances:
+                cls._instances[key] = cls(directory, **settings)
+            return cls._instances[key]
+
+    def _path(self, *parts: str) -> str:
+        return path.join(self.directory, *parts)
+
+    def _rows_path(self, *parts: str, generation: Optional[int] = None) -> str:
+        generation = self.generation if generation is None else generation
+        return path.join(self.directory, *([f"generation-{generation}"] if generation else []), *parts)
+
+    def _save_state(self) -> None:
+        atomic_write(self._path("state.json"), dumps({"dimension": self.dimension, "generation": self.generation}))
+
+    def _repair(self) -> None:
+        # An append interrupted by a crash is dropped: rows.bin is written last, so it sets the number of rows,
+        # and the other files are cut back to it. The rows of the interrupted document are not live anyway,
+        # documents.json is only updated once they are all written.
+        row_count = self.row_count
+        truncate_file(self._rows_path("rows.bin"), row_count * ROW_DTYPE.itemsize)
+        truncate_file(self._rows_path("record_offsets.bin"), row_count * OFFSET_DTYPE.itemsize)
+        truncate_file(self._rows_path("vectors.f32"), row_count * (self.dimension or 0) * VECTOR_DTYPE.itemsize)
+
+        records_end = 0
+        if row_count:
+            last_offset = int(np.fromfile(self._rows_path("record_offsets.bin"), dtype=OFFSET_DTYPE)[-1])
+            with open(self._rows_path("records.jsonl"), "rb") as f:
+                f.seek(last_offset)
+                records_end = last_offset + len(f.readline())
+        truncate_file(self._rows_path("records.jsonl"), records_end)
+
+    def _row_count(self, generation: int) -> int:
+        rows_path = self._rows_path("rows.bin", generation=generation)
+        return path.getsize(rows_path) // ROW_DTYPE.itemsize if path.exists(rows_path) else 0
+
+    @property
+    def row_count(self) -> int:
+        """
+        Number of rows appended to the current generation, live or not.
+        """
+        return self._row_count(self.generation)
+
+    @property
+    def documents(self) -> Dict[str, int]:
+        return self._documents
+
+    def _save_documents(self) -> None:
+        atomic_write(self._path("documents.json"), dumps({"documents": self._documents,
+                                                          "next_document_id": self.next_document_id}))
+
+    def _live_rows(self, row_documents: np.ndarray) -> np.ndarray:
+        return np.isin(row_documents, np.fromiter(self._documents.values(), dtype=np.int32))
+
+    # --- Appends ---
+
+    def add_document(self, document: str, batches: Iterable[Tuple[List[Dict[str, Any]], np.ndarray]]) -> int:
+        document = path.normpath(document)
+
+        # The batches are consumed (e.g. embedded) before taking the lock, so the documents indexed
+        # concurrently only wait for each other's appends, not for each other's embedding requests.
+        prepared = []
+        for records, vectors in batches:
+            if not records:
+                continue
+            vectors = normalize_vectors(vectors)
+            if len(vectors) != len(records):
+                raise ValueError(f"Got {len(vectors)} embeddings for {len(records)} chunks of {document}")
+            prepared.append(([dumps({**record, "document": document}) + b"\n" for record in records], vectors))
+
+        with self._lock:
+            for lines, vectors in prepared:
+                if self.dimension is None:
+                    self.dimension = int(vectors.shape[1])
+                    self._save_state()
+                elif vectors.shape[1] != self.dimension:
+                    raise ValueError(f"Embeddings of dimension {vectors.shape[1]} do not match the index dimension "
+                                     f"{self.dimension}, delete {self.directory} to index them with another model.")
+
+            document_id = self.next_document_id
+            for lines, vectors in prepared:
+                # Vectors and the side table first, and the rows last (see '_repair').
+                with open(self._rows_path("records.jsonl"), "ab") as f:
+                    start = f.tell()
+                    f.write(b"".join(lines))
+                offsets = start + np.concatenate([[0], np.cumsum([len(line) for line in lines[:-1]], dtype=np.int64)])
+                with open(self._rows_path("record_offsets.bin"), "ab") as f:
+                    f.write(np.asarray(offsets, dtype=OFFSET_DTYPE).tobytes())
+                with open(self._rows_path("vectors.f32"), "ab") as f:
+                    f.write(vectors.astype(VECTOR_DTYPE).tobytes())
+                with open(self._rows_path("rows.bin"), "ab") as f:
+                    f.write(np.full(len(lines), document_id, dtype=ROW_DTYPE).tobytes())
+
+            self._documents[document] = document_id
+            self.next_document_id += 1
+            self._save_documents()
+            return sum(len(lines) for lines, _ in prepared)
+
+    def delete_document(self, document: str) -> None:
+        with self._lock:
+            if self._documents.pop(path.normpath(document), None) is not None:
+                self._save_documents()
+
+    # --- Compaction ---
+
+    def _remove_generation(self, generation: int) -> None:
+        if generation:
+            shutil.rmtree(self._rows_path(generation=generation), ignore_errors=True)
+            return
+        # The first generation lives in the index directory itself.
+        for file_name in self.ROW_FILES:
+            if path.exists(self._path(file_name)):
+                os.remove(self._path(file_name))
+        shutil.rmtree(self._path("ivf"), ignore_errors=True)
+
+    def compact(self, max_dead_ratio: float = 0.3) -> bool:
+        with self._lock:
+            row_count = self.row_count
+            if not row_count:
+                return False
+            row_documents = np.fromfile(self._rows_path("rows.bin"), dtype=ROW_DTYPE)
+            live = self._live_rows(row_documents)
+            if 1 - live.mean() < max_dead_ratio:
+                return False
+
+            # The live rows are copied to the next generation, left over by a crashed compaction if it exists.
+            generation = self.generation + 1
+            self._remove_generation(generation)
+            os.makedirs(self._rows_path("ivf", generation=generation))
+
+            vectors = np.memmap(self._rows_path("vectors.f32"), dtype=VECTOR_DTYPE, mode="r", shape=(row_count, self.dimension))
+            with open(self._rows_path("vectors.f32", generation=generation), "wb") as f:
+                for start in range(0, row_count, SCAN_BLOCK_SIZE):
+                    f.write(np.asarray(vectors[start:start + SCAN_BLOCK_SIZE])[live[start:start + SCAN_BLOCK_SIZE]].tobytes())
+
+            offsets = []
+            with open(self._rows_path("records.jsonl"), "rb") as source, \
+                    open(self._rows_path("records.jsonl", generation=generation), "wb") as f:
+                for line, is_live in zip(source, live):
+                    if is_live:
+                        offsets.append(f.tell())
+                        f.write(line)
+            with open(self._rows_path("record_offsets.bin", generation=generation), "wb") as f:
+                f.write(np.asarray(offsets, dtype=OFFSET_DTYPE).tobytes())
+            with open(self._rows_path("rows.bin", generation=generation), "wb") as f:
+                f.write(row_documents[live].astype(ROW_DTYPE).tobytes())
+
+            # The new generation only becomes current once complete, the previous one stays for the
+            # queries still reading it, and the older ones are removed.
+            self.generation = generation
+            self._save_state()
+            self._ivf = None
+            for old in range(generation - 1):
+                self._remove_generation(old)
+            return True
+
+    # --- IVF ---
+
+    def _kmeans(self, vectors: np.ndarray, rows: np.ndarray, clusters: int, iterations: int = 10) -> np.ndarray:
+        # Spherical k-means on a sample of the rows: the centroids are normalized means.
+        rng = np.random.default_rng(self.seed)
+        sample = np.sort(rng.choice(rows, size=min(len(rows), clusters * 64), replace=False))
+        points = np.asarray(vectors[sample])
+        centroids = points[rng.choice(len(points), size=clusters, replace=False)]
+        for _ in range(iterations):
+            assignments = np.argmax(points @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, points)
+            empty = np.bincount(assignments, minlength=clusters) == 0
+            # An empty centroid is moved to a random point.
+            sums[empty] = points[rng.choice(len(points), size=int(empty.sum()))]
+            centroids = normalize_vectors(sums)
+        return centroids
+
+    def build(self) -> None:
+        with self._lock:
+            row_count = self.row_count
+            ivf_state = {}
+            if path.exists(self._rows_path("ivf", "state.json")):
+                with open(self._rows_path("ivf", "state.json"), "rb") as f:
+                    ivf_state = loads(f.read())
+            if row_count < self.ivf_min_vectors or (ivf_state.get("dimension") == self.dimension
+                                                    and row_count < ivf_state.get("rows", 0) * self.ivf_retrain_ratio):
+                return
+
+            vectors = np.memmap(self._rows_path("vectors.f32"), dtype=VECTOR_DTYPE, mode="r", shape=(row_count, self.dimension))
+            live = np.flatnonzero(self._live_rows(np.fromfile(self._rows_path("rows.bin"), dtype=ROW_DTYPE)))
+            if len(live) < self.ivf_min_vectors:
+                return
+            clusters = int(np.clip(np.sqrt(len(live)) * 2, 16, 65536))
+            centroids = self._kmeans(vectors, live, clusters)
+
+            assignments = np.empty(len(live), dtype=np.int64)
+            for start in range(0, len(live), SCAN_BLOCK_SIZE):
+                block = live[start:start + SCAN_BLOCK_SIZE]
+                assignments[start:start + len(block)] = np.argmax(np.asarray(vectors[block]) @ centroids.T, axis=1)
+            order = np.argsort(assignments, kind="stable")
+            indptr = np.zeros(clusters + 1, dtype=np.int64)
+            np.cumsum(np.bincount(assignments, minlength=clusters), out=indptr[1:])
+
+            os.makedirs(self._rows_path("ivf"), exist_ok=True)
+            save_array(self._rows_path("ivf", "centroids.npy"), centroids.astype(VECTOR_DTYPE))
+            save_array(self._rows_path("ivf", "indptr.npy"), indptr)
+            save_array(self._rows_path("ivf", "rows.npy"), live[order].astype(np.int64))
+            atomic_write(self._rows_path("ivf", "state.json"), dumps({"rows": row_count, "dimension": self.dimension}))
+            self._ivf = None
+
+    def _load_ivf(self) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            if self._ivf is None and path.exists(self._rows_path("ivf", "state.json")):
+                with open(self._rows_path("ivf", "state.json"), "rb") as f:
+                    state = loads(f.read())
+                if state.get("dimension") == self.dimension:
+                    self._ivf = {"rows_trained": state["rows"], "generation": self.generation,
+                                 **{array: np.load(self._rows_path("ivf", f"{array}.npy"), mmap_mode="r")
+                                    for array in ["centroids", "indptr", "rows"]}}
+            return self._ivf
+
+    # --- Queries ---
+
+    def search(self, vector: np.ndarray, k: int = 5, exact: bool = False, nprobe: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        The 'k' chunks closest to the query embedding, best first: their record with its "score" and "document".
+
+        Args:
+            - vector: np.ndarray - The query embedding.
+            - k: int - Number of chunks returned.
+            - exact: bool - Score every row instead of the rows of the closest IVF centroids.
+            - nprobe: Optional[int] - Number of IVF centroids scored, overrides the index setting.
+        """
+        # The files of one generation are read, even if a compaction switches to the next one meanwhile.
+        with self._lock:
+            generation = self.generation
+            row_count = self.row_count
+            ivf = None if exact else self._load_ivf()
+        if not row_count or not self._documents or k <= 0:
+            return []
+        query = normalize_vectors(vector)[0]
+        if len(query) != self.dimension:
+            raise ValueError(f"Query of dimension {len(query)} does not match the index dimension {self.dimension}")
+
+        rows_path = lambda file_name: self._rows_path(file_name, generation=generation)
+        vectors = np.memmap(rows_path("vectors.f32"), dtype=VECTOR_DTYPE, mode="r", shape=(row_count, self.dimension))
+        row_documents = np.memmap(rows_path("rows.bin"), dtype=ROW_DTYPE, mode="r", shape=(row_count,))
+
+        best_scores, best_rows = np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64)
+        if ivf is None:
+            # Exact search, block by block.
+            for start in range(0, row_count, SCAN_BLOCK_SIZE):
+                end = min(start + SCAN_BLOCK_SIZE, row_count)
+                rows = start + np.flatnonzero(self._live_rows(row_documents[start:end]))
+                scores = np.asarray(vectors[start:end])[rows - start] @ query
+                best_scores, best_rows = _top_k(np.concatenate([best_scores, scores]), np.concatenate([best_rows, rows]), k)
+        else:
+            # The rows of the closest centroids, and the rows appended since the training.
+            centroid_scores = np.asarray(ivf["centroids"]) @ query
+            probes = np.argsort(-centroid_scores)[:nprobe or self.nprobe]
+            rows = np.concatenate([np.asarray(ivf["rows"][ivf["indptr"][c]:ivf["indptr"][c + 1]]) for c in probes]
+                                  + [np.arange(min(ivf["rows_trained"], row_count), row_count)])
+            rows = np.sort(rows[self._live_rows(row_documents[rows])])
+            best_scores, best_rows = _top_k(np.asarray(vectors[rows]) @ query, rows, k)
+
+        offsets = np.memmap(rows_path("record_offsets.bin"), dtype=OFFSET_DTYPE, mode="r", shape=(row_count,))
+        results = []
+        with open(rows_path("records.jsonl"), "rb") as f:
+            for score, row in zip(best_scores, best_rows):
+                f.seek(int(offsets[row]))
+                results.append({**loads(f.readline()), "score": float(score)})
+        return results
+
+    def stats(self) -> Dict[str, int]:
+        ivf = self._load_ivf()
+        row_count = self.row_count
+        live_rows = int(self._live_rows(np.fromfile(self._rows_path("rows.bin"), dtype=ROW_DTYPE)).sum()) if row_count else 0
+        return {"rows": row_count, "live_rows": live_rows, "documents": len(self._documents),
+                "dimension": self.dimension or 0, "generation": self.generation,
+                "ivf_centroids": len(ivf["centroids"]) if ivf is not None else 0}
@@ -1,7 +1,11 @@
 import json
 import random
+import argparse
 from pyvis.network import Network
 
+from utils.graph_store import GraphStore
+from utils.base_operations.entity_resolution import normalize_entity_name
+
 # Function to generate a random hex color code
 def random_color():
     return "#" + ''.join(random.choices('0123456789ABCDEF', k=6))
@@ -14,39 +18,65 @@ def get_color_for_type(entity_type):
         type_to_color[entity_type] = random_color()
     return type_to_color[entity_type]
 
-# Load your data dictionary. For example, if stored in 'data.json'
-file = "./data/sixth-data-extraction/related-processed-growing-tomatoes-successfully-on-the-texas-high-plains.json"
-with open(file, "r", encoding="utf-8") as f:
-    data = json.load(f)
-
-# Dictionaries to hold unique nodes and list for edges
-nodes = {}  # key: entity name, value: dict with type and context
-edges = []  # list of tuples: (source, target, relation_detail)
-
-# Iterate through each paragraph in your data
-for paragraph in data.get("grouped_paragraphs", []):
-    # Process entities
-    for entity in paragraph.get("entities", []):
-        name = entity.get("name")
-        entity_type = entity.get("type", "Unknown")
-        context = entity.get("context", "")
-        if name not in nodes:
-            nodes[name] = {"type": entity_type, "context": context}
-    # Process relations (if available)
-    for relation in paragraph.get("relations", []):
-        # Each relation contains nested dictionaries for source and target entities
-        source = relation.get("source_entity", {}).get("name")
-        target = relation.get("target_entity", {}).get("name")
-        detail = relation.get("relation_detail", "")
-        if source and target:
-            edges.append((source, target, detail))
+parser = argparse.ArgumentParser(description="Draw the knowledge graph built by the 'relate_entities' stage.")
+parser.add_argument("--graph-dir", default="./data/graph",          help="Directory of the graph store.")
+parser.add_argument("--entity",    default=None,                    help="Only draw the neighborhood of this entity.")
+parser.add_argument("--depth",     type=int, default=2,             help="Depth of the neighborhood drawn around --entity.")
+parser.add_argument("--resolved",  default="./data/seventh-data-extraction/resolved-entities.json",
+                    help="Resolved entities index, the aliases of an entity are drawn as one node. Ignored if missing.")
+parser.add_argument("--output",    default="interactive_graph.html", help="Output HTML file.")
+args = parser.parse_args()
+
+# The entities are interned and the relations memory mapped, nothing is loaded from the related JSON files.
+graph = GraphStore.for_directory(args.graph_dir)
+
+# Canonical name and aliases of every entity name, from the 'resolve_entities' stage.
+resolved = {"entities": [], "aliases": {}}
+try:
+    with open(args.resolved, "r", encoding="utf-8") as f:
+        resolved = json.load(f)
+except FileNotFoundError:
+    pass
+
+def canonical(name):
+    entity_id = resolved["aliases"].get(normalize_entity_name(name))
+    return resolved["entities"][entity_id]["name"] if entity_id is not None else name
+
+def aliases_of(name):
+    entity_id = resolved["aliases"].get(normalize_entity_name(name))
+    return resolved["entities"][entity_id]["aliases"] if entity_id is not None else [name]
+
+# The relations to draw, with their source, target and detail
+if args.entity:
+    # Breadth-first walk of the neighborhood, using the CSR adjacency.
+    edges = set()
+    frontier, seen = {canonical(args.entity)}, {canonical(args.entity)}
+    for _ in range(args.depth):
+        next_frontier = set()
+        for name in frontier:
+            for neighbor, relation_id in (n for alias in aliases_of(name) for n in graph.neighbors(alias)):
+                neighbor = canonical(neighbor)
+                edges.add(relation_id)
+                if neighbor not in seen:
+                    seen.add(neighbor)
+                    next_frontier.add(neighbor)
+        frontier = next_frontier
+    relations = [graph.relation(relation_id) for relation_id in sorted(edges)]
+else:
+    relations = list(graph.iter_relations())
+relations = [{**relation, "source": canonical(relation["source"]), "target": canonical(relation["target"])} for relation in relations]
 
 # Create an interactive PyVis network
 net = Network(height="750px", width="100%", notebook=True)
 
+# The nodes to draw: the ends of the live relations, plus the entity of the neighborhood. The entities of
+# removed documents stay interned in the store, they are not drawn.
+nodes = {name for relation in relations for name in (relation["source"], relation["target"])} | ({canonical(args.entity)} if args.entity else set())
+
 # Add nodes with colors based on their type
-for node_name, attrs in nodes.items():
-    color = get_color_for_type(attrs.get("type", "Unknown"))
+for node_name in sorted(nodes):
+    attrs = next((graph.entity(alias) for alias in aliases_of(node_name) if graph.entity(alias)), {})
+    color = get_color_for_type(attrs.get("type") or "Unknown")
     # The title attribute appears when you hover over a node
     net.add_node(node_name,
                  label=node_name,
@@ -54,8 +84,8 @@ for node_name, attrs in nodes.items():
                  color=color)
 
 # Add edges with relation detail labels
-for source, target, detail in edges:
-    net.add_edge(source, target, title=detail, label=detail)
+for relation in relations:
+    net.add_edge(relation["source"], relation["target"], title=relation["detail"], label=relation["detail"])
 
 # Save and open the interactive graph in your web browser
-net.show("interactive_graph.html")
\ No newline at end of file
+net.show(args.output)